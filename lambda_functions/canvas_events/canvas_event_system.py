@@ -1,6 +1,12 @@
+import copy
+import datetime
+import json
+import time
 from typing import Optional
 
-from src.exceptions import UnknownCanvasEventType
+from sqlalchemy import text
+
+from src.exceptions import InvalidCanvasEventRecord, NON_RETRYABLE_EXCEPTIONS, UnknownCanvasEventType
 
 
 from events.asset_events import AssetAccessedEvent
@@ -20,23 +26,74 @@ from events.quiz_events import QuizSubmittedEvent
 from events.grade_events import GradeChangeEvent
 
 from events.logged_events import LoggedInEvent
+from src.canvas_services import submission_histories
+from src.event_lanes import LaneMetrics, LaneRouter
+from src.event_envelope import CanvasEventEnvelope
+from src.event_ledger import OUTCOME_FAILED, OUTCOME_SUCCEEDED, EventLedger
+from src.sf_services import SFServices, activity_timestamps, contact_cache
+from src.sql_metrics import sql_metrics
 from propus.aws.ssm import AWS_SSM
 from propus.logging_utility import Logging
 
+# High volume activity events where only the earliest and latest times matter, so a user's events of these types in a
+# batch are folded into a single event before being processed
+COALESCED_EVENT_TYPES = ("logged_in", "asset_accessed")
+
+# The backing systems each event type's handler uses. Event types that use none are acknowledged as soon as they are
+# parsed, without building a handler or reading the ledger. Event types missing from here are assumed to use them all.
+POSTGRES = "postgres"
+SALESFORCE = "salesforce"
+CANVAS = "canvas"
+ALL_CAPABILITIES = frozenset({POSTGRES, SALESFORCE, CANVAS})
+EVENT_CAPABILITIES = {
+    "asset_accessed": frozenset(),
+    "conversation_created": frozenset(),
+    "conversation_message_created": frozenset(),
+    "course_completed": frozenset(),
+    "course_progress": frozenset(),
+    "submission_updated": frozenset(),
+    "discussion_topic_created": frozenset({POSTGRES, SALESFORCE}),
+    "discussion_topic_updated": frozenset({POSTGRES, SALESFORCE}),
+    "logged_in": frozenset({POSTGRES, SALESFORCE}),
+    "discussion_entry_created": ALL_CAPABILITIES,
+    "discussion_entry_submitted": ALL_CAPABILITIES,
+    "submission_created": ALL_CAPABILITIES,
+    "quiz_submitted": ALL_CAPABILITIES,
+    "grade_change": ALL_CAPABILITIES,
+}
+
 
 class CanvasEventSystem:
     """
     This class is responsible for processing the incoming events from the Canvas event system.
     It will determine the type of event and call the appropriate handler to process the event.
+
+    Systems built through `get_or_build` are kept for the life of the Lambda container, so the Postgres engine and the
+    Salesforce / Canvas clients are shared by every record and every warm invocation.
     """
 
-    def __init__(self, config, psql_engine, sf_client, dlq, canvas_client):
+    _system_registry = {}
+
+    def __init__(
+        self,
+        config,
+        psql_engine,
+        sf_client,
+        dlq,
+        canvas_client,
+        event_ledger: EventLedger = None,
+        lane_router: LaneRouter = None,
+    ):
         self.config = config
         self.logger = Logging.get_logger("castor/lambda_functions/canvas_events/canvas_event_system", debug=True)
         self.psql_engine = psql_engine
         self.sf_client = sf_client
         self.canvas_client = canvas_client
         self.dlq = dlq
+        self.event_ledger = event_ledger if event_ledger is not None else EventLedger()
+        self.lane_router = lane_router if lane_router is not None else LaneRouter()
+        self.lane_metrics = LaneMetrics()
+        sql_metrics.instrument(psql_engine)
         self._event_type_mapping = {
             "asset_accessed": AssetAccessedEvent,
             "discussion_entry_created": DiscussionEntryCreatedEvent,
@@ -77,6 +134,83 @@ class CanvasEventSystem:
             dlq=f"canvas_events_{environment}_dlq.fifo",
         )
 
+    @staticmethod
+    def get_or_build(environment: Optional[str]):
+        """
+        Get the CanvasEventSystem for the environment from the container registry, building it on first use.
+        A cached system is health checked before it is handed back, and its Postgres engine is rebuilt if the
+        connection has gone stale.
+        Args:
+            environment: a string representing the environment (e.g. "localhost", "staging", "prod")
+
+        Returns: a CanvasEventSystem object
+
+        """
+        system = CanvasEventSystem._system_registry.get(environment)
+        if system is None:
+            system = CanvasEventSystem.build(environment)
+            CanvasEventSystem._system_registry[environment] = system
+        elif not system.check_health():
+            system.reconnect_postgres(environment)
+        return system
+
+    @staticmethod
+    def reset_registry():
+        """
+        Drop every cached CanvasEventSystem so the next `get_or_build` call builds a fresh one.
+
+        Returns: None
+
+        """
+        CanvasEventSystem._system_registry.clear()
+
+    def check_health(self):
+        """
+        Check that the Postgres connection is still usable by running a trivial query. Any open transaction left behind
+        by a failed event is rolled back first.
+
+        Returns: True if the connection is healthy, otherwise False
+
+        """
+        try:
+            self.psql_engine.session.rollback()
+            self.psql_engine.session.execute(text("SELECT 1"))
+            return True
+        except Exception as err:
+            self.logger.warning(f"postgres health check failed, reconnecting: {err}")
+            return False
+
+    def reconnect_postgres(self, environment: Optional[str]):
+        """
+        Rebuild the Postgres engine for the environment, closing the stale session if possible.
+        Args:
+            environment: a string representing the environment (e.g. "localhost", "staging", "prod")
+
+        Returns: None
+
+        """
+        try:
+            self.psql_engine.session.close()
+        except Exception as err:
+            self.logger.warning(f"unable to close stale postgres session: {err}")
+        ssm = AWS_SSM.build("us-west-2", use_cache=True)
+        self.psql_engine = self.config.setup_postgres_engine(environment, ssm)
+        sql_metrics.instrument(self.psql_engine)
+
+    def reconcile_contact_timestamps(self):
+        """
+        Repair drift between the known Salesforce contact timestamps kept in Postgres and Salesforce itself. Run on a
+        schedule, see ActivityTimestampStore.reconcile.
+
+        Returns: dict: the reconciliation counts
+
+        """
+        try:
+            return activity_timestamps.reconcile(self.psql_engine.session, self.sf_client)
+        except Exception:
+            self.psql_engine.session.rollback()
+            raise
+
     @staticmethod
     def _get_event_type(event):
         """
@@ -89,21 +223,417 @@ class CanvasEventSystem:
         """
         return event.get("metadata").get("event_name")
 
-    def process_event(self, event):
+    @staticmethod
+    def is_no_op(event_type):
         """
-        Process the event by determining the event type and calling the appropriate handler
+        Check if events of a type are acknowledged without any work, per EVENT_CAPABILITIES
+        Args:
+            event_type: the event type
+
+        Returns: True if the event type's handler uses no backing system
+
+        """
+        return not EVENT_CAPABILITIES.get(event_type, ALL_CAPABILITIES)
+
+    def process_event(
+        self,
+        event,
+        event_keys: Optional[list] = None,
+        defer_ledger: bool = False,
+        envelope: Optional[CanvasEventEnvelope] = None,
+    ):
+        """
+        Process the event by determining the event type and calling the appropriate handler.
+        Event types with no capabilities are acknowledged right away. Events that the ledger shows already succeeded
+        are skipped, and the outcome of the event is recorded in the ledger; a success is recorded in the same
+        transaction as the event's own changes, unless it is deferred.
         Args:
             event: the event to process
+            event_keys: the ledger keys of the events this event stands for, if it was coalesced from several
+            defer_ledger: don't record a success, because the event's Salesforce writes are buffered and haven't been
+                sent yet. The caller records it with `record_success` once they have
+            envelope: the event's envelope, if it was already parsed. Its ledger keys must then be passed as well
 
-        Returns: None
+        Returns: the ledger keys to record as succeeded when `defer_ledger` is set and the event was processed,
+            otherwise None
 
         """
         event_type = self._get_event_type(event)
         if not self._event_type_mapping.get(event_type):
             self.logger.error(f"unrecognized event type: {event_type}. full event: {event}")
             raise UnknownCanvasEventType(event_type)
-        handler = self._event_type_mapping.get(event_type)(
-            event=event, psql_engine=self.psql_engine, sf_client=self.sf_client, canvas_client=self.canvas_client
+        if self.is_no_op(event_type):
+            self.logger.info(f"acknowledging {event_type} event, nothing to process")
+            return
+        # The key has to be taken before the handler is built, as BaseEvent changes the event in place
+        event_keys = event_keys or [EventLedger.event_key(event)]
+        with sql_metrics.event(event_type):
+            try:
+                with sql_metrics.step("ledger"):
+                    applied = self.event_ledger.is_applied(self.psql_engine.session, event_keys)
+                if applied:
+                    self.logger.info(f"skipping {event_type} event already processed: {event_keys}")
+                    return
+            except Exception as err:
+                # The ledger only saves work, so if it can't be read the event is processed as usual
+                self.logger.warning(f"unable to read the event ledger for {event_keys}: {err}")
+                self.psql_engine.session.rollback()
+
+            handler = self._event_type_mapping.get(event_type)(
+                event=envelope or CanvasEventEnvelope(event),
+                psql_engine=self.psql_engine,
+                sf_client=self.sf_client,
+                canvas_client=self.canvas_client,
+            )
+            self.logger.info(f"processing event of type {event_type}")
+            try:
+                # Everything the handler writes to Postgres is committed together once the event has been processed
+                with handler.psql_services.unit_of_work():
+                    with sql_metrics.step("handler"):
+                        try:
+                            handler.process()
+                        except Exception:
+                            # Salesforce calls the handler fanned out still have to finish before the rollback
+                            handler.salesforce.wait(raise_errors=False)
+                            raise
+                        handler.salesforce.wait()
+                    if defer_ledger:
+                        recorded = False
+                    else:
+                        try:
+                            with handler.psql_services.savepoint(), sql_metrics.step("ledger"):
+                                self.event_ledger.record(self.psql_engine.session, event_keys, OUTCOME_SUCCEEDED)
+                            recorded = True
+                        except Exception as err:
+                            self.logger.warning(f"unable to record processed events {event_keys} in the ledger: {err}")
+                            recorded = False
+            except Exception as err:
+                # The session is shared across events in the container, so don't leave a failed transaction behind
+                self.psql_engine.session.rollback()
+                self.record_failure(event_keys, str(err))
+                raise
+            if recorded:
+                self.event_ledger.remember(event_keys, OUTCOME_SUCCEEDED)
+            return event_keys if defer_ledger else None
+
+    def record_success(self, event_keys: list):
+        """
+        Record in the ledger that events succeeded, once their buffered Salesforce writes have been sent. A failure to
+        write to the ledger is logged rather than raised, as the events themselves succeeded; they are only processed
+        again if they are redelivered.
+        Args:
+            event_keys: the ledger keys of the events
+
+        Returns: None
+
+        """
+        if not event_keys:
+            return
+        try:
+            with sql_metrics.step("ledger"):
+                self.event_ledger.record(self.psql_engine.session, event_keys, OUTCOME_SUCCEEDED)
+                self.psql_engine.session.commit()
+        except Exception as err:
+            self.logger.warning(f"unable to record processed events {event_keys} in the ledger: {err}")
+            self.psql_engine.session.rollback()
+            return
+        self.event_ledger.remember(event_keys, OUTCOME_SUCCEEDED)
+
+    def record_failure(self, event_keys: list, detail: str):
+        """
+        Record in the ledger that events failed, so they are processed again when they are redelivered or replayed.
+        A failure to write to the ledger is logged rather than raised, so it never hides the original error.
+        Args:
+            event_keys: the ledger keys of the events
+            detail: the reason the events failed
+
+        Returns: None
+
+        """
+        try:
+            self.event_ledger.record(self.psql_engine.session, event_keys, OUTCOME_FAILED, detail)
+            self.psql_engine.session.commit()
+        except Exception as err:
+            self.logger.warning(f"unable to record failed events {event_keys} in the ledger: {err}")
+            self.psql_engine.session.rollback()
+            return
+        self.event_ledger.remember(event_keys, OUTCOME_FAILED)
+
+    def parse_records(self, records):
+        """
+        Parse every SQS record in a batch up front, so a malformed record is reported on its own instead of failing
+        the records around it.
+        Args:
+            records: the SQS records from the Lambda event
+
+        Returns: a tuple of (parsed records, message IDs of records that could not be parsed). Each parsed record is a
+            dict with the keys 'message_ids', 'event_keys', 'event', its 'envelope', 'event_type' and 'user_id' (the
+            local Canvas user ID, or None), plus the SQS message's 'body', 'source' queue ARN and 'sent_at' time in
+            epoch milliseconds
+
+        """
+        parsed_records = []
+        failed_message_ids = []
+        for record in records:
+            message_id = record.get("messageId")
+            try:
+                event = json.loads(record.get("body"))
+                if (
+                    not isinstance(event, dict)
+                    or not isinstance(event.get("metadata"), dict)
+                    or not isinstance(event.get("body"), dict)
+                ):
+                    raise InvalidCanvasEventRecord(message_id)
+                event_type = self._get_event_type(event)
+                if not self._event_type_mapping.get(event_type):
+                    raise UnknownCanvasEventType(event_type)
+                # The key has to be taken before the envelope normalizes the event in place
+                event_keys = [EventLedger.event_key(event)]
+                envelope = CanvasEventEnvelope(event)
+            except (ValueError, TypeError, InvalidCanvasEventRecord, UnknownCanvasEventType) as err:
+                self.logger.error(f"unable to parse SQS record {message_id}: {err}. full record: {record}")
+                failed_message_ids.append(message_id)
+                continue
+            parsed_records.append(
+                {
+                    "message_ids": [message_id],
+                    "event_keys": event_keys,
+                    "event": event,
+                    "envelope": envelope,
+                    "event_type": event_type,
+                    "user_id": envelope.user_id_local,
+                    "body": record.get("body"),
+                    "source": record.get("eventSourceARN"),
+                    "sent_at": int((record.get("attributes") or {}).get("SentTimestamp") or 0) or None,
+                }
+            )
+        return parsed_records, failed_message_ids
+
+    @staticmethod
+    def group_records_by_user(parsed_records):
+        """
+        Group parsed records by Canvas user, keeping the order they arrived in within each group. Records without a
+        user are put in a group of their own.
+        Args:
+            parsed_records: the records returned by `parse_records`
+
+        Returns: a dict of group key > list of parsed records
+
+        """
+        groups = {}
+        for index, record in enumerate(parsed_records):
+            key = record["user_id"] if record["user_id"] else f"no_user_{index}"
+            groups.setdefault(key, []).append(record)
+        return groups
+
+    @staticmethod
+    def _event_time(record):
+        # Events without a time sort first
+        return record["envelope"].event_time or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+
+    def coalesce_activity_records(self, user_records):
+        """
+        Fold a user's `logged_in` and `asset_accessed` events into one event per type. The folded event is a copy of
+        the latest event, with `first_event_time` added to its metadata holding the earliest event time, and it carries
+        the message IDs of every event it replaced. It takes the place of the first event it replaced.
+        Args:
+            user_records: a single user's parsed records, in order
+
+        Returns: the user's records with the activity events folded together
+
+        """
+        activity_records = {}
+        for record in user_records:
+            if record["event_type"] in COALESCED_EVENT_TYPES:
+                activity_records.setdefault(record["event_type"], []).append(record)
+
+        coalesced_records = []
+        for record in user_records:
+            folded_records = activity_records.get(record["event_type"])
+            if not folded_records:
+                coalesced_records.append(record)
+                continue
+            if record is not folded_records[0]:
+                continue
+            if len(folded_records) == 1:
+                coalesced_records.append(record)
+                continue
+
+            ordered_records = sorted(folded_records, key=self._event_time)
+            event = copy.deepcopy(ordered_records[-1]["event"])
+            event["metadata"]["first_event_time"] = ordered_records[0]["envelope"].event_time
+            event["metadata"]["coalesced_event_count"] = len(folded_records)
+            self.logger.info(
+                f"coalesced {len(folded_records)} {record['event_type']} events for user {record['user_id']}"
+            )
+            coalesced_records.append(
+                {
+                    "message_ids": [message_id for r in folded_records for message_id in r["message_ids"]],
+                    "event_keys": [key for r in folded_records for key in r["event_keys"]],
+                    "event": event,
+                    "envelope": CanvasEventEnvelope(event),
+                    "event_type": record["event_type"],
+                    "user_id": record["user_id"],
+                }
+            )
+        return coalesced_records
+
+    def process_user_group(self, user_id, user_records, sf_write_buffer=None, applied_records: Optional[list] = None):
+        """
+        Process all of a single user's events from a batch, in order, isolated from every other user in the batch.
+        - If an event fails with a retryable error, it and every later event for the user are reported as failed, so
+            the user's events are retried in their original order.
+        - If an event fails with a non-retryable error, only that event is reported and the rest of the user's events
+            still run.
+        Args:
+            user_id: the local Canvas user ID for the group
+            user_records: the user's parsed records, in order
+            sf_write_buffer: the batch's Salesforce write buffer, if writes are being buffered. The ledger successes of
+                the user's events are then deferred until the buffer is flushed
+            applied_records: a list the deferred successes are added to, as (message IDs, ledger keys) tuples
+
+        Returns: a list of the message IDs that failed
+
+        """
+        failed_message_ids = []
+        for position, record in enumerate(user_records):
+            if sf_write_buffer is not None:
+                sf_write_buffer.track(record["message_ids"])
+            try:
+                applied_keys = self.process_event(
+                    record["event"],
+                    event_keys=record["event_keys"],
+                    defer_ledger=sf_write_buffer is not None,
+                    envelope=record.get("envelope"),
+                )
+                if applied_keys and applied_records is not None:
+                    applied_records.append((record["message_ids"], applied_keys))
+            except NON_RETRYABLE_EXCEPTIONS as err:
+                self.logger.error(f"non-retryable error processing {record['event_type']} for user {user_id}: {err}")
+                failed_message_ids.extend(record["message_ids"])
+            except Exception as err:
+                self.logger.error(f"error processing {record['event_type']} for user {user_id}: {err}")
+                for remaining in user_records[position:]:
+                    failed_message_ids.extend(remaining["message_ids"])
+                break
+        return failed_message_ids
+
+    @staticmethod
+    def register_submission_lookups(parsed_records):
+        """
+        Reset the submission history cache for a new batch and register the submission every grade_change event may
+        have to fetch from Canvas, so a course's submissions can be pulled with one bulk request
+        Args:
+            parsed_records: the batch's parsed records
+
+        Returns: None
+
+        """
+        submission_histories.reset()
+        for record in parsed_records:
+            if record["event_type"] == "grade_change":
+                envelope = record["envelope"]
+                submission_histories.register(
+                    course_id=envelope.context_id,
+                    assignment_id=envelope.local_id("assignment_id"),
+                    user_id=record["user_id"],
+                )
+
+    def process_batch(self, records):
+        """
+        Process a batch of SQS records and report which ones failed, so SQS only redelivers those messages.
+        Records are parsed first and split into lanes: the transactional lane (grading, submissions and everything
+        else) runs before the activity lane (logins and asset views), so grading never waits behind activity volume and
+        an activity failure never holds back a grade. When the activity lane has its own queue, activity records are
+        forwarded to it and aggregated there instead. Within a lane, records are grouped by Canvas user, the user's
+        activity events are coalesced and then each user's events are processed in isolation. Salesforce contact updates
+        are buffered during the batch and sent together at the end; events whose updates fail to write are reported as
+        failed too, and events are only recorded as succeeded in the ledger after their updates are sent. The ledger
+        outcomes of the whole batch are loaded up front, so events that already succeeded are skipped without a query
+        each.
+        Args:
+            records: the SQS records from the Lambda event
+
+        Returns: a dict in the SQS partial batch response format, for example
+            {"batchItemFailures": [{"itemIdentifier": "059f36b4-87a3-44ab-83d2-661975830a7d"}]}
+
+        """
+        parsed_records, failed_message_ids = self.parse_records(records)
+        lanes = self.lane_router.split(parsed_records)
+        lane_times = {}
+        forwarded_lanes = set()
+        for lane, lane_records in lanes.items():
+            if self.lane_router.should_forward(lane, lane_records):
+                started = time.monotonic()
+                failed_message_ids.extend(self.lane_router.forward(lane_records))
+                lane_times[lane] = time.monotonic() - started
+                forwarded_lanes.add(lane)
+        processed_records = [
+            record for lane, lane_records in lanes.items() if lane not in forwarded_lanes for record in lane_records
+        ]
+
+        self.register_submission_lookups(processed_records)
+        try:
+            self.event_ledger.prefetch(
+                self.psql_engine.session,
+                [
+                    key
+                    for record in processed_records
+                    if not self.is_no_op(record["event_type"])
+                    for key in record["event_keys"]
+                ],
+            )
+        except Exception as err:
+            self.logger.warning(f"unable to prefetch the event ledger: {err}")
+            self.psql_engine.session.rollback()
+        sf_services = SFServices(self.sf_client, session=self.psql_engine.session)
+        applied_records = []
+        with SFServices.buffer_writes() as sf_write_buffer:
+            for lane, lane_records in lanes.items():
+                if lane in forwarded_lanes:
+                    continue
+                started = time.monotonic()
+                for user_id, user_records in self.group_records_by_user(lane_records).items():
+                    user_records = self.coalesce_activity_records(user_records)
+                    failed_message_ids.extend(
+                        self.process_user_group(user_id, user_records, sf_write_buffer, applied_records)
+                    )
+                lane_times[lane] = time.monotonic() - started
+            sf_results = sf_services.flush_writes(sf_write_buffer)
+
+        # Events are only recorded as applied once their Salesforce writes are sent, so an event whose writes are lost
+        # to a timeout or a failed flush is processed again when SQS redelivers it
+        sf_failed_set = set(sf_results["failed_message_ids"])
+        self.record_success(
+            [key for message_ids, keys in applied_records if not sf_failed_set & set(message_ids) for key in keys]
         )
-        self.logger.info(f"processing event of type {event_type}")
-        handler.process()
+        for message_id in sf_results["failed_message_ids"]:
+            if message_id not in failed_message_ids:
+                failed_message_ids.append(message_id)
+        if sf_results["failed_message_ids"]:
+            # Their Postgres changes were committed, but the events have to run again to write to Salesforce
+            sf_failed_keys = [
+                key
+                for record in parsed_records
+                if set(record["message_ids"]) & set(sf_results["failed_message_ids"])
+                for key in record["event_keys"]
+            ]
+            self.record_failure(sf_failed_keys, "salesforce contact update failed")
+
+        failed_set = set(failed_message_ids)
+        for lane, lane_records in lanes.items():
+            if not lane_records:
+                continue
+            failed = sum(1 for record in lane_records if failed_set & set(record["message_ids"]))
+            self.lane_metrics.emit(
+                lane,
+                lane_records,
+                failed=failed,
+                forwarded=len(lane_records) - failed if lane in forwarded_lanes else 0,
+                elapsed_seconds=lane_times.get(lane, 0.0),
+            )
+        self.logger.info(f"processed batch of {len(records)} records with {len(failed_message_ids)} failures")
+        self.logger.info(f"salesforce contact cache: {contact_cache.stats()}")
+        self.logger.info(f"known contact timestamps: {activity_timestamps.stats()}")
+        self.logger.info(f"canvas submission history cache: {submission_histories.stats()}")
+        return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_message_ids]}
@@ -1,5 +1,6 @@
 #!/usr/bin/env bash
 cd lambda_functions/canvas_events
 cp ../unzip_requirements.py .
+cp -r ../common .
 npm i
 ./node_modules/serverless/bin/serverless.js deploy
\ No newline at end of file
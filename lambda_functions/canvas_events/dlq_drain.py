@@ -0,0 +1,471 @@
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from propus.logging_utility import Logging
+
+from src.event_ledger import EventLedger
+from src.exceptions import NON_RETRYABLE_EXCEPTIONS
+
+# SQS returns and deletes at most 10 messages per request
+SQS_BATCH_SIZE = 10
+SQS_MAX_VISIBILITY_TIMEOUT = 43200
+
+
+class RateLimiter:
+    """
+    A token bucket shared by every worker, used to cap the rate of calls made to a downstream service
+    """
+
+    def __init__(self, calls_per_second: float):
+        """
+        Initialize the rate limiter
+        Args:
+            calls_per_second: The number of calls allowed per second, no limit if 0 or None
+        """
+        self.calls_per_second = calls_per_second
+        self._tokens = calls_per_second or 0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a call is allowed
+
+        Returns: None
+
+        """
+        if not self.calls_per_second:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.calls_per_second, self._tokens + (now - self._updated_at) * self.calls_per_second
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.calls_per_second
+            time.sleep(wait)
+
+
+class RateLimitedClient:
+    """
+    Wraps a Salesforce or Canvas client so every method call waits for the downstream's rate limiter first
+    """
+
+    def __init__(self, client, limiter: RateLimiter):
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        def limited(*args, **kwargs):
+            self._limiter.acquire()
+            return attribute(*args, **kwargs)
+
+        return limited
+
+
+class VisibilityHeartbeat:
+    """
+    Keeps received messages invisible while a worker is still processing them, by extending their visibility timeout
+    every half timeout until stopped
+    """
+
+    def __init__(self, sqs_client, queue_url: str, visibility_timeout: int):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+        self.receipt_handles = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.visibility_timeout / 2):
+            entries = [
+                {"Id": message_id, "ReceiptHandle": handle, "VisibilityTimeout": self.visibility_timeout}
+                for message_id, handle in list(self.receipt_handles.items())
+            ]
+            if entries:
+                self.sqs_client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+
+
+class DrainStats:
+    """
+    Thread safe counters for a drain, with throughput and ETA reporting
+    """
+
+    def __init__(self):
+        self.counts = {"received": 0, "processed": 0, "skipped": 0, "discarded": 0, "failed": 0, "deleted": 0}
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, count: int = 1):
+        with self._lock:
+            self.counts[name] += count
+
+    def report(self, remaining: int = None):
+        """
+        Summarize the drain so far
+        Args:
+            remaining: The approximate number of messages left in the queue, if known
+
+        Returns: dict: the counters, the throughput in messages per second and the ETA in seconds
+
+        """
+        with self._lock:
+            counts = dict(self.counts)
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        throughput = counts["received"] / elapsed
+        eta = remaining / throughput if remaining is not None and throughput else None
+        return counts | {
+            "elapsed_seconds": round(elapsed, 1),
+            "messages_per_second": round(throughput, 2),
+            "remaining": remaining,
+            "eta_seconds": round(eta) if eta is not None else None,
+        }
+
+
+class DLQDrain:
+    """
+    Replays the Canvas events in a dead letter queue. A pool of workers each receive 10 messages at a time, process them
+    with their own CanvasEventSystem (a SQLAlchemy session can't be shared across threads) and delete the handled
+    messages with one batch request.
+    - Messages that succeed, were already processed (per the event ledger) or fail with a non-retryable error are
+        deleted.
+    - Messages that fail with a retryable error are hidden for `failed_visibility_timeout` so this drain doesn't
+        receive them again, and are left in the queue.
+    - In dry-run mode nothing is processed or deleted: the events are checked against the ledger and every message is
+        made visible again when the drain ends. Meanwhile messages are only hidden for `dry_run_visibility_timeout`,
+        so an interrupted dry run doesn't keep them out of the queue for long. Messages received again are counted
+        once, and a receive returning only messages already checked counts as an empty one.
+    """
+
+    def __init__(
+        self,
+        queue_name: str,
+        environment: str,
+        sqs_client,
+        system_factory,
+        workers: int = 4,
+        dry_run: bool = False,
+        visibility_timeout: int = 120,
+        failed_visibility_timeout: int = 900,
+        dry_run_visibility_timeout: int = 300,
+        salesforce_calls_per_second: float = None,
+        canvas_calls_per_second: float = None,
+        max_empty_receives: int = 3,
+        report_interval: int = 30,
+    ):
+        """
+        Initialize the DLQ drain
+        Args:
+            queue_name: The name of the dead letter queue
+            environment: The environment to build the CanvasEventSystem for
+            sqs_client: A boto3 SQS client
+            system_factory: A function taking the environment and returning a new CanvasEventSystem
+            workers: The number of workers
+            dry_run: Only report what would be done
+            visibility_timeout: How long received messages stay hidden, extended while they are being processed
+            failed_visibility_timeout: How long messages that failed stay hidden after the attempt
+            dry_run_visibility_timeout: How long messages checked by a dry run stay hidden, until they are released
+            salesforce_calls_per_second: The Salesforce call rate shared by every worker, no limit if None
+            canvas_calls_per_second: The Canvas call rate shared by every worker, no limit if None
+            max_empty_receives: A worker stops after this many receives in a row return no messages
+            report_interval: How often progress is logged, in seconds
+        """
+        self.logger = Logging.get_logger("castor/lambda_functions/canvas_events/dlq_drain", debug=True)
+        self.queue_name = queue_name
+        self.environment = environment
+        self.sqs_client = sqs_client
+        self.system_factory = system_factory
+        self.workers = workers
+        self.dry_run = dry_run
+        self.visibility_timeout = visibility_timeout
+        self.failed_visibility_timeout = min(failed_visibility_timeout, SQS_MAX_VISIBILITY_TIMEOUT)
+        self.dry_run_visibility_timeout = min(dry_run_visibility_timeout, SQS_MAX_VISIBILITY_TIMEOUT)
+        self.salesforce_limiter = RateLimiter(salesforce_calls_per_second)
+        self.canvas_limiter = RateLimiter(canvas_calls_per_second)
+        self.max_empty_receives = max_empty_receives
+        self.report_interval = report_interval
+        self.stats = DrainStats()
+        self.queue_url = sqs_client.get_queue_url(QueueName=queue_name)["QueueUrl"]
+        self._seen_messages = {}
+        self._seen_lock = threading.Lock()
+        self._done = threading.Event()
+
+    def build_system(self):
+        """
+        Build a worker's CanvasEventSystem, with its Salesforce and Canvas clients behind the shared rate limiters
+
+        Returns: a CanvasEventSystem object
+
+        """
+        system = self.system_factory(self.environment)
+        system.sf_client = RateLimitedClient(system.sf_client, self.salesforce_limiter)
+        system.canvas_client = RateLimitedClient(system.canvas_client, self.canvas_limiter)
+        return system
+
+    def remaining_messages(self):
+        """
+        Get the approximate number of messages left in the queue
+
+        Returns: int: the number of messages, or None if it couldn't be fetched
+
+        """
+        try:
+            attributes = self.sqs_client.get_queue_attributes(
+                QueueUrl=self.queue_url, AttributeNames=["ApproximateNumberOfMessages"]
+            )
+            return int(attributes["Attributes"]["ApproximateNumberOfMessages"])
+        except Exception as err:
+            self.logger.warning(f"unable to get the queue size: {err}")
+
+    def receive(self):
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=SQS_BATCH_SIZE,
+            VisibilityTimeout=self.visibility_timeout,
+            WaitTimeSeconds=2,
+        )
+        return response.get("Messages", [])
+
+    def delete(self, messages: list):
+        """
+        Delete messages from the queue with one request
+        Args:
+            messages: The SQS messages to delete
+
+        Returns: None
+
+        """
+        if not messages:
+            return
+        response = self.sqs_client.delete_message_batch(
+            QueueUrl=self.queue_url,
+            Entries=[{"Id": message["MessageId"], "ReceiptHandle": message["ReceiptHandle"]} for message in messages],
+        )
+        self.stats.add("deleted", len(response.get("Successful", [])))
+        for failure in response.get("Failed", []):
+            self.logger.error(f"unable to delete message {failure.get('Id')}: {failure.get('Message')}")
+
+    def hide(self, messages: list, visibility_timeout: int):
+        """
+        Change the visibility timeout of messages with one request
+        Args:
+            messages: The SQS messages
+            visibility_timeout: The new visibility timeout, 0 makes them visible right away
+
+        Returns: None
+
+        """
+        if messages:
+            self.sqs_client.change_message_visibility_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {
+                        "Id": message["MessageId"],
+                        "ReceiptHandle": message["ReceiptHandle"],
+                        "VisibilityTimeout": visibility_timeout,
+                    }
+                    for message in messages
+                ],
+            )
+
+    def is_applied(self, system, event_key):
+        """
+        Check the ledger for an event that already succeeded
+        Args:
+            system: The worker's CanvasEventSystem
+            event_key: The event's ledger key
+
+        Returns: True if the event already succeeded, False if it didn't or the ledger couldn't be read
+
+        """
+        try:
+            return system.event_ledger.is_applied(system.psql_engine.session, [event_key])
+        except Exception as err:
+            self.logger.warning(f"unable to read the event ledger for {event_key}: {err}")
+            system.psql_engine.session.rollback()
+            return False
+
+    def check_message(self, system, message):
+        """
+        Dry run a message: report what would be done with its event, without processing it
+        Args:
+            system: The worker's CanvasEventSystem
+            message: The SQS message
+
+        Returns: str: 'skipped' if the ledger shows the event already succeeded, 'discarded' if the message isn't a
+            valid event, otherwise 'processed'
+
+        """
+        try:
+            event = json.loads(message["Body"])
+        except json.JSONDecodeError:
+            return "discarded"
+        return "skipped" if self.is_applied(system, EventLedger.event_key(event)) else "processed"
+
+    def process_message(self, system, message):
+        """
+        Process a message's event
+        Args:
+            system: The worker's CanvasEventSystem
+            message: The SQS message
+
+        Returns: str: 'processed', 'skipped', 'discarded' (non-retryable error) or 'failed'
+
+        """
+        try:
+            event = json.loads(message["Body"])
+            event_key = EventLedger.event_key(event)
+            if self.is_applied(system, event_key):
+                return "skipped"
+            system.process_event(event, event_keys=[event_key])
+            return "processed"
+        except (json.JSONDecodeError, *NON_RETRYABLE_EXCEPTIONS):
+            traceback.print_exc()
+            return "discarded"
+        except Exception as err:
+            self.logger.error(f"error replaying message {message['MessageId']}: {err}")
+            return "failed"
+
+    def worker(self, index: int):
+        """
+        Receive and process messages until the queue is empty
+        Args:
+            index: The worker number, for logging
+
+        Returns: None
+
+        """
+        system = self.build_system()
+        empty_receives = 0
+        while empty_receives < self.max_empty_receives:
+            messages = self.receive()
+            if not messages:
+                empty_receives += 1
+                continue
+
+            if self.dry_run:
+                with self._seen_lock:
+                    new = [message for message in messages if message["MessageId"] not in self._seen_messages]
+                    # Keep the latest receipt handle, the earlier ones can't release the message any more
+                    self._seen_messages.update((message["MessageId"], message) for message in messages)
+                self.hide(messages, self.dry_run_visibility_timeout)
+                if not new:
+                    empty_receives += 1
+                    continue
+                empty_receives = 0
+                self.stats.add("received", len(new))
+                for message in new:
+                    self.stats.add(self.check_message(system, message))
+                continue
+
+            empty_receives = 0
+            self.stats.add("received", len(messages))
+
+            handled, failed = [], []
+            with VisibilityHeartbeat(self.sqs_client, self.queue_url, self.visibility_timeout) as heartbeat:
+                heartbeat.receipt_handles = {message["MessageId"]: message["ReceiptHandle"] for message in messages}
+                for message in messages:
+                    outcome = self.process_message(system, message)
+                    self.stats.add(outcome)
+                    (failed if outcome == "failed" else handled).append(message)
+                    heartbeat.receipt_handles.pop(message["MessageId"], None)
+            self.delete(handled)
+            self.hide(failed, self.failed_visibility_timeout)
+        self.logger.info(f"worker {index} finished, no more messages")
+
+    def _report_progress(self):
+        while not self._done.wait(self.report_interval):
+            self.logger.info(f"dlq drain progress: {self.stats.report(self.remaining_messages())}")
+
+    def run(self):
+        """
+        Drain the queue with the worker pool
+
+        Returns: dict: the final report
+
+        """
+        self.logger.info(
+            f"draining {self.queue_name} with {self.workers} workers{' (dry run)' if self.dry_run else ''}, "
+            f"{self.remaining_messages()} messages in the queue"
+        )
+        reporter = threading.Thread(target=self._report_progress, daemon=True)
+        reporter.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for future in [executor.submit(self.worker, index) for index in range(self.workers)]:
+                    future.result()
+        finally:
+            self._done.set()
+            if self.dry_run:
+                # Make every message visible again, the dry run didn't change anything
+                seen = list(self._seen_messages.values())
+                for start in range(0, len(seen), SQS_BATCH_SIZE):
+                    self.hide(seen[start : start + SQS_BATCH_SIZE], 0)
+        report = self.stats.report(self.remaining_messages())
+        self.logger.info(f"dlq drain finished: {report}")
+        return report
+
+
+def main(argv: list):
+    """
+    Run the DLQ drain from the command line, for example:
+        python handler.py dlq canvas_events_prod_dlq.fifo --workers 8 --salesforce-rate 20 --dry-run
+    Args:
+        argv: The command line arguments after 'dlq'
+
+    Returns: dict: the final report
+
+    """
+    import boto3
+
+    from canvas_event_system import CanvasEventSystem
+
+    parser = argparse.ArgumentParser(prog="handler.py dlq", description="Replay the Canvas events in a DLQ")
+    parser.add_argument("queue_name")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--visibility-timeout", type=int, default=120)
+    parser.add_argument("--failed-visibility-timeout", type=int, default=900)
+    parser.add_argument("--dry-run-visibility-timeout", type=int, default=300)
+    parser.add_argument("--salesforce-rate", type=float, default=None, help="Salesforce calls per second")
+    parser.add_argument("--canvas-rate", type=float, default=None, help="Canvas calls per second")
+    parser.add_argument("--report-interval", type=int, default=30)
+    args = parser.parse_args(argv)
+
+    return DLQDrain(
+        queue_name=args.queue_name,
+        environment=os.environ.get("ENV"),
+        sqs_client=boto3.client("sqs", region_name="us-west-2"),
+        system_factory=CanvasEventSystem.build,
+        workers=args.workers,
+        dry_run=args.dry_run,
+        visibility_timeout=args.visibility_timeout,
+        failed_visibility_timeout=args.failed_visibility_timeout,
+        dry_run_visibility_timeout=args.dry_run_visibility_timeout,
+        salesforce_calls_per_second=args.salesforce_rate,
+        canvas_calls_per_second=args.canvas_rate,
+        report_interval=args.report_interval,
+    ).run()
@@ -1,6 +1,5 @@
 import datetime
-import re
-from zoneinfo import ZoneInfo
+from functools import cached_property
 
 # import pytz
 
@@ -16,6 +15,7 @@ from propus.salesforce import Salesforce
 from propus.canvas import Canvas
 
 from src.canvas_services import CanvasServices
+from src.event_envelope import CanvasEventEnvelope, to_local_id
 from src.exceptions import (
     AssigmentNotFoundInDatabase,
     MissingGraderId,
@@ -25,7 +25,9 @@ from src.exceptions import (
     NoSubmissionTimestamp,
 )
 from src.psql_services import PSQLServices
+from src.sf_fanout import SalesforceFanOut, get_salesforce_pool
 from src.sf_services import SFServices
+from src.sql_metrics import sql_metrics
 
 
 class BaseEvent:
@@ -42,7 +44,7 @@ class BaseEvent:
         """
         Initialize the BaseEvent class with the event, and the PSQL / Salesforce / Canvas clients
         Args:
-            event: The event from the Canvas event stream
+            event: The event from the Canvas event stream, or its CanvasEventEnvelope
             psql_engine: The Propus Calbright PSQL engine
             sf_client: The Propus Salesforce client
             canvas_client: The Propus Canvas client
@@ -50,164 +52,62 @@ class BaseEvent:
         self.logger = Logging.get_logger(
             "castor/lambda_functions/canvas_events/canvas_event_system/base_event", debug=True
         )
-        self.metadata = self._get_metadata(event)
-        self.body = self._get_body(event)
-        self.user_info = self._get_user_info(event, PSQLServices(psql_engine))
-        self.event_info = self._get_event_info()
-        self.psql_services = PSQLServices(psql_engine)
-        self.sf_services = SFServices(sf_client)
-        self.canvas_services = CanvasServices(canvas_client, psql_engine)
-
-    def _convert_pst_to_utc(self, date_obj: datetime):
+        # IDs and timestamps are normalized once here, handlers read them from the envelope or the normalized dicts
+        self.envelope = CanvasEventEnvelope.parse(event)
+        self.metadata = self.envelope.metadata
+        self.body = self.envelope.body
+        self.event_info = self.envelope.event_info()
+        # The services and the user info are built on first access, so handlers that don't use them cost nothing
+        self.psql_engine = psql_engine
+        self.sf_client = sf_client
+        self.canvas_client = canvas_client
+
+    @cached_property
+    def psql_services(self):
+        # The same PSQLServices object is used for the whole event, so the student context it loads is shared
+        return PSQLServices(self.psql_engine)
+
+    @cached_property
+    def sf_services(self):
+        return SFServices(self.sf_client, session=self.psql_engine.session)
+
+    @cached_property
+    def salesforce(self):
+        # The event's Salesforce calls run on the container's pool when SALESFORCE_FANOUT_WORKERS is set, and are
+        # awaited by the CanvasEventSystem at the end of the event
+        return SalesforceFanOut(get_salesforce_pool())
+
+    @cached_property
+    def canvas_services(self):
+        return CanvasServices(self.canvas_client, self.psql_engine)
+
+    @cached_property
+    def user_info(self):
+        return self._get_user_info(self.envelope, self.psql_services)
+
+    def _get_user_info(self, envelope: CanvasEventEnvelope, psql_services: PSQLServices):
         """
-        Convert a date object from PST to UTC
-        Args:
-            date_obj: The date object to convert. If the date object has no timezone info, it will assume it is in PST.
-
-        Returns: datetime: The date object converted to UTC
-
-        """
-        # self.logger.debug(f"Converting datetime {date_obj} from PST to UTC | Current TZ: {date_obj.tzinfo}")
-
-        pst = ZoneInfo("America/Los_Angeles")
-
-        if date_obj.tzinfo is not None:
-            return date_obj.astimezone(ZoneInfo("UTC"))
-        return date_obj.replace(tzinfo=pst).astimezone(ZoneInfo("UTC"))
+        Get the user info from the event - different event types present the user info in different ways, the envelope
+        finds the user in a consistent way, and the sis_id/cc_id and email come from the database.
 
-    def _parse_isoformat(self, date_string):
-        if date_string.endswith("Z"):
-            date_string = date_string[:-1] + "+00:00"
-        return datetime.datetime.fromisoformat(date_string)
-
-    def _get_body(self, event):
-        # self.logger.debug("Getting event body...")
-        """
-        Get the body of the event, for convenience and to change global > local IDs + convert timestamps to UTC
         Args:
-            event: The event from the Canvas event stream
-
-        Returns: dict: the body of the event, with local IDs and UTC timestamps
-
-        """
-        body = event.get("body")
-        if body.get("student_id"):
-            body["student_id_local"] = self._convert_global_to_local_id(body.get("student_id"))
-        if body.get("submitted_at"):
-            event_time = self._parse_isoformat(body.get("submitted_at"))
-            body["submitted_at"] = self._convert_pst_to_utc(event_time)
-        if body.get("created_at"):
-            event_time = self._parse_isoformat(body.get("created_at"))
-            body["created_at"] = self._convert_pst_to_utc(event_time)
-        return body
-
-    def _get_metadata(self, event):
-        """
-        Get the metadata of the event, for convenience, and parse the context_id and user_id to local IDs
-        Args:
-            event: The event from the Canvas event stream
-
-        Returns: dict: the metadata of the event, with local IDs and UTC timestamps
-
-        """
-        # self.logger.debug("Getting event metadata...")
-        metadata = event.get("metadata")
-        if metadata.get("context_id"):
-            metadata["context_id_local"] = self._convert_global_to_local_id(metadata.get("context_id"))
-        if metadata.get("user_id"):
-            metadata["user_id_local"] = self._convert_global_to_local_id(metadata.get("user_id"))
-        if metadata.get("event_time"):
-            event_time = self._parse_isoformat(metadata.get("event_time"))
-            metadata["event_time"] = self._convert_pst_to_utc(event_time)
-        return event.get("metadata")
-
-    def _get_user_info(self, event, psql_services: PSQLServices):
-        """
-        Get the user info from the event - different event types present the user info in different ways, so this
-        will get the user info from the event in a consistent way.
-
-        Args:
-            event: The event from the Canvas event stream
+            envelope: The parsed event
             psql_services: The Calbright PSQL services object
 
         Returns: dict: user_info including the user_id, user_id_local, user_sis_id, and user_login
 
         """
-        # self.logger.debug("Getting user info from event...")
-        meta = event.get("metadata")
-        body = event.get("body")
-
-        user_info = {"user_id": None}
-        # Try to get the user_id from body, if it's not there get the student_id, if it's not there get meta user_id
-        if body.get("user_id"):
-            user_info["user_id"] = body.get("user_id")
-        elif body.get("student_id"):
-            user_info["user_id"] = body.get("student_id")
-        elif meta.get("user_id"):
-            user_info["user_id"] = meta.get("user_id")
-
-        if user_info["user_id"]:
-            user_info["user_id_local"] = self._convert_global_to_local_id(user_info["user_id"])
-
-        if body.get("user", {}).get("id"):
-            user_info["user_id"] = body.get("user").get("id")
-            user_info["user_id_local"] = body.get("user").get("id")
-
-        if not user_info.get("user_id_local"):
+        if not envelope.user_id_local:
             raise NoUserInfoInEvent()
-        # Try to get the sis_id/cc_id and email from the event, if not there, get it from the database
-        if body.get("student_sis_id") and meta.get("user_login"):
-            # TODO: I'm getting the user here from the DB bc for the final grade events the user comes in as
-            #   the instructor instead of the student... Can figure out a different way to do this prob...
-            user_info_from_db = psql_services.get_user_info_by_canvas_id(canvas_id=user_info["user_id_local"])
-        else:
-            user_info_from_db = psql_services.get_user_info_by_canvas_id(canvas_id=user_info["user_id_local"])
+        user_info = {"user_id": envelope.user_id, "user_id_local": envelope.user_id_local}
+        # TODO: The user is fetched from the DB even when the event has a student_sis_id and user_login, bc for the
+        #   final grade events the user comes in as the instructor instead of the student...
+        user_info_from_db = psql_services.get_user_info_by_canvas_id(canvas_id=user_info["user_id_local"])
         user_info["user_sis_id"] = user_info_from_db.get("ccc_id")
         user_info["user_login"] = user_info_from_db.get("email")
         return user_info
 
-    def _get_event_info(self):
-        """
-        Get the event info from the event, for convenience
-        Args:
-            event: The event from the Canvas event stream
-
-        Returns: dict: the event info including event name, time, context_type, and context_id
-
-        """
-        # self.logger.debug("Getting event info from event...")
-        event_info = {
-            "event_name": self.metadata.get("event_name"),
-            "event_time": self.metadata.get("event_time"),
-            "context_type": self.metadata.get("context_type"),
-            "context_id": self.metadata.get("context_id"),
-            "context_account_id": self.metadata.get("context_account_id"),
-        }
-        if self.metadata.get("context_id"):
-            event_info["context_id_local"] = self._convert_global_to_local_id(self.metadata.get("context_id"))
-        return event_info
-
-    def _convert_global_to_local_id(self, id_string):
-        """
-        A helper function to convert a global ID to a local ID (which is the main ID used across Canvas and in the UI)
-        Note: Instructure has noted that they are going to be moving away from global IDs in the future, so this
-        function may not be needed in the future.
-        Reference here: https://canvas.instructure.com/doc/api/file.data_service_canvas_event_metadata.html
-        Args:
-            id_string: The global ID string. For example '21070000000000123'
-
-        Returns: str: the local ID string. For example '123'
-
-        """
-
-        if len(id_string) < 16:
-            return id_string
-        match = re.compile(r"0+(\d+)$").search(id_string)
-        if match:
-            # self.logger.debug(f"Converted global ID {id_string} to local ID {match.group(1)}")
-            return match.group(1)
-        # self.logger.warning(f"Could not convert global ID {id_string} to local ID")
-
+    @sql_metrics.step("saa_timestamp")
     def check_and_update_saa_timestamp(self):
         """
         This function is used to update the SAA information in the database and Salesforce.
@@ -238,7 +138,12 @@ class BaseEvent:
             student_enrollment.first_saa = event_timestamp.isoformat()
             if student_enrollment.student.user.learner_status.status == "Enrolled in Program Pathway":
                 student_enrollment = self.psql_services.update_enrollment_status_at_first_saa(student_enrollment)
-                self.sf_services.update_learner_status(email=email, status="Started Program Pathway")
+                self.salesforce.submit(
+                    self.sf_services.update_learner_status,
+                    email=email,
+                    status="Started Program Pathway",
+                    event_timestamp=event_timestamp,
+                )
 
             self.psql_services.update_object(student_enrollment)
 
@@ -252,13 +157,13 @@ class BaseEvent:
 
         # * SALESFORCE UPDATES *
         # update salesforce with the latest SAA timestamp
-        sf_saa_timestamp = self.sf_services.get_contact_field(email=email, sf_field="Last_Strut_SAA_Timestamp__c")
-        if sf_saa_timestamp is None or event_timestamp > sf_saa_timestamp:
-            self.logger.info(
-                f"Setting SAA in Salesforce for user {self.user_info['user_id_local']} | {event_timestamp}"
-            )
-            self.sf_services.update_contact_saa_timestamp(email=email, timestamp=event_timestamp)
+        # only written if it's newer than the value Salesforce holds, which is usually known without querying it
+        if self.sf_services.advance_contact_timestamp(
+            email=email, sf_field="Last_Strut_SAA_Timestamp__c", timestamp=event_timestamp, fanout=self.salesforce
+        ):
+            self.logger.info(f"Set SAA in Salesforce for user {self.user_info['user_id_local']} | {event_timestamp}")
 
+    @sql_metrics.step("grade_change")
     def process_grade_change_event(self):
         """
         This function is used to process a grade change event from Canvas. It will:
@@ -271,7 +176,7 @@ class BaseEvent:
 
         """
         # Get the assignment ID from the event > convert to local ID > fetch from the database
-        assignment_id = self._convert_global_to_local_id(self.body["assignment_id"])
+        assignment_id = self.envelope.local_id("assignment_id")
         assignment_from_db = self.psql_services.get_assignment_by_canvas_id(canvas_id=assignment_id)
         ccc_id = self.user_info.get("user_sis_id")
 
@@ -294,17 +199,18 @@ class BaseEvent:
                 grader_id = self.body.get("grader_id")
                 if not grader_id:
                     raise MissingGraderId()
-                grader_id_local = self._convert_global_to_local_id(grader_id)
+                grader_id_local = to_local_id(grader_id)
 
                 # Update the grade in the database (enrollment_course_term table)
                 try:
-                    enrollment_course_term = self.psql_services.update_ect_final_grade(
-                        ccc_id=ccc_id,
-                        course_id=course_id,
-                        grade=grade,
-                        grade_timestamp=self.event_info.get("event_time"),
-                        instructor_lms_id=grader_id_local,
-                    )
+                    with self.psql_services.savepoint():
+                        enrollment_course_term = self.psql_services.update_ect_final_grade(
+                            ccc_id=ccc_id,
+                            course_id=course_id,
+                            grade=grade,
+                            grade_timestamp=self.event_info.get("event_time"),
+                            instructor_lms_id=grader_id_local,
+                        )
                 except Exception as e:
                     self.logger.error(f"Error updating final grade for user {self.user_info['user_id_local']} {e}")
                     enrollment_course_term = None
@@ -322,13 +228,15 @@ class BaseEvent:
                     )
 
                 # Update the checkbox of 'Completed Course #...' in Salesforce
-                self.sf_services.update_course_completed(email=email, course_code=course_code)
+                self.sf_services.update_course_completed(
+                    email=email, course_code=course_code, event_timestamp=self.event_info.get("event_time")
+                )
             # TODO: what happens if the instructor has an oopsie doodles and grades the wrong student and then is
             #   like "oh no, I didn't mean to do that" and changes the grade back to null or something?
             return None
 
         # Fetch the student's submission from the database. This is done on the submission_id, not the assignment_id.
-        submission_id_local = self._convert_global_to_local_id(self.body["submission_id"])
+        submission_id_local = self.envelope.local_id("submission_id")
         submission_from_db = self.psql_services.get_submission_by_submission_id(submission_id=submission_id_local)
 
         if not submission_from_db:
@@ -371,8 +279,7 @@ class BaseEvent:
                 f"{self.user_info.get('user_id_local')}"
             )
             self.psql_services.psql_engine.session.add(new_submission)
-            # self.psql_services.psql_engine.session.flush()  # TODO: verify swapping this commit/flush works...
-            self.psql_services.psql_engine.session.commit()
+            self.psql_services.commit()
             # This sets our submission_from_db used in the next steps to the new submission record we just created
             submission_from_db = new_submission
         else:
@@ -398,7 +305,7 @@ class BaseEvent:
                 f"Updating submission record {submission_id_local} with grade in database for user "
                 f"{self.user_info['user_id_local']}"
             )
-            self.psql_services.psql_engine.session.commit()
+            self.psql_services.commit()
 
             if assignment_from_db.assessment_type == AssessmentType("Summative"):
                 # At this point - recalculate their progress from the DB and then go and update both their enrollment
@@ -414,8 +321,9 @@ class BaseEvent:
                 f"{self.user_info['user_id_local']}"
             )
             submission_from_db.status = AssessmentSubmissionStatus("Submitted")
-            self.psql_services.psql_engine.session.commit()
+            self.psql_services.commit()
 
+    @sql_metrics.step("submission")
     def process_submission_event(self, lms_type: Literal["assignment", "discussion", "quiz"] = "assignment"):
         """
         This function is used to process a submission event from Canvas. It will:
@@ -436,23 +344,23 @@ class BaseEvent:
 
             # Note: So when it's a graded discussion, I'm getting the assignment ID, and then resetting the context
             #    of the lms_type to be an assignment so we fetch the assignment ID from the DB....
-            assignment_id = self._convert_global_to_local_id(self.body.get("discussion_topic_id"))
+            assignment_id = self.envelope.local_id("discussion_topic_id")
             if self.body.get("assignment_id"):
-                assignment_id = self._convert_global_to_local_id(self.body.get("assignment_id"))
+                assignment_id = self.envelope.local_id("assignment_id")
                 lms_type = "assignment"
 
-            submission_id_local = self._convert_global_to_local_id(self.body.get("discussion_entry_id"))
+            submission_id_local = self.envelope.local_id("discussion_entry_id")
             submission_timestamp = self.body.get("created_at")
         elif lms_type == "quiz":
             # TODO: for quizzes, the score doesn't come in with the quiz_submitted event. So we may need to
             #   fetch from the API. Or maybe it's a separate 'grade_change' event for the actual assignment
             #   We're not using quizzes right now in Canvas so revisit this later...
-            assignment_id = self._convert_global_to_local_id(self.body.get("quiz_id"))
-            submission_id_local = self._convert_global_to_local_id(self.body.get("submission_id"))
+            assignment_id = self.envelope.local_id("quiz_id")
+            submission_id_local = self.envelope.local_id("submission_id")
             submission_timestamp = self.event_info.get("event_time")
         else:
-            assignment_id = self._convert_global_to_local_id(self.body.get("assignment_id"))
-            submission_id_local = self._convert_global_to_local_id(self.body.get("submission_id"))
+            assignment_id = self.envelope.local_id("assignment_id")
+            submission_id_local = self.envelope.local_id("submission_id")
             submission_timestamp = self.body.get("submitted_at")
 
         if not submission_timestamp:
@@ -497,8 +405,7 @@ class BaseEvent:
                 status=submission_status,
             )
             self.psql_services.psql_engine.session.add(new_submission)
-            self.psql_services.psql_engine.session.commit()
-            # self.psql_services.psql_engine.session.flush()  # TODO: verify swapping this commit/flush works...
+            self.psql_services.commit()
         else:
             self.logger.debug("submission found in database...")
             # TODO: - if the student has already PASSED the summative, and then resubmits, this would set the status
@@ -531,21 +438,21 @@ class BaseEvent:
                 #     if not submission_from_db.status == AssessmentSubmissionStatus("Passed")
                 #     else submission_from_db.status
                 # )
-                # self.psql_services.psql_engine.session.flush()  # TODO: verify swapping this commit/flush works...
-                self.psql_services.psql_engine.session.commit()
+                self.psql_services.commit()
 
         # self.psql_services.psql_engine.session.commit()
 
         # Check if this is the last summative assignment of the course, if so, enroll in next course, if exists
         if assignment_from_db.is_last_summative_of_course:
             self.logger.info(f"Attempting to enroll in next course for user {self.user_info['user_id_local']}...")
-            current_course_id = self._convert_global_to_local_id(self.metadata["context_id"])
+            current_course_id = self.envelope.context_id_local
             ccc_id = self.user_info["user_sis_id"]
             canvas_user_id = self.user_info["user_id_local"]
             self.canvas_services.create_next_course_enrollment(
                 current_course_id=current_course_id, ccc_id=ccc_id, canvas_user_id=canvas_user_id
             )
 
+    @sql_metrics.step("progress")
     def update_progress(self):
         """
         This function is used to update the course progress in both the Database and Salesforce for a student.
@@ -554,22 +461,29 @@ class BaseEvent:
         Returns: None
 
         """
-        program_progress = self.psql_services.update_program_progress(lms_id=self.user_info["user_id_local"])
-        course_progress = self.psql_services.calculate_progress(
-            lms_id=self.user_info["user_id_local"],
-            progress_type="course",
-            course_lms_id=self.event_info["context_id_local"],
+        # Program progress, course progress and the course code all come back from one query
+        progress = self.psql_services.get_progress(
+            lms_id=self.user_info["user_id_local"], course_lms_id=self.event_info["context_id_local"]
         )
+        program_progress = progress.get("program")
+        if program_progress:
+            self.psql_services.update_program_progress(
+                lms_id=self.user_info["user_id_local"], program_progress=program_progress
+            )
+        course_progress = progress.get("course")
 
         self.logger.debug(f"Course progress for user: {course_progress}")
         self.logger.debug(f"Program progress for user: {program_progress}")
         if course_progress and course_progress.get("percentage"):
             self.logger.info(f"Updating course progress in Salesforce for user {self.user_info['user_id_local']}...")
             email = self.user_info.get("user_login")
-            course_id = self.event_info.get("context_id_local")
-            course_code = self.psql_services.get_course_code_by_lms_id(course_id)
-            self.sf_services.update_course_progress(
-                email=email, course_code=course_code, progress=course_progress.get("percentage")
+            course_code = progress.get("course_code")
+            self.salesforce.submit(
+                self.sf_services.update_course_progress,
+                email=email,
+                course_code=course_code,
+                progress=course_progress.get("percentage"),
+                event_timestamp=self.event_info.get("event_time"),
             )
 
             course_id = self.event_info.get("context_id_local")
@@ -578,13 +492,14 @@ class BaseEvent:
                 ccc_id=ccc_id, course_id=course_id, progress=course_progress.get("percentage")
             )
 
+    @sql_metrics.step("login")
     def process_login_event(self):
         """
         This function is used to process a login event from Canvas. It will:
         - Set the first login timestamp in the database (enrollment table) if it is not already set
         - Update the last login timestamp in the database (enrollment table) if the event time is greater than
             the current last login
-        -
+        - For coalesced login events, the first login uses the earliest event time and the last login the latest
         Returns: dict: A dictionary with the keys 'first_lms_login_updated' and 'last_lms_login_updated' with boolean
 
         """
@@ -593,7 +508,7 @@ class BaseEvent:
         student_enrollment = self.psql_services.get_student_enrollment(lms_id=self.user_info["user_id_local"])
         if student_enrollment.first_lms_login is None:
             self.logger.info(f"Setting first LMS login in database for user {self.user_info['user_id_local']}")
-            student_enrollment.first_lms_login = self.event_info["event_time"]
+            student_enrollment.first_lms_login = self.event_info["first_event_time"]
             first_lms_login_updated = True
         try:
             last_lms_login = student_enrollment.last_lms_login.replace(tzinfo=datetime.timezone.utc)
@@ -603,10 +518,11 @@ class BaseEvent:
             self.logger.info(f"Setting last LMS login in database for user {self.user_info['user_id_local']}")
             student_enrollment.last_lms_login = self.event_info["event_time"]
             last_lms_login_updated = True
-        self.psql_services.psql_engine.session.commit()
+        self.psql_services.commit()
 
         return {"first_lms_login_updated": first_lms_login_updated, "last_lms_login_updated": last_lms_login_updated}
 
+    @sql_metrics.step("activity")
     def process_non_saa_activity_event(self, activity_type: Literal["login", "asset", "conversation"]):
         # TODO: Need to implement more of this function still.
         #  This will be used to process non-SAA activities like logins, asset access, and conversations.
@@ -5,15 +5,8 @@ except ImportError:
 
 import json
 import os
-import traceback
 
 from canvas_event_system import CanvasEventSystem
-from src.exceptions import (
-    AssigmentNotFoundInDatabase,
-    UserNotFoundInDatabase,
-    NoUserInfoInEvent,
-    UnknownCanvasEventType,
-)
 from test_events import test_events
 
 
@@ -23,14 +16,25 @@ def run(event, _):
     Args:
         event: An SQS event from the Canvas events queue. Will be in the format of one of the Canvas events found
             here: https://canvas.instructure.com/doc/api/file.data_service_introduction.html
-    Returns:
+    Returns: a partial batch response listing the SQS message IDs that failed and should be retried
 
     """
     print(event)
-    for record in event.get("Records"):
-        event_body = json.loads(record.get("body"))
-        ces = CanvasEventSystem.build(os.environ.get("ENV"))
-        ces.process_event(event_body)
+    ces = CanvasEventSystem.get_or_build(os.environ.get("ENV"))
+    return ces.process_batch(event.get("Records"))
+
+
+def reconcile_timestamps(event, _):
+    """
+    The scheduled entry point that repairs drift between the known Salesforce contact timestamps and Salesforce.
+    Args:
+        event: The schedule event, unused
+
+    Returns: dict: the reconciliation counts
+
+    """
+    ces = CanvasEventSystem.get_or_build(os.environ.get("ENV"))
+    return ces.reconcile_contact_timestamps()
 
 
 if __name__ == "__main__":
@@ -38,24 +42,13 @@ if __name__ == "__main__":
 
     if sys.argv[1] == "dlq":
         print("Running DLQ")
-        from propus.aws.sqs import AWS_SQS
-
-        sqs = AWS_SQS.build()
-        msg_req = sqs.receive_messages(sys.argv[2], visibility=60)
-        while len(msg_req.get("Messages", [])):
-            for msg in msg_req.get("Messages"):
-                try:
-                    event_body = json.loads(msg.get("Body"))
-                    print(event_body)
-                    ces = CanvasEventSystem.build(os.environ.get("ENV"))
-                    ces.process_event(event_body)
-                    sqs.delete_message(sys.argv[2], msg.get("ReceiptHandle"))
-                except (AssigmentNotFoundInDatabase, UserNotFoundInDatabase, NoUserInfoInEvent, UnknownCanvasEventType):
-                    traceback.print_exc()
-                    sqs.delete_message(sys.argv[2], msg.get("ReceiptHandle"))
-                    continue
-
-            msg_req = sqs.receive_messages(sys.argv[2])
+        from dlq_drain import main
+
+        print(main(sys.argv[2:]))
+
+    elif sys.argv[1] == "reconcile":
+        print("Reconciling contact timestamps")
+        print(reconcile_timestamps({}, None))
 
     else:
 
@@ -63,6 +56,7 @@ if __name__ == "__main__":
             sqs_event = {
                 "Records": [
                     {
+                        "messageId": "local-test-message",
                         "body": json.dumps(event_body_dict),
                     }
                 ]
@@ -77,7 +71,7 @@ if __name__ == "__main__":
         Note: not all events are implemented yet.
         """
 
-        run(create_test_sqs_event(test_events["grade_change"]), None)
+        print(run(create_test_sqs_event(test_events["grade_change"]), None))
         # run(create_test_sqs_event(test_events["submission_created"]), None)
 
         # run(create_test_sqs_event(test_events["asset_accessed"]), None)
@@ -0,0 +1,262 @@
+import datetime
+import threading
+import time
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, delete, select
+from sqlalchemy.dialects.postgresql import insert
+
+from propus.logging_utility import Logging
+
+RECONCILE_BATCH_SIZE = 200
+# How long a value read from the table is answered from memory
+ACTIVITY_TIMESTAMP_TTL_SECONDS = 30
+
+# The contact timestamp fields that only ever move forward, so a known value is enough to skip an older event
+MONOTONIC_CONTACT_FIELDS = ("Last_Strut_SAA_Timestamp__c", "Last_Strut_Activity_Timestamp__c")
+
+# Created by db_scripts/postgres/canvas_events/tables/canvas_contact_timestamps_create.txt, the Lambda doesn't create it
+timestamps_table = Table(
+    "canvas_contact_timestamps",
+    MetaData(),
+    Column("email", String, primary_key=True),
+    Column("sf_field", String, primary_key=True),
+    Column("contact_id", String, nullable=False),
+    Column("value", DateTime(timezone=True), nullable=False),
+    Column("updated_at", DateTime(timezone=True), nullable=False),
+)
+
+
+def _as_utc(value: datetime.datetime):
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def _parse_sf_datetime(sf_datetime: str):
+    """
+    Parse a datetime as Salesforce returns it, for example '2021-09-01T00:00:00.000+0000'
+    Args:
+        sf_datetime: The Salesforce datetime string
+
+    Returns: datetime: the timezone aware datetime, or None
+
+    """
+    if not sf_datetime:
+        return None
+    return datetime.datetime.fromisoformat(sf_datetime[:-2] + ":" + sf_datetime[-2:])
+
+
+class ActivityTimestampStore:
+    """
+    The last known Salesforce value of the monotonic contact timestamps (last SAA and last activity), kept per contact
+    in the canvas_contact_timestamps table. Salesforce holds at least the known value, so an event that isn't newer is
+    skipped without querying Salesforce, and a newer value is written using the stored contact ID without reading the
+    contact first.
+
+    A value only moves forward: it is written in the event's transaction, and the upsert leaves newer rows alone.
+    Writes that Salesforce rejects drop the contact's rows, and `reconcile` repairs any other drift against Salesforce.
+
+    Values read from the table are answered from memory for a few seconds, so a burst of events for the same student
+    costs one lookup. Only committed values are kept in memory: every write drops the value from memory instead of
+    storing it, because the event's transaction may still be rolled back, and unknown values aren't kept. A value
+    another container moved forward is at most `ttl_seconds` old, and an older value only means the newer event
+    is written to Salesforce instead of skipped.
+
+    The store lives at module level in sf_services, so it is shared by every event in a Lambda container, and it is
+    safe to use from the Salesforce fan-out threads.
+    """
+
+    def __init__(self, ttl_seconds: int = ACTIVITY_TIMESTAMP_TTL_SECONDS):
+        """
+        Initialize the store
+        Args:
+            ttl_seconds: How long a value read from the table is answered from memory
+        """
+        self.logger = Logging.get_logger(
+            "castor/lambda_functions/canvas_events/canvas_event_system/activity_timestamps", debug=True
+        )
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self._memory = {}
+        # Salesforce calls fanned out to a thread pool share the store
+        self._lock = threading.Lock()
+
+    def _forget(self, keys):
+        with self._lock:
+            for key in keys:
+                self._memory.pop(key, None)
+
+    def get(self, session, email: str, sf_field: str):
+        """
+        Get the last known Salesforce value of a contact timestamp, from memory or with a primary key lookup
+        Args:
+            session: The SQLAlchemy session to query with
+            email: The Calbright email of the contact
+            sf_field: The Salesforce field, one of MONOTONIC_CONTACT_FIELDS
+
+        Returns: tuple: (contact ID, value), or None if the value isn't known
+
+        """
+        key = (email, sf_field)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry["expires_at"] > time.monotonic():
+                self.memory_hits += 1
+                return entry["known"]
+        row = session.execute(
+            select(timestamps_table.c.contact_id, timestamps_table.c.value).where(
+                timestamps_table.c.email == email, timestamps_table.c.sf_field == sf_field
+            )
+        ).one_or_none()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        known = (row.contact_id, _as_utc(row.value))
+        with self._lock:
+            self.hits += 1
+            self._memory[key] = {"known": known, "expires_at": time.monotonic() + self.ttl_seconds}
+        return known
+
+    def advance(self, session, email: str, sf_field: str, contact_id: str, value: datetime.datetime):
+        """
+        Record that Salesforce holds a contact timestamp, unless a newer value is already known. This doesn't commit,
+        so the value is saved in the same transaction as the event's own changes, and it is dropped from memory until
+        it is read back.
+        Args:
+            session: The SQLAlchemy session to write with
+            email: The Calbright email of the contact
+            sf_field: The Salesforce field, one of MONOTONIC_CONTACT_FIELDS
+            contact_id: The Salesforce contact ID
+            value: The timestamp Salesforce holds
+
+        Returns: None
+
+        """
+        self._forget([(email, sf_field)])
+        statement = insert(timestamps_table).values(
+            email=email,
+            sf_field=sf_field,
+            contact_id=contact_id,
+            value=value,
+            updated_at=datetime.datetime.now(datetime.timezone.utc),
+        )
+        session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[timestamps_table.c.email, timestamps_table.c.sf_field],
+                set_={
+                    "contact_id": statement.excluded.contact_id,
+                    "value": statement.excluded.value,
+                    "updated_at": statement.excluded.updated_at,
+                },
+                where=timestamps_table.c.value < statement.excluded.value,
+            )
+        )
+
+    def forget_contacts(self, session, contact_ids: list):
+        """
+        Drop the known values of contacts, when a write to Salesforce failed and their values can't be trusted
+        Args:
+            session: The SQLAlchemy session to write with
+            contact_ids: The Salesforce contact IDs
+
+        Returns: None
+
+        """
+        contact_ids = set(contact_ids)
+        if not contact_ids:
+            return
+        with self._lock:
+            keys = [key for key, entry in self._memory.items() if entry["known"][0] in contact_ids]
+        self._forget(keys)
+        session.execute(delete(timestamps_table).where(timestamps_table.c.contact_id.in_(contact_ids)))
+
+    def reconcile(self, session, sf_client, batch_size: int = RECONCILE_BATCH_SIZE):
+        """
+        Repair drift between the stored values and Salesforce. The stored contacts are paged through in contact ID
+        order and each page is read back from Salesforce with one query; a newer Salesforce value (written by something
+        else) moves the stored value forward, a stored value Salesforce doesn't have is written again, and contacts
+        that no longer exist are dropped. Commits per page.
+        Args:
+            session: The SQLAlchemy session to use
+            sf_client: The Propus Salesforce object
+            batch_size: How many contacts to read from Postgres and Salesforce per page
+
+        Returns: dict: the number of contacts checked, values moved forward, values written again and contacts dropped
+
+        """
+        stats = {"checked": 0, "advanced": 0, "rewritten": 0, "dropped": 0}
+        last_contact_id = None
+        while True:
+            page = select(timestamps_table.c.contact_id).distinct().order_by(timestamps_table.c.contact_id)
+            if last_contact_id is not None:
+                page = page.where(timestamps_table.c.contact_id > last_contact_id)
+            batch = list(session.execute(page.limit(batch_size)).scalars().all())
+            if not batch:
+                break
+            last_contact_id = batch[-1]
+
+            stored = {}
+            for row in session.execute(
+                select(timestamps_table).where(timestamps_table.c.contact_id.in_(batch))
+            ).all():
+                stored.setdefault(row.contact_id, []).append(row)
+
+            quoted_ids = ", ".join(f"'{contact_id}'" for contact_id in batch)
+            response = sf_client.custom_query(
+                f"SELECT Id, {', '.join(MONOTONIC_CONTACT_FIELDS)} FROM Contact WHERE Id IN ({quoted_ids})"
+            )
+            contacts = {record.get("Id"): record for record in response.get("records") or []}
+            missing = [contact_id for contact_id in batch if contact_id not in contacts]
+            self.forget_contacts(session, missing)
+            stats["dropped"] += len(missing)
+
+            for contact_id, record in contacts.items():
+                stats["checked"] += 1
+                rewrite = {}
+                for row in stored.get(contact_id, []):
+                    value = _as_utc(row.value)
+                    sf_value = _parse_sf_datetime(record.get(row.sf_field))
+                    if sf_value is not None and sf_value > value:
+                        self.advance(session, row.email, row.sf_field, contact_id, sf_value)
+                        stats["advanced"] += 1
+                    elif sf_value is None or sf_value < value:
+                        rewrite[row.sf_field] = value.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+                if rewrite:
+                    self.logger.warning(f"Salesforce contact {contact_id} is missing known timestamps: {rewrite}")
+                    sf_client.update_contact_record(salesforce_id=contact_id, **rewrite)
+                    stats["rewritten"] += len(rewrite)
+            session.commit()
+        self.logger.info(f"reconciled contact timestamps: {stats}")
+        return stats
+
+    def clear(self):
+        """
+        Drop every value from memory and reset the lookup counters
+
+        Returns: None
+
+        """
+        with self._lock:
+            self._memory.clear()
+            self.hits = 0
+            self.memory_hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Get the lookup counters
+
+        Returns: dict: the number of lookups that found a known value in the table, the number answered from memory,
+            the number that didn't find one and the number of values in memory
+
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "misses": self.misses,
+                "size": len(self._memory),
+            }
@@ -4,24 +4,32 @@ from propus.canvas import Canvas
 from propus.helpers.canvas import create_subsequent_course_enrollment
 from propus.logging_utility import Logging
 
+from src.submission_history import SubmissionHistoryCache, get_first_attempt
+
+submission_histories = SubmissionHistoryCache()
+
 
 class CanvasServices:
     """
     This class is responsible for handling all the canvas related services, e.g. creating a new course enrollment
     """
 
-    def __init__(self, canvas_engine: Canvas, postgres_engine):
+    def __init__(
+        self, canvas_engine: Canvas, postgres_engine, submission_cache: SubmissionHistoryCache = submission_histories
+    ):
         """
         Initialize the canvas services object
         Args:
             canvas_engine: The Propus Canvas object
             postgres_engine: The Propus Calbright Postgres object
+            submission_cache: The submission history cache, shared by the events of a batch
         """
         self.logger = Logging.get_logger(
             "castor/lambda_functions/canvas_events/canvas_event_system/canvas_services", debug=True
         )
         self.canvas_engine = canvas_engine
         self.postgres_engine = postgres_engine
+        self.submission_cache = submission_cache
 
     @staticmethod
     def _get_first_result(results):
@@ -57,7 +65,8 @@ class CanvasServices:
 
     def get_first_assignment_submission(self, assignment_id: str, user_id: str, course_id: str):
         """
-        Get the first submission attempt for an assignment from the Canvas REST API
+        Get the first submission attempt for an assignment from the Canvas REST API, or from the submission histories
+        prefetched for the batch
         Args:
             assignment_id: The Canvas assignment id
             user_id: The Canvas user id
@@ -70,22 +79,17 @@ class CanvasServices:
             f"Getting first submission attempt for assignment {assignment_id} for user {user_id}"
             f" in course {course_id}"
         )
-        assignment = self._get_first_result(
-            asyncio.run(
-                self.canvas_engine.get_single_submission(
-                    object_type="course",
-                    object_id=course_id,
-                    assignment_id=assignment_id,
-                    user_id=user_id,
-                    include=["submission_history"],
+        submission = self.submission_cache.get(self.canvas_engine, course_id, assignment_id, user_id)
+        if submission is None:
+            submission = self._get_first_result(
+                asyncio.run(
+                    self.canvas_engine.get_single_submission(
+                        object_type="course",
+                        object_id=course_id,
+                        assignment_id=assignment_id,
+                        user_id=user_id,
+                        include=["submission_history"],
+                    )
                 )
             )
-        )
-        for submission in assignment.get("submission_history", []):
-            if submission.get("attempt") == 1:
-                return submission
-        # TODO: There is something happening with skillways where it's wiping out the first attempt.
-        #   SO here I'm gonna re-loop through it and just grab ANY attempt that exists if we don't have an attempt 1
-        #   we could also refactor to look through and grab the lowest attempt...
-        for submission in assignment.get("submission_history", []):
-            return submission
+        return get_first_attempt(submission)
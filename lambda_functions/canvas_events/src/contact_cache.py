@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import OrderedDict
+
+CONTACT_CACHE_MAX_SIZE = 2000
+CONTACT_CACHE_TTL_SECONDS = 300
+
+
+class ContactCache:
+    """
+    A bounded LRU cache with a TTL for Salesforce contact records, so repeated lookups for the same student don't each
+    cost a SOQL query. Records are stored by contact ID and can be looked up by either the contact ID or the
+    Calbright email.
+
+    The cache lives at module level in sf_services, so it is shared by every event in a Lambda container, and it is
+    safe to use from the Salesforce fan-out threads.
+    """
+
+    def __init__(self, max_size: int = CONTACT_CACHE_MAX_SIZE, ttl_seconds: int = CONTACT_CACHE_TTL_SECONDS):
+        """
+        Initialize the contact cache
+        Args:
+            max_size: The maximum number of contacts to keep, the least recently used contact is evicted first
+            ttl_seconds: How long a contact is served from the cache before it has to be queried again
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._records = OrderedDict()
+        self._email_index = {}
+        # Salesforce calls fanned out to a thread pool share the cache
+        self._lock = threading.RLock()
+
+    def _evict(self, contact_id):
+        entry = self._records.pop(contact_id, None)
+        if entry and entry["email"]:
+            self._email_index.pop(entry["email"], None)
+
+    def get(self, email: str = None, contact_id: str = None):
+        """
+        Get a contact record from the cache by email or contact ID
+        Args:
+            email: The Calbright email of the contact
+            contact_id: The Salesforce contact ID
+
+        Returns: dict: A copy of the cached contact record, or None if it isn't cached or has expired
+
+        """
+        with self._lock:
+            if contact_id is None:
+                contact_id = self._email_index.get(email)
+            entry = self._records.get(contact_id)
+            if entry is None or entry["expires_at"] <= time.monotonic():
+                if entry is not None:
+                    self._evict(contact_id)
+                self.misses += 1
+                return None
+            self._records.move_to_end(contact_id)
+            self.hits += 1
+            return dict(entry["record"])
+
+    def put(self, contact_id: str, record: dict, email: str = None):
+        """
+        Add or replace a contact record in the cache, evicting the least recently used contact if the cache is full
+        Args:
+            contact_id: The Salesforce contact ID
+            record: The contact fields, as returned by a SOQL query
+            email: The Calbright email of the contact, if known
+
+        Returns: None
+
+        """
+        with self._lock:
+            existing = self._records.get(contact_id)
+            if email is None and existing:
+                email = existing["email"]
+            self._evict(contact_id)
+            self._records[contact_id] = {
+                "email": email,
+                "record": dict(record),
+                "expires_at": time.monotonic() + self.ttl_seconds,
+            }
+            if email:
+                self._email_index[email] = contact_id
+            while len(self._records) > self.max_size:
+                self._evict(next(iter(self._records)))
+
+    def update_fields(self, contact_id: str, **fields):
+        """
+        Apply fields we have written to Salesforce to a cached contact, so the cache doesn't serve stale values after
+        our own updates. Contacts that aren't cached are left alone.
+        Args:
+            contact_id: The Salesforce contact ID
+            **fields: The fields that were written
+
+        Returns: None
+
+        """
+        with self._lock:
+            entry = self._records.get(contact_id)
+            if entry is not None:
+                entry["record"].update(fields)
+
+    def invalidate(self, contact_id: str):
+        """
+        Remove a contact from the cache, for example after a write to Salesforce failed
+        Args:
+            contact_id: The Salesforce contact ID
+
+        Returns: None
+
+        """
+        with self._lock:
+            self._evict(contact_id)
+
+    def clear(self):
+        """
+        Remove every contact from the cache and reset the counters
+
+        Returns: None
+
+        """
+        with self._lock:
+            self._records.clear()
+            self._email_index.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Get the cache counters
+
+        Returns: dict: the number of hits, misses and cached contacts
+
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._records)}
@@ -0,0 +1,159 @@
+import datetime
+import re
+from zoneinfo import ZoneInfo
+
+GLOBAL_ID_PATTERN = re.compile(r"0+(\d+)$")
+PACIFIC = ZoneInfo("America/Los_Angeles")
+UTC = ZoneInfo("UTC")
+
+# Body fields holding Canvas IDs that the event handlers need as local IDs
+BODY_ID_FIELDS = ("assignment_id", "submission_id", "discussion_topic_id", "discussion_entry_id", "quiz_id")
+METADATA_TIMESTAMP_FIELDS = ("event_time", "first_event_time")
+BODY_TIMESTAMP_FIELDS = ("submitted_at", "created_at")
+
+
+def to_local_id(id_string):
+    """
+    Convert a global Canvas ID to a local ID (which is the main ID used across Canvas and in the UI)
+    Note: Instructure has noted that they are going to be moving away from global IDs in the future, so this
+    function may not be needed in the future.
+    Reference here: https://canvas.instructure.com/doc/api/file.data_service_canvas_event_metadata.html
+    Args:
+        id_string: The global ID string. For example '263480000000000123'. Integer IDs are converted to strings first
+
+    Returns: str: the local ID string. For example '123', or None if a global ID couldn't be converted
+
+    """
+    id_string = str(id_string)
+    if len(id_string) < 16:
+        return id_string
+    match = GLOBAL_ID_PATTERN.search(id_string)
+    if match:
+        return match.group(1)
+
+
+def to_utc(value):
+    """
+    Parse an ISO timestamp from an event and convert it to UTC. Timestamps without timezone info are taken as Pacific
+    time. Values that were already parsed are only converted, so an event can safely be parsed twice.
+    Args:
+        value: The ISO timestamp string, or a datetime
+
+    Returns: datetime: the timestamp in UTC
+
+    """
+    if isinstance(value, str):
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        value = datetime.datetime.fromisoformat(value)
+    if value.tzinfo is not None:
+        return value.astimezone(UTC)
+    return value.replace(tzinfo=PACIFIC).astimezone(UTC)
+
+
+class CanvasEventEnvelope:
+    """
+    A Canvas event parsed once: the IDs are converted to local IDs and the timestamps to UTC a single time, up front,
+    instead of every time a handler needs them.
+
+    The normalized values are also written back into the event's `metadata` and `body` dicts (timestamps replaced,
+    `*_local` IDs added), which the handlers keep reading for the fields they use as is.
+    """
+
+    __slots__ = (
+        "metadata",
+        "body",
+        "event_name",
+        "event_time",
+        "first_event_time",
+        "context_type",
+        "context_id",
+        "context_id_local",
+        "context_account_id",
+        "user_id",
+        "user_id_local",
+        "local_ids",
+    )
+
+    def __init__(self, event: dict):
+        """
+        Parse a Canvas event
+        Args:
+            event: The event from the Canvas event stream
+        """
+        metadata = event.get("metadata")
+        body = event.get("body")
+        self.metadata = metadata
+        self.body = body
+
+        for field in METADATA_TIMESTAMP_FIELDS:
+            if metadata.get(field):
+                metadata[field] = to_utc(metadata[field])
+        for field in BODY_TIMESTAMP_FIELDS:
+            if body.get(field):
+                body[field] = to_utc(body[field])
+
+        self.event_name = metadata.get("event_name")
+        self.event_time = metadata.get("event_time")
+        # Set on events coalesced by the CanvasEventSystem, holding the time of the earliest event folded together
+        self.first_event_time = metadata.get("first_event_time") or self.event_time
+        self.context_type = metadata.get("context_type")
+        self.context_id = metadata.get("context_id")
+        self.context_id_local = None
+        self.context_account_id = metadata.get("context_account_id")
+        if self.context_id:
+            self.context_id_local = metadata["context_id_local"] = to_local_id(self.context_id)
+        if metadata.get("user_id"):
+            metadata["user_id_local"] = to_local_id(metadata["user_id"])
+        if body.get("student_id"):
+            body["student_id_local"] = to_local_id(body["student_id"])
+
+        self.local_ids = {field: to_local_id(body[field]) for field in BODY_ID_FIELDS if body.get(field)}
+
+        # The user can be in the body as user_id or student_id, or in the metadata, in that order of preference
+        self.user_id = body.get("user_id") or body.get("student_id") or metadata.get("user_id")
+        self.user_id_local = to_local_id(self.user_id) if self.user_id else None
+        if (body.get("user") or {}).get("id"):
+            self.user_id = self.user_id_local = str(body["user"]["id"])
+
+    @classmethod
+    def parse(cls, event):
+        """
+        Get the envelope of an event, parsing it unless it already is one
+        Args:
+            event: The event from the Canvas event stream, or its envelope
+
+        Returns: CanvasEventEnvelope: the parsed event
+
+        """
+        return event if isinstance(event, cls) else cls(event)
+
+    def local_id(self, field):
+        """
+        Get the local ID of one of the body's ID fields
+        Args:
+            field: The body field, for example 'assignment_id'
+
+        Returns: str: the local ID, or None if the body doesn't have the field
+
+        """
+        return self.local_ids.get(field)
+
+    def event_info(self):
+        """
+        Get the event info the handlers use
+
+        Returns: dict: the event name, time, first time (for coalesced events), context_type, and context IDs
+
+        """
+        event_info = {
+            "event_name": self.event_name,
+            "event_time": self.event_time,
+            "first_event_time": self.first_event_time,
+            "context_type": self.context_type,
+            "context_id": self.context_id,
+            "context_account_id": self.context_account_id,
+        }
+        if self.context_id:
+            event_info["context_id_local"] = self.context_id_local
+        return event_info
@@ -0,0 +1,187 @@
+import json
+import os
+import time
+
+from propus.logging_utility import Logging
+
+ACTIVITY_LANE = "activity"
+TRANSACTIONAL_LANE = "transactional"
+
+# Lanes are processed in this order within a batch, so grading is never queued behind activity volume
+LANE_ORDER = (TRANSACTIONAL_LANE, ACTIVITY_LANE)
+
+# Event types are routed by their _event_type_mapping key. Activity events only move timestamps forward and are cheap
+# to aggregate; everything else (grade_change, submission_created, quiz_submitted...) is transactional.
+EVENT_LANES = {
+    "logged_in": ACTIVITY_LANE,
+    "asset_accessed": ACTIVITY_LANE,
+}
+
+LANE_METRICS_NAMESPACE = "Castor/CanvasEvents"
+
+# SQS accepts at most 10 messages per SendMessageBatch request
+SQS_SEND_BATCH_SIZE = 10
+
+
+def get_lane(event_type: str):
+    """
+    Get the lane an event type is processed in
+    Args:
+        event_type: The event type, a key of CanvasEventSystem._event_type_mapping
+
+    Returns: str: ACTIVITY_LANE or TRANSACTIONAL_LANE
+
+    """
+    return EVENT_LANES.get(event_type, TRANSACTIONAL_LANE)
+
+
+class LaneRouter:
+    """
+    Splits a batch of parsed records into lanes, and forwards activity records to their own queue when one is
+    configured (ACTIVITY_LANE_QUEUE). The activity queue's event source has a large batch size, a long batching window
+    and a low concurrency, so a user's activity events are coalesced over a whole window and never take Lambda
+    concurrency from the transactional lane. Records that already come from the activity queue are processed.
+    """
+
+    def __init__(self, activity_queue: str = None, sqs_client=None):
+        """
+        Initialize the lane router
+        Args:
+            activity_queue: The name of the activity lane queue, defaults to the ACTIVITY_LANE_QUEUE environment
+                variable. Activity records are processed with the rest of the batch when there is none
+            sqs_client: A boto3 SQS client, built on first use by default
+        """
+        self.logger = Logging.get_logger("castor/lambda_functions/canvas_events/canvas_event_system/lanes", debug=True)
+        self.activity_queue = activity_queue if activity_queue is not None else os.environ.get("ACTIVITY_LANE_QUEUE")
+        self._sqs_client = sqs_client
+        self._queue_url = None
+
+    @staticmethod
+    def split(parsed_records: list):
+        """
+        Split parsed records into lanes, keeping their order within each lane
+        Args:
+            parsed_records: The records returned by CanvasEventSystem.parse_records
+
+        Returns: dict: lane > list of parsed records, in LANE_ORDER
+
+        """
+        lanes = {lane: [] for lane in LANE_ORDER}
+        for record in parsed_records:
+            lanes[get_lane(record["event_type"])].append(record)
+        return lanes
+
+    def should_forward(self, lane: str, records: list):
+        """
+        Check if a lane's records should be sent to the lane's own queue instead of being processed now
+        Args:
+            lane: The lane
+            records: The lane's parsed records
+
+        Returns: True if the records are activity records that didn't come from the activity queue
+
+        """
+        if lane != ACTIVITY_LANE or not self.activity_queue or not records:
+            return False
+        return not all((record.get("source") or "").endswith(f":{self.activity_queue}") for record in records)
+
+    @property
+    def sqs_client(self):
+        if self._sqs_client is None:
+            import boto3
+
+            self._sqs_client = boto3.client("sqs", region_name="us-west-2")
+        return self._sqs_client
+
+    def forward(self, records: list):
+        """
+        Send records to the activity lane queue
+        Args:
+            records: The parsed records, each with its original SQS message 'body'
+
+        Returns: list: the message IDs that could not be sent, so SQS redelivers them
+
+        """
+        if self._queue_url is None:
+            self._queue_url = self.sqs_client.get_queue_url(QueueName=self.activity_queue)["QueueUrl"]
+        entries = [
+            {"Id": str(index), "MessageBody": record.get("body") or json.dumps(record["event"])}
+            for index, record in enumerate(records)
+        ]
+        failed_message_ids = []
+        for start in range(0, len(entries), SQS_SEND_BATCH_SIZE):
+            chunk = entries[start : start + SQS_SEND_BATCH_SIZE]
+            try:
+                response = self.sqs_client.send_message_batch(QueueUrl=self._queue_url, Entries=chunk)
+                failed_ids = [int(failure["Id"]) for failure in response.get("Failed") or []]
+            except Exception as err:
+                self.logger.error(f"unable to forward activity records to {self.activity_queue}: {err}")
+                failed_ids = [int(entry["Id"]) for entry in chunk]
+            for index in failed_ids:
+                failed_message_ids.extend(records[index]["message_ids"])
+        self.logger.info(f"forwarded {len(records) - len(failed_message_ids)} records to {self.activity_queue}")
+        return failed_message_ids
+
+
+class LaneMetrics:
+    """
+    Per-lane backlog and latency metrics for a batch, logged as CloudWatch Embedded Metric Format lines: how many
+    records the lane had, how many failed or were forwarded, how long the oldest record waited in SQS and how long the
+    lane took to process.
+    """
+
+    def __init__(self, namespace: str = LANE_METRICS_NAMESPACE):
+        self.namespace = namespace
+
+    @staticmethod
+    def oldest_age_ms(records: list, now_ms: int = None):
+        """
+        Get how long the oldest record of a lane waited in SQS
+        Args:
+            records: The lane's parsed records
+            now_ms: The current time in epoch milliseconds
+
+        Returns: int: the age in milliseconds, 0 if no record has a sent timestamp
+
+        """
+        now_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+        sent_at = [record["sent_at"] for record in records if record.get("sent_at")]
+        return max(now_ms - min(sent_at), 0) if sent_at else 0
+
+    def emit(self, lane: str, records: list, failed: int, forwarded: int, elapsed_seconds: float):
+        """
+        Log a lane's metrics for the batch
+        Args:
+            lane: The lane
+            records: The lane's parsed records
+            failed: How many of the lane's messages failed
+            forwarded: How many of the lane's records were forwarded to the lane's queue
+            elapsed_seconds: How long the lane took
+
+        Returns: dict: the logged line
+
+        """
+        metrics = {
+            "LaneRecords": ("Count", len(records)),
+            "LaneFailures": ("Count", failed),
+            "LaneForwarded": ("Count", forwarded),
+            "LaneBacklogAge": ("Milliseconds", self.oldest_age_ms(records)),
+            "LaneLatency": ("Milliseconds", round(elapsed_seconds * 1000, 3)),
+        }
+        line = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [["Lane"]],
+                        "Metrics": [{"Name": name, "Unit": unit} for name, (unit, _) in metrics.items()],
+                    }
+                ],
+            },
+            "Lane": lane,
+            **{name: value for name, (_, value) in metrics.items()},
+        }
+        # EMF lines have to be written to stdout as they are, CloudWatch extracts the metrics from them
+        print(json.dumps(line))
+        return line
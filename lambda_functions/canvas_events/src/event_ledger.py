@@ -0,0 +1,220 @@
+import datetime
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, Text, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+LEDGER_CACHE_MAX_SIZE = 5000
+LEDGER_CACHE_TTL_SECONDS = 600
+# "Not recorded yet" is only trusted for about as long as the batch that prefetched it takes to run, as another
+# container may record the event at any time
+LEDGER_UNRECORDED_TTL_SECONDS = 30
+
+OUTCOME_SUCCEEDED = "succeeded"
+OUTCOME_FAILED = "failed"
+
+# Created by db_scripts/postgres/canvas_events/tables/canvas_event_ledger_create.txt, the Lambda doesn't create it
+ledger_table = Table(
+    "canvas_event_ledger",
+    MetaData(),
+    Column("event_id", String, primary_key=True),
+    Column("event_type", String, primary_key=True),
+    Column("outcome", String, nullable=False),
+    Column("detail", Text),
+    Column("processed_at", DateTime(timezone=True), nullable=False),
+)
+
+
+class EventLedger:
+    """
+    An idempotency ledger for Canvas events. The outcome of every processed event is recorded in the
+    canvas_event_ledger table, keyed by the Canvas event ID and event type, so an event that SQS redelivers or that is
+    replayed from the DLQ after it already succeeded can be skipped before any work is done.
+
+    Outcomes are also kept in a short-lived in-process cache in front of the table, so redeliveries within a warm
+    container don't cost a query. Recorded outcomes only enter the cache through `remember`, once the transaction that
+    recorded them has committed. Events a prefetch found unrecorded are cached for a much shorter time.
+
+    The ledger is shared by the DLQ drain's worker threads, so the cache is guarded by a lock.
+    """
+
+    def __init__(
+        self,
+        max_size: int = LEDGER_CACHE_MAX_SIZE,
+        ttl_seconds: int = LEDGER_CACHE_TTL_SECONDS,
+        unrecorded_ttl_seconds: int = LEDGER_UNRECORDED_TTL_SECONDS,
+    ):
+        """
+        Initialize the event ledger
+        Args:
+            max_size: The maximum number of outcomes to keep in the in-process cache
+            ttl_seconds: How long an outcome is served from the in-process cache
+            unrecorded_ttl_seconds: How long an event a prefetch found unrecorded is served from the in-process cache
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.unrecorded_ttl_seconds = unrecorded_ttl_seconds
+        self._outcomes = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def event_key(event: dict):
+        """
+        Get the ledger key of a Canvas event. Canvas live events carry an `event_guid` in their metadata; events without
+        one fall back to the `request_id` (or `job_id` for background jobs) plus a digest of the body, since a single
+        request can emit several events of the same type (for example, grading a whole course).
+        This must be called before the event is handed to a BaseEvent, which changes the event in place.
+        Args:
+            event: The event from the Canvas event stream
+
+        Returns: tuple: (event ID, event type)
+
+        """
+        metadata = event.get("metadata") or {}
+        event_type = metadata.get("event_name")
+        if metadata.get("event_guid"):
+            return str(metadata["event_guid"]), event_type
+
+        digest = hashlib.sha256(json.dumps(event.get("body"), sort_keys=True, default=str).encode()).hexdigest()[:16]
+        source_id = metadata.get("request_id") or metadata.get("job_id")
+        if source_id:
+            return f"{source_id}:{digest}", event_type
+        digest = hashlib.sha256(json.dumps(event, sort_keys=True, default=str).encode()).hexdigest()[:32]
+        return f"event:{digest}", event_type
+
+    def _cache(self, key, outcome):
+        ttl_seconds = self.ttl_seconds if outcome is not None else self.unrecorded_ttl_seconds
+        with self._lock:
+            self._outcomes.pop(key, None)
+            self._outcomes[key] = {"outcome": outcome, "expires_at": time.monotonic() + ttl_seconds}
+            while len(self._outcomes) > self.max_size:
+                self._outcomes.popitem(last=False)
+
+    def get_outcome(self, session, key):
+        """
+        Get the recorded outcome of an event
+        Args:
+            session: The SQLAlchemy session to query with
+            key: The event's ledger key, from `event_key`
+
+        Returns: str: The outcome, or None if the event hasn't been recorded
+
+        """
+        key = tuple(key)
+        with self._lock:
+            entry = self._outcomes.get(key)
+        if entry is not None and entry["expires_at"] > time.monotonic():
+            return entry["outcome"]
+
+        event_id, event_type = key
+        outcome = session.execute(
+            select(ledger_table.c.outcome).where(
+                ledger_table.c.event_id == event_id, ledger_table.c.event_type == event_type
+            )
+        ).scalar_one_or_none()
+        if outcome is not None:
+            self._cache(key, outcome)
+        return outcome
+
+    def prefetch(self, session, keys: list):
+        """
+        Load the outcomes of many events with one query, so checking each event of a batch doesn't cost a query.
+        Events that haven't been recorded are cached as such for `unrecorded_ttl_seconds` only.
+        Args:
+            session: The SQLAlchemy session to query with
+            keys: The events' ledger keys
+
+        Returns: None
+
+        """
+        keys = [tuple(key) for key in keys]
+        if not keys:
+            return
+        rows = session.execute(
+            select(ledger_table.c.event_id, ledger_table.c.event_type, ledger_table.c.outcome).where(
+                tuple_(ledger_table.c.event_id, ledger_table.c.event_type).in_(keys)
+            )
+        ).all()
+        outcomes = {(row.event_id, row.event_type): row.outcome for row in rows}
+        for key in keys:
+            self._cache(key, outcomes.get(key))
+
+    def is_applied(self, session, keys: list):
+        """
+        Check if every one of a set of events has already been processed successfully
+        Args:
+            session: The SQLAlchemy session to query with
+            keys: The events' ledger keys
+
+        Returns: True if all of the events succeeded before
+
+        """
+        return bool(keys) and all(self.get_outcome(session, key) == OUTCOME_SUCCEEDED for key in keys)
+
+    def record(self, session, keys: list, outcome: str, detail: str = None):
+        """
+        Record the outcome of events, replacing any earlier outcome. This doesn't commit, so a success can be recorded
+        in the same transaction as the event's own changes, and it doesn't cache the outcome: call `remember` once the
+        transaction has committed.
+        Args:
+            session: The SQLAlchemy session to write with
+            keys: The events' ledger keys
+            outcome: The outcome, OUTCOME_SUCCEEDED or OUTCOME_FAILED
+            detail: Extra information about the outcome, for example the error message
+
+        Returns: None
+
+        """
+        if not keys:
+            return
+        processed_at = datetime.datetime.now(datetime.timezone.utc)
+        statement = insert(ledger_table).values(
+            [
+                {
+                    "event_id": event_id,
+                    "event_type": event_type,
+                    "outcome": outcome,
+                    "detail": detail,
+                    "processed_at": processed_at,
+                }
+                for event_id, event_type in keys
+            ]
+        )
+        session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[ledger_table.c.event_id, ledger_table.c.event_type],
+                set_={
+                    "outcome": statement.excluded.outcome,
+                    "detail": statement.excluded.detail,
+                    "processed_at": statement.excluded.processed_at,
+                },
+            )
+        )
+
+    def remember(self, keys: list, outcome: str):
+        """
+        Cache the outcome of events after the transaction that recorded it has committed, so a rolled back outcome is
+        never served from the cache
+        Args:
+            keys: The events' ledger keys
+            outcome: The committed outcome
+
+        Returns: None
+
+        """
+        for key in keys:
+            self._cache(tuple(key), outcome)
+
+    def clear(self):
+        """
+        Empty the in-process cache
+
+        Returns: None
+
+        """
+        with self._lock:
+            self._outcomes.clear()
@@ -46,3 +46,19 @@ class NoSubmissionTimestamp(Exception):
 class CourseNotFoundInDatabase(Exception):
     def __init__(self, course_id):
         super().__init__(f'Course with canvas_id "{course_id}" not found in database')
+
+
+class InvalidCanvasEventRecord(Exception):
+    def __init__(self, message_id):
+        super().__init__(f'SQS record "{message_id}" does not contain a valid Canvas event')
+
+
+# Errors caused by the event data itself. Retrying these events will never succeed, so they are not allowed to hold up
+# the rest of a user's events in a batch, and the DLQ drain deletes them instead of leaving them on the queue.
+NON_RETRYABLE_EXCEPTIONS = (
+    AssigmentNotFoundInDatabase,
+    UserNotFoundInDatabase,
+    NoUserInfoInEvent,
+    UnknownCanvasEventType,
+    InvalidCanvasEventRecord,
+)
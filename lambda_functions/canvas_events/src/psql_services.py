@@ -1,7 +1,10 @@
+from contextlib import contextmanager
 from typing import Union, Literal
-from sqlalchemy import text, select
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy import and_, text, select, update
+from sqlalchemy.orm import contains_eager, joinedload
+from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
+from common.reference_data import ReferenceDataCache
 from src.exceptions import (
     UserNotFoundInDatabase,
     InvalidFinalGrade,
@@ -14,11 +17,13 @@ from propus.calbright_sql.assessment import Assessment
 from propus.calbright_sql.assessment_submission import AssessmentSubmission
 from propus.calbright_sql.calbright import Calbright
 from propus.calbright_sql.course_version import CourseVersion
+from propus.calbright_sql.course_version_section import CourseVersionSection
 from propus.calbright_sql.enrollment import LMS, Enrollment
 from propus.calbright_sql.enrollment_course_term import EnrollmentCourseTerm, GradeStatus
 from propus.calbright_sql.enrollment_status import EnrollmentStatus
 from propus.calbright_sql.grade import Grade
 from propus.calbright_sql.learner_status import LearnerStatus
+from propus.calbright_sql.program_version_course import ProgramVersionCourse
 from propus.calbright_sql.student import Student
 from propus.calbright_sql.user import User
 from propus.calbright_sql.user_lms import UserLms
@@ -27,6 +32,100 @@ from propus.logging_utility import Logging
 
 all_models = tuple(Calbright.all_models)
 
+# Lookup tables shared by every event in the Lambda container
+reference_data = ReferenceDataCache({Grade: "grade", LearnerStatus: "status", EnrollmentStatus: "status"})
+
+ACTIVE_ENROLLMENT_STATUSES = ("Enrolled", "Started")
+
+# The progress views are read positionally, so each view row is returned as JSON (which keeps the column order).
+# The statements are built once and their compiled form is cached by SQLAlchemy and reused by every event.
+PROGRAM_PROGRESS_QUERY = text("SELECT * FROM progress_by_enrollment WHERE enrollment_id = :enrollment_id")
+PROGRESS_QUERY = text(
+    """
+    SELECT to_json(program_progress) AS program_progress,
+        to_json(course_progress) AS course_progress,
+        course.course_code
+    FROM course_version
+    JOIN course ON course.id = course_version.course_id
+    LEFT JOIN progress_by_enrollment AS program_progress ON program_progress.enrollment_id = :enrollment_id
+    LEFT JOIN progress_by_course AS course_progress
+        ON course_progress.enrollment_id = :enrollment_id AND course_progress.course_id = course.id
+    WHERE course_version.lms_id = :course_lms_id
+    """
+)
+
+
+class StudentContext:
+    """
+    Everything about a student that a Canvas event needs from the database, loaded together by
+    PSQLServices.get_student_context: their user_lms and user records, their active enrollments, and the
+    enrollment_course_terms that haven't been graded yet with the course version chain of each. The course terms come
+    from every enrollment of the student, so a grade or progress event still finds its course term after the
+    enrollment has left an active status.
+
+    A student with more than one active enrollment still has a context, so steps that only need the user work for
+    them; only asking for the single active `enrollment` fails.
+    """
+
+    def __init__(self, lms_id, user_lms: UserLms, enrollments: list, course_terms: list):
+        """
+        Initialize the StudentContext object
+        Args:
+            lms_id: The student's canvas_id
+            user_lms: The student's user_lms record, with the user loaded
+            enrollments: The student's active enrollments, with the student and user loaded
+            course_terms: The 'Not Graded' enrollment_course_terms of all the student's enrollments, with their course
+                versions loaded
+        """
+        self.lms_id = lms_id
+        self.user_lms = user_lms
+        self.enrollments = enrollments
+        self.course_terms = course_terms
+
+    @property
+    def user(self) -> User:
+        return self.user_lms.user
+
+    @property
+    def ccc_id(self):
+        return self.user.ccc_id
+
+    @property
+    def email(self):
+        return self.user.calbright_email
+
+    @property
+    def enrollment(self) -> Enrollment:
+        """
+        The student's active enrollment
+
+        Returns: The enrollment object
+
+        Raises: EnrollmentNotFoundInDatabase if the student has no active enrollment, MultipleResultsFound if they have
+            more than one
+        """
+        if not self.enrollments:
+            raise EnrollmentNotFoundInDatabase(self.lms_id)
+        if len(self.enrollments) > 1:
+            raise MultipleResultsFound(f"Multiple active enrollments found for user with lms_id {self.lms_id}")
+        return self.enrollments[0]
+
+    def get_course_term(self, course_lms_id):
+        """
+        Get the enrollment_course_term of a course the student is taking that hasn't been graded yet
+        Args:
+            course_lms_id: The course's lms_id
+
+        Returns: The enrollment_course_term object, or None if the student isn't taking the course
+
+        """
+        for course_term in self.course_terms:
+            if (
+                course_term.grade_status == GradeStatus("Not Graded")
+                and course_term.course_version_section.program_version_course.course_version.lms_id == course_lms_id
+            ):
+                return course_term
+
 
 class PSQLServices:
     """
@@ -43,6 +142,130 @@ class PSQLServices:
             "castor/lambda_functions/canvas_events/canvas_event_system/psql_services", debug=True
         )
         self.psql_engine = psql_engine
+        self._student_contexts = {}
+        self._in_unit_of_work = False
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        Run everything inside the block in a single transaction that is committed once at the end, instead of
+        committing after every change. If the block raises, every change made in it is rolled back.
+
+        Usage:
+            with psql_services.unit_of_work():
+                ...
+
+        Returns: None
+
+        """
+        if self._in_unit_of_work:
+            yield
+            return
+        self._in_unit_of_work = True
+        try:
+            yield
+            self.psql_engine.session.commit()
+        except Exception:
+            self.psql_engine.session.rollback()
+            raise
+        finally:
+            self._in_unit_of_work = False
+
+    @contextmanager
+    def savepoint(self):
+        """
+        Wrap an optional step of a unit of work in a savepoint, so a failure only rolls back that step and the rest of
+        the event can still be committed. The exception is re-raised for the caller to handle. Outside of a unit of work
+        this does nothing, as each step commits on its own.
+
+        Returns: None
+
+        """
+        if not self._in_unit_of_work:
+            yield
+            return
+        nested = self.psql_engine.session.begin_nested()
+        try:
+            yield
+            nested.commit()
+        except Exception:
+            nested.rollback()
+            raise
+
+    def commit(self):
+        """
+        Commit the session, or only flush it when running inside a unit of work, which commits once at the end
+
+        Returns: None
+
+        """
+        if self._in_unit_of_work:
+            self.psql_engine.session.flush()
+        else:
+            self.psql_engine.session.commit()
+
+    def get_student_context(self, lms_id) -> StudentContext:
+        """
+        Load a student's user, active enrollments and the ungraded enrollment_course_terms of all their enrollments
+        (with their course version chain) in a single query. The context is kept for the life of this object, so every
+        step of an event shares it.
+        Args:
+            lms_id: The student's canvas_id
+
+        Returns: The StudentContext object
+
+        Raises: UserNotFoundInDatabase if no user has the canvas_id
+        """
+        if lms_id in self._student_contexts:
+            return self._student_contexts[lms_id]
+
+        self.logger.debug(f"Loading student context with lms_id: {lms_id}")
+        session = self.psql_engine.session
+        active_status_ids = [
+            reference_data.get_id(session, EnrollmentStatus, status) for status in ACTIVE_ENROLLMENT_STATUSES
+        ]
+        rows = session.execute(
+            select(UserLms, Enrollment, EnrollmentCourseTerm)
+            .join(UserLms.user)
+            .outerjoin(Enrollment, Enrollment.ccc_id == User.ccc_id)
+            .outerjoin(
+                EnrollmentCourseTerm,
+                and_(
+                    EnrollmentCourseTerm.enrollment_id == Enrollment.id,
+                    EnrollmentCourseTerm.grade_status == GradeStatus("Not Graded"),
+                ),
+            )
+            .filter(UserLms.lms_id == lms_id, UserLms.lms == LMS("Canvas"))
+            .options(
+                contains_eager(UserLms.user).joinedload(User.learner_status),
+                joinedload(Enrollment.student).joinedload(Student.user).joinedload(User.learner_status),
+                joinedload(EnrollmentCourseTerm.course_version_section)
+                .joinedload(CourseVersionSection.program_version_course)
+                .joinedload(ProgramVersionCourse.course_version)
+                .joinedload(CourseVersion.course),
+            )
+        ).all()
+        if not rows:
+            self.logger.error(f"User with canvas_id {lms_id} not found in the database.")
+            raise UserNotFoundInDatabase(lms_id)
+
+        enrollments = list(
+            {
+                row.Enrollment.id: row.Enrollment
+                for row in rows
+                if row.Enrollment is not None and row.Enrollment.enrollment_status_id in active_status_ids
+            }.values()
+        )
+        course_terms = [row.EnrollmentCourseTerm for row in rows if row.EnrollmentCourseTerm is not None]
+
+        context = StudentContext(lms_id, rows[0].UserLms, enrollments, course_terms)
+        self._student_contexts[lms_id] = context
+        return context
+
+    def _get_cached_context(self, ccc_id):
+        for context in self._student_contexts.values():
+            if context.ccc_id == ccc_id:
+                return context
 
     def get_student(self, ccc_id):
         """
@@ -71,23 +294,12 @@ class PSQLServices:
         """
         self.logger.debug(f"Getting student enrollment with lms_id: {lms_id}")
         try:
-            data = self.psql_engine.session.execute(
-                select(Enrollment)
-                .join(Student, Enrollment.ccc_id == Student.ccc_id)
-                .join(User, Student.ccc_id == User.ccc_id)
-                .join(UserLms, User.id == UserLms.user_id)
-                .join(EnrollmentStatus, Enrollment.enrollment_status_id == EnrollmentStatus.id)
-                .filter(
-                    UserLms.lms_id == lms_id,
-                    UserLms.lms == "canvas",
-                    EnrollmentStatus.status.in_(["Enrolled", "Started"]),
-                )
-            ).scalar_one()
-            self.logger.debug(f"Fetched Enrollment: {data}")
-            return data
-        except NoResultFound:
+            data = self.get_student_context(lms_id).enrollment
+        except (UserNotFoundInDatabase, EnrollmentNotFoundInDatabase):
             self.logger.warn(f"Enrollment for user with lms_id {lms_id} not found in the database.")
             raise EnrollmentNotFoundInDatabase(lms_id)
+        self.logger.debug(f"Fetched Enrollment: {data}")
+        return data
 
     def get_assignment_by_canvas_id(
         self, canvas_id, lms_type: Literal["assignment", "discussion", "quiz"] = "assignment"
@@ -130,9 +342,10 @@ class PSQLServices:
     def update_object(self, db_object: Union[all_models]):
         try:
             self.psql_engine.session.add(db_object)
-            self.psql_engine.session.commit()
+            self.commit()
         except Exception as err:
-            self.psql_engine.session.rollback()
+            if not self._in_unit_of_work:
+                self.psql_engine.session.rollback()
             raise err
 
     def get_user_info_by_canvas_id(self, canvas_id, user_type: Literal["student", "staff"] = "student"):
@@ -145,6 +358,9 @@ class PSQLServices:
         Returns: A dictionary with the user's ccc_id/staff_id and email
         """
         self.logger.debug(f"Getting user info with canvas_id: {canvas_id}, user_type: {user_type}")
+        if user_type == "student":
+            context = self.get_student_context(canvas_id)
+            return {"ccc_id": context.ccc_id, "email": context.email}
         try:
             user_lms = self.psql_engine.session.execute(
                 select(UserLms).filter_by(lms_id=canvas_id, lms=LMS("Canvas"))
@@ -152,10 +368,47 @@ class PSQLServices:
         except NoResultFound:
             self.logger.error(f"User with canvas_id {canvas_id} not found in the database.")
             raise UserNotFoundInDatabase(canvas_id)
-        if user_type == "student":
-            return {"ccc_id": user_lms.user.ccc_id, "email": user_lms.user.calbright_email}
-        elif user_type == "staff":
-            return {"staff_id": user_lms.user.staff_id, "email": user_lms.user.calbright_email}
+        return {"staff_id": user_lms.user.staff_id, "email": user_lms.user.calbright_email}
+
+    def _current_course_term_query(self, ccc_id, course_id):
+        """
+        Build the query for the 'Not Graded' enrollment_course_term of a student for a course, joined through the course
+        version chain so the course is matched in the database rather than by walking relationships in Python
+        Args:
+            ccc_id: The student's ccc_id
+            course_id: The course's lms_id
+
+        Returns: The select statement
+
+        """
+        return (
+            select(EnrollmentCourseTerm)
+            .join(EnrollmentCourseTerm.enrollment)
+            .join(EnrollmentCourseTerm.course_version_section)
+            .join(CourseVersionSection.program_version_course)
+            .join(ProgramVersionCourse.course_version)
+            .filter(
+                Enrollment.ccc_id == ccc_id,
+                EnrollmentCourseTerm.grade_status == GradeStatus("Not Graded"),
+                CourseVersion.lms_id == course_id,
+            )
+        )
+
+    def _get_current_course_term(self, ccc_id, course_id):
+        """
+        Get the 'Not Graded' enrollment_course_term of a student for a course, from the student's context if it has
+        already been loaded for this event
+        Args:
+            ccc_id: The student's ccc_id
+            course_id: The course's lms_id
+
+        Returns: The enrollment_course_term object, or None if there is no matching course
+
+        """
+        context = self._get_cached_context(ccc_id)
+        if context is not None:
+            return context.get_course_term(course_id)
+        return self.psql_engine.session.execute(self._current_course_term_query(ccc_id, course_id)).scalars().first()
 
     def update_ect_progress(self, ccc_id, course_id, progress: float):
         """
@@ -173,28 +426,30 @@ class PSQLServices:
         #   future courses. This may need to be updated if that assumption is incorrect.
         self.logger.info(f"Updating ECT progress for ccc_id: {ccc_id}, course_id: {course_id}, progress: {progress}")
 
-        current_course_enrollments = (
-            self.psql_engine.session.execute(
-                select(EnrollmentCourseTerm)
-                .join(Enrollment, Enrollment.id == EnrollmentCourseTerm.enrollment_id)
-                .filter(Enrollment.ccc_id == ccc_id)
-                .filter(EnrollmentCourseTerm.grade_status == GradeStatus("Not Graded"))
-            )
-            .scalars()
-            .all()
+        context = self._get_cached_context(ccc_id)
+        if context is not None:
+            course = context.get_course_term(course_id)
+            if not course:
+                self.logger.error(f"No matching course enrollments found for ccc_id: {ccc_id}")
+                return False
+            self.logger.info(f"Updating progress for course: {course}")
+            course.progress = progress * 100
+            self.commit()
+            return True
+
+        # Without a loaded context, update the matching course in a single statement
+        course_term_ids = self._current_course_term_query(ccc_id, course_id).with_only_columns(EnrollmentCourseTerm.id)
+        result = self.psql_engine.session.execute(
+            update(EnrollmentCourseTerm)
+            .where(EnrollmentCourseTerm.id.in_(course_term_ids.scalar_subquery()))
+            .values(progress=progress * 100)
+            .execution_options(synchronize_session="fetch")
         )
-        self.logger.debug(f"Current course enrollments: {current_course_enrollments}")
-        if not current_course_enrollments:
+        self.commit()
+        if not result.rowcount:
             self.logger.error(f"No matching course enrollments found for ccc_id: {ccc_id}")
             return False
-        for course in current_course_enrollments:
-            self.logger.debug(f"Checking course enrollment: {course}")
-            if course.course_version_section.program_version_course.course_version.lms_id == course_id:
-                self.logger.info(f"Updating progress for course: {course}")
-                course.progress = progress * 100
-                self.psql_engine.session.commit()
-                return True
-        return False
+        return True
 
     def update_ect_final_grade(self, ccc_id, course_id, grade: Literal["P", "NP"], grade_timestamp, instructor_lms_id):
         """
@@ -218,34 +473,54 @@ class PSQLServices:
             raise InvalidFinalGrade(grade)
 
         # Get the grade object and the instructor object from the database
-        grade_object = self.psql_engine.session.execute(select(Grade).filter_by(grade=grade)).scalar_one()
+        grade_object = reference_data.get_instance(self.psql_engine.session, Grade, grade)
         instructor = self.get_user_info_by_canvas_id(instructor_lms_id, user_type="staff")
 
-        # Get the current course enrollments for the student
+        # Get the current course enrollment for the student
         # Note: this filters to only courses in 'not_graded' status and assumes that there is only 1 course in
         #   'not_graded' status (previous courses should all be graded, and there should be no future courses)
-        current_course_enrollments = (
-            self.psql_engine.session.execute(
-                select(EnrollmentCourseTerm)
-                .join(Enrollment, Enrollment.id == EnrollmentCourseTerm.enrollment_id)
-                .filter(Enrollment.ccc_id == ccc_id)
-                .filter(EnrollmentCourseTerm.grade_status == GradeStatus("Not Graded"))
-            )
-            .scalars()
-            .all()
-        )
-        self.logger.debug(f"Current course enrollments: {current_course_enrollments}")
-        for course in current_course_enrollments:
-            if course.course_version_section.program_version_course.course_version.lms_id == course_id:
-                self.logger.info(f"Updating final grade for course: {course}")
-                course.grade_status = GradeStatus("Submitted")
-                course.grade = grade_object
-                course.grade_date = grade_timestamp
-                course.instructor_id = instructor["staff_id"]
-                if grade == "P":
-                    course.progress = 100
-                self.psql_engine.session.commit()
-                return course
+        course = self._get_current_course_term(ccc_id, course_id)
+        if course:
+            self.logger.info(f"Updating final grade for course: {course}")
+            course.grade_status = GradeStatus("Submitted")
+            course.grade = grade_object
+            course.grade_date = grade_timestamp
+            course.instructor_id = instructor["staff_id"]
+            if grade == "P":
+                course.progress = 100
+            self.commit()
+            return course
+
+    def get_progress(self, lms_id: str, course_lms_id: str):
+        """
+        Get a student's program progress, their progress in a course and the course code in a single query
+        Args:
+            lms_id: The student's canvas_id
+            course_lms_id: The course's lms_id
+
+        Returns: A dictionary with the program progress, the course progress and the course code, for example:
+            {'program': {'competencies': 21, 'completed': 3, 'percentage': 0.14285714285714285},
+             'course': {'competencies': 7, 'completed': 3, 'percentage': 0.42857142857142855},
+             'course_code': 'BUS500'}
+            The program/course progress is None if the student has none
+
+        """
+        student_enrollment = self.get_student_enrollment(lms_id=lms_id)
+        result = self.psql_engine.session.execute(
+            PROGRESS_QUERY, {"enrollment_id": str(student_enrollment.id), "course_lms_id": str(course_lms_id)}
+        ).fetchone()
+        if result is None:
+            self.logger.error(f"Course with lms_id {course_lms_id} not found in the database.")
+            raise CourseNotFoundInDatabase(course_lms_id)
+
+        program_progress = course_progress = None
+        if result.program_progress:
+            values = list(result.program_progress.values())
+            program_progress = {"competencies": values[1], "completed": values[2], "percentage": float(values[3])}
+        if result.course_progress:
+            values = list(result.course_progress.values())
+            course_progress = {"competencies": values[2], "completed": values[3], "percentage": float(values[4])}
+        return {"program": program_progress, "course": course_progress, "course_code": result.course_code}
 
     def calculate_progress(
         self,
@@ -265,45 +540,34 @@ class PSQLServices:
         Returns: A dictionary with the number of competencies, the number of competencies passed, and the percentage,
             for example: {'competencies': 7, 'completed': 3, 'percentage': 0.42857142857142855}
         """
-        student_enrollment = self.get_student_enrollment(lms_id=lms_id)
-
         # TODO: can swap these views to SQLAlchemy views instead of raw SQL views...
         if progress_type == "program":
-            query = text(f"SELECT * FROM progress_by_enrollment WHERE enrollment_id = '{student_enrollment.id}'")
-            results = self.psql_engine.session.execute(query).fetchone()
+            student_enrollment = self.get_student_enrollment(lms_id=lms_id)
+            results = self.psql_engine.session.execute(
+                PROGRAM_PROGRESS_QUERY, {"enrollment_id": str(student_enrollment.id)}
+            ).fetchone()
             return {"competencies": results[1], "completed": results[2], "percentage": float(results[3])}
         elif progress_type == "course":
-            try:
-                course_version = self.psql_engine.session.execute(
-                    select(CourseVersion).filter_by(lms_id=course_lms_id)
-                ).scalar_one()
-            except NoResultFound:
-                self.logger.error(f"Course with lms_id {course_lms_id} not found in the database.")
-                raise CourseNotFoundInDatabase(course_lms_id)
-
-            query = text(
-                f"SELECT * FROM progress_by_course WHERE enrollment_id = '{student_enrollment.id}' "
-                f"AND course_id = '{course_version.course.id}'"
-            )
-            results = self.psql_engine.session.execute(query).fetchone()
-            return {"competencies": results[2], "completed": results[3], "percentage": float(results[4])}
+            return self.get_progress(lms_id=lms_id, course_lms_id=course_lms_id)["course"]
 
-    def update_program_progress(self, lms_id: str):
+    def update_program_progress(self, lms_id: str, program_progress: Union[dict, None] = None):
         """
         Update the program progress for a student in the database (enrollment table)
         Args:
             lms_id: The student's canvas_id
+            program_progress: The program progress if it has already been calculated, it is calculated if not given
 
         Returns: The program progress as a dictionary, or None
 
         """
         self.logger.info(f"Updating program progress for lms_id: {lms_id}")
         student_enrollment = self.get_student_enrollment(lms_id=lms_id)
-        program_progress = self.calculate_progress(lms_id=lms_id, progress_type="program")
+        if program_progress is None:
+            program_progress = self.calculate_progress(lms_id=lms_id, progress_type="program")
         if program_progress.get("percentage"):
             self.logger.info(f"Updating program progress to {program_progress.get('percentage')}")
             student_enrollment.progress = program_progress.get("percentage") * 100
-            self.psql_engine.session.commit()
+            self.commit()
             return program_progress
         self.logger.info("No program progress calculated")
 
@@ -338,12 +602,11 @@ class PSQLServices:
 
         """
         self.logger.info(f"Updating enrollment status for enrollment: {enrollment}")
-        enrollment.student.user.learner_status_id = self.psql_engine.session.execute(
-            select(LearnerStatus.id).filter_by(status="Started Program Pathway")
-        ).scalar_one()
-        enrollment.enrollment_status_id = self.psql_engine.session.execute(
-            select(EnrollmentStatus.id).filter_by(status="Started")
-        ).scalar_one()
+        session = self.psql_engine.session
+        enrollment.student.user.learner_status_id = reference_data.get_id(
+            session, LearnerStatus, "Started Program Pathway"
+        )
+        enrollment.enrollment_status_id = reference_data.get_id(session, EnrollmentStatus, "Started")
         if commit:
-            self.psql_engine.session.commit()
+            self.commit()
         return enrollment
@@ -0,0 +1,98 @@
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from propus.logging_utility import Logging
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_salesforce_pool():
+    """
+    Get the container's Salesforce thread pool, creating it on first use. The pool is only used when the
+    SALESFORCE_FANOUT_WORKERS environment variable is set to more than 0.
+
+    Returns: ThreadPoolExecutor: the pool, or None if Salesforce calls run inline
+
+    """
+    global _pool
+    workers = int(os.environ.get("SALESFORCE_FANOUT_WORKERS", 0))
+    if workers <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="salesforce")
+    return _pool
+
+
+class SalesforceFanOut:
+    """
+    Runs the Salesforce calls of one Canvas event on a small thread pool, so they overlap with the event's Postgres
+    work instead of adding their latency to it, and waits for them at the end of the event.
+
+    Without a pool the calls run inline as they are submitted, which is the default. Either way a failed call fails the
+    event: `wait` raises the first error once every call has finished. Result callbacks run on the thread calling
+    `wait`, so they can use the event's Postgres session.
+    """
+
+    def __init__(self, executor: ThreadPoolExecutor = None):
+        """
+        Initialize the fan-out for an event
+        Args:
+            executor: The thread pool to submit calls to, or None to run them inline
+        """
+        self.logger = Logging.get_logger(
+            "castor/lambda_functions/canvas_events/canvas_event_system/sf_fanout", debug=True
+        )
+        self.executor = executor
+        self._pending = []
+
+    @property
+    def concurrent(self):
+        return self.executor is not None
+
+    def submit(self, call, *args, on_result=None, **kwargs):
+        """
+        Run a Salesforce call, on the pool if there is one
+        Args:
+            call: The function to call
+            *args: The positional arguments of the call
+            on_result: A function called with the call's result when it succeeds, on the thread calling `wait`
+            **kwargs: The keyword arguments of the call
+
+        Returns: The call's result when it runs inline, otherwise None
+
+        """
+        if self.executor is None:
+            result = call(*args, **kwargs)
+            return on_result(result) if on_result is not None else result
+        # The call runs in a copy of the event's context, so it sees the batch's Salesforce write buffer
+        future = self.executor.submit(contextvars.copy_context().run, call, *args, **kwargs)
+        self._pending.append((future, on_result, getattr(call, "__name__", call)))
+
+    def wait(self, raise_errors: bool = True):
+        """
+        Wait for every submitted call to finish, and run the result callbacks of those that succeeded
+        Args:
+            raise_errors: Whether to raise the first error. When the event already failed, the errors are only logged
+                so they don't hide the original one
+
+        Returns: None
+
+        """
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        wait([future for future, _, _ in pending])
+        errors = []
+        for future, on_result, name in pending:
+            error = future.exception()
+            if error is not None:
+                self.logger.error(f"Salesforce call {name} failed: {error}")
+                errors.append(error)
+            elif on_result is not None:
+                on_result(future.result())
+        if errors and raise_errors:
+            raise errors[0]
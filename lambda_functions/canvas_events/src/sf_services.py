@@ -1,23 +1,72 @@
+import contextvars
 import datetime
+from contextlib import contextmanager
+
 from propus.logging_utility import Logging
 from propus.salesforce import Salesforce
 
+from common.sf_collections import update_records
+
+from src.activity_timestamps import MONOTONIC_CONTACT_FIELDS, ActivityTimestampStore
+from src.contact_cache import ContactCache
 from src.exceptions import InvalidFinalGrade
+from src.sf_fanout import SalesforceFanOut
+from src.sf_write_buffer import SFWriteBuffer
+
+# The contact fields read by the canvas events, fetched together and cached so each one doesn't need its own query
+CACHED_CONTACT_FIELDS = (
+    "Id",
+    "Course_1__c",
+    "Course_2__c",
+    "Course_3__c",
+    "Last_Strut_SAA_Timestamp__c",
+    "Last_Strut_Activity_Timestamp__c",
+)
+
+SF_METRICS_NAMESPACE = "Castor/CanvasEvents"
+
+contact_cache = ContactCache()
+activity_timestamps = ActivityTimestampStore()
+
+# The write buffer of the `buffer_writes` block being run. Context variables are per thread, so batches processed at
+# the same time in one process (the DLQ drain's workers) each have their own; the Salesforce fan-out copies the
+# context of the event into the calls it runs on its threads.
+_write_buffer = contextvars.ContextVar("sf_write_buffer", default=None)
 
 
 class SFServices:
     """
     This class provides methods to interact with Salesforce.
+
+    Contact updates are sent straight away, unless they are made inside `buffer_writes` or a write buffer is passed in,
+    in which case they are merged in a write-behind buffer and sent together by `flush_writes`.
     """
 
-    def __init__(self, sf_client: Salesforce):
+    def __init__(
+        self,
+        sf_client: Salesforce,
+        cache: ContactCache = contact_cache,
+        session=None,
+        timestamp_store: ActivityTimestampStore = activity_timestamps,
+        write_buffer: SFWriteBuffer = None,
+    ):
         """
         Initialize the Salesforce services object
         Args:
             sf_client: The Propus Salesforce object
+            cache: The contact cache, shared by every SFServices object in the container by default
+            session: The SQLAlchemy session of the event, used to keep the known contact timestamps. Without it, the
+                contact timestamps are read from Salesforce before they are written
+            timestamp_store: The known contact timestamps, shared by every SFServices object in the container by default
+            write_buffer: The write buffer to add contact updates to, defaults to the one of the `buffer_writes` block
+                being run, if any
         """
         self.logger = Logging.get_logger("castor/lambda_functions/canvas_events/src/sf_services", debug=True)
         self.sf_client = sf_client
+        self.contact_cache = cache
+        self.session = session
+        self.timestamp_store = timestamp_store
+        self._write_buffer = write_buffer
 
     def _convert_sf_datetime(self, sf_datetime: str):
         """
@@ -34,6 +83,131 @@ class SFServices:
         sf_datetime_adjusted = sf_datetime[:-2] + ":" + sf_datetime[-2:]
         return datetime.datetime.fromisoformat(sf_datetime_adjusted)
 
+    @staticmethod
+    def _as_queried_datetime(sf_datetime: str):
+        """
+        Convert a datetime string we wrote to Salesforce into the format Salesforce returns it in, so it can be cached
+        Args:
+            sf_datetime: The Salesforce datetime string we wrote, for example '2021-09-01T00:00:00.000Z'
+
+        Returns: str: The datetime string as Salesforce returns it, for example '2021-09-01T00:00:00.000+0000'
+
+        """
+        if sf_datetime.endswith("Z"):
+            return sf_datetime[:-1] + "+0000"
+        if sf_datetime[-3] == ":":
+            return sf_datetime[:-3] + sf_datetime[-2:]
+        return sf_datetime
+
+    def _get_contact(self, email: str = None, contact_id: str = None):
+        """
+        Get the cached contact fields for a contact by email or contact ID, querying Salesforce for all of them at once
+        on a cache miss
+        Args:
+            email: str: The Calbright email address of the contact
+            contact_id: str: The Salesforce contact ID
+
+        Returns: dict: The contact record with the CACHED_CONTACT_FIELDS, or None if the contact doesn't exist
+
+        """
+        record = self.contact_cache.get(email=email, contact_id=contact_id)
+        if record is not None:
+            return record
+
+        fields = ", ".join(CACHED_CONTACT_FIELDS)
+        if contact_id:
+            query = f"""SELECT {fields} FROM Contact WHERE Id = '{contact_id}'"""
+        else:
+            query = f"""SELECT {fields} FROM Contact WHERE cfg_Calbright_Email__c = '{email}' AND LMS__c ='Canvas'"""
+        response = self.sf_client.custom_query(query)
+        if response.get("totalSize") == 0:
+            return None
+        record = {field: response.get("records")[0].get(field) for field in CACHED_CONTACT_FIELDS}
+        self.contact_cache.put(record.get("Id"), record, email=email)
+        return record
+
+    @property
+    def write_buffer(self):
+        return self._write_buffer if self._write_buffer is not None else _write_buffer.get()
+
+    @staticmethod
+    @contextmanager
+    def buffer_writes():
+        """
+        Buffer the contact updates made by every SFServices object in the current context while the block runs. The
+        caller is responsible for sending them with `flush_writes` before the block ends.
+
+        Yields: SFWriteBuffer: the buffer holding the pending updates
+
+        """
+        buffer = SFWriteBuffer()
+        token = _write_buffer.set(buffer)
+        try:
+            yield buffer
+        finally:
+            _write_buffer.reset(token)
+
+    def _send_contact_collection(self, records: list):
+        """
+        Send contact updates to Salesforce with sObject Collections requests of up to 200 records
+        Args:
+            records: list: sObject Collection records
+
+        Returns: dict: contact ID > list of errors, empty for contacts that were updated
+
+        """
+        return update_records(self.sf_client, records, namespace=SF_METRICS_NAMESPACE, logger=self.logger)
+
+    def flush_writes(self, buffer: SFWriteBuffer):
+        """
+        Send every update in a write buffer to Salesforce. Contacts that fail to update are dropped from the contact
+        cache, since the cache already holds the values that weren't written.
+        Args:
+            buffer: SFWriteBuffer: The buffer to flush
+
+        Returns: dict: the flush results, see SFWriteBuffer.flush
+
+        """
+        self.logger.info(f"Flushing buffered Salesforce updates for {len(buffer)} contacts")
+        results = buffer.flush(self._send_contact_collection)
+        for contact_id, errors in results["failed"].items():
+            self.logger.error(f"Failed to update Salesforce contact {contact_id}: {errors}")
+            self.contact_cache.invalidate(contact_id)
+        if results["failed"] and self.session is not None:
+            # The known timestamps of these contacts were saved with their events, but Salesforce doesn't have them
+            try:
+                self.timestamp_store.forget_contacts(self.session, list(results["failed"]))
+                self.session.commit()
+            except Exception as err:
+                self.logger.warning(f"Unable to drop the known timestamps of failed contacts: {err}")
+                self.session.rollback()
+        return results
+
+    def _update_contact(self, contact_id: str, event_timestamp: datetime.datetime = None, **fields):
+        """
+        Update a contact record in Salesforce, or add the update to the write buffer if writes are being buffered, and
+        apply the written fields to the contact cache
+        Args:
+            contact_id: str: The Salesforce contact ID
+            event_timestamp: datetime.datetime: The time of the event that produced the update
+            **fields: The fields to update
+
+        Returns: None
+
+        """
+        write_buffer = self.write_buffer
+        if write_buffer is not None:
+            write_buffer.add(contact_id, event_timestamp, **fields)
+        else:
+            self.sf_client.update_contact_record(salesforce_id=contact_id, **fields)
+        self.contact_cache.update_fields(
+            contact_id,
+            **{
+                field: self._as_queried_datetime(value) if field.endswith("_Timestamp__c") else value
+                for field, value in fields.items()
+            },
+        )
+
     def get_contact_id(self, email: str):
         """
         Get the Salesforce contact ID for a given email address
@@ -44,9 +218,8 @@ class SFServices:
 
         """
         self.logger.debug(f"Getting Salesforce contact ID for {email}")
-        query = f"""SELECT id FROM Contact WHERE cfg_Calbright_Email__c = '{email}' AND LMS__c ='Canvas'"""
-        response = self.sf_client.custom_query(query)
-        return None if response.get("totalSize") == 0 else response.get("records")[0].get("Id")
+        contact = self._get_contact(email=email)
+        return contact.get("Id") if contact else None
 
     def get_contact_field(self, email: str, sf_field: str):
         """
@@ -69,6 +242,9 @@ class SFServices:
         # return None
         # TODO: verify this works after updating...
         self.logger.debug(f"Getting {sf_field} for {email}")
+        if sf_field in CACHED_CONTACT_FIELDS:
+            contact = self._get_contact(email=email)
+            return self._convert_sf_datetime(contact.get(sf_field)) if contact else None
         query = f"""SELECT {sf_field} FROM Contact WHERE cfg_Calbright_Email__c = '{email}' AND LMS__c ='Canvas'"""
         response = self.sf_client.custom_query(query)
         if response.get("totalSize") != 0:
@@ -103,7 +279,7 @@ class SFServices:
         if not contact_id:
             return False
         formatted_date = self.convert_event_timestamp_to_sf_datetime(timestamp)
-        self.sf_client.update_contact_record(salesforce_id=contact_id, Last_Strut_SAA_Timestamp__c=formatted_date)
+        self._update_contact(contact_id, timestamp, Last_Strut_SAA_Timestamp__c=formatted_date)
         return True
 
     def get_courses(self, contact_id: str):
@@ -116,25 +292,27 @@ class SFServices:
             the course code as the value. For example, {1: 'BUS500', 2: 'BUS501', 3: None}
         """
         self.logger.debug(f"Getting courses for {contact_id}")
-        query = f"""SELECT Course_1__c, Course_2__c, Course_3__c FROM Contact WHERE Id = '{contact_id}'"""
-        response = self.sf_client.custom_query(query)
+        contact = self._get_contact(contact_id=contact_id)
         return (
             {
-                1: response.get("records")[0].get("Course_1__c"),
-                2: response.get("records")[0].get("Course_2__c"),
-                3: response.get("records")[0].get("Course_3__c"),
+                1: contact.get("Course_1__c"),
+                2: contact.get("Course_2__c"),
+                3: contact.get("Course_3__c"),
             }
-            if response.get("totalSize") != 0
+            if contact
             else None
         )
 
-    def update_course_progress(self, email: str, course_code: str, progress: float):
+    def update_course_progress(
+        self, email: str, course_code: str, progress: float, event_timestamp: datetime.datetime = None
+    ):
         """
         This function updates the course progress in Salesforce for a given course code and student.
         Args:
             email: str: the email address of the student
             course_code: str: The course code of the course, for example 'BUS500' or 'BUS501'
             progress: float: The progress of the student in the course, for example 0.5 for 50%
+            event_timestamp: datetime.datetime: The time of the event that changed the progress
 
         Returns: bool: True if the course progress was updated successfully, False otherwise
         """
@@ -146,16 +324,17 @@ class SFServices:
                 course_field = f"Course_{k}_Progress__c"
                 formatted_progress = int(progress * 100)
                 self.logger.info(f"Updating course progress for {email} in {course_code} to {progress}")
-                self.sf_client.update_contact_record(salesforce_id=contact_id, **{course_field: formatted_progress})
+                self._update_contact(contact_id, event_timestamp, **{course_field: formatted_progress})
                 return True
         return False
 
-    def update_course_completed(self, email: str, course_code: str):
+    def update_course_completed(self, email: str, course_code: str, event_timestamp: datetime.datetime = None):
         """
         This function updates the course completion status in Salesforce for a given course code and student.
         Args:
             email: str: the email address of the student
             course_code: str: The course code of the course, for example 'BUS500' or 'BUS501'
+            event_timestamp: datetime.datetime: The time of the event that completed the course
 
         Returns: bool: True if the course completion status was updated successfully, False otherwise
 
@@ -168,33 +347,94 @@ class SFServices:
             if v == course_code:
                 course_field = f"Completed_Course_{k}__c"
                 self.logger.debug(f"Updating course completion status for {email} in {course_code} | {course_field}")
-                self.sf_client.update_contact_record(salesforce_id=contact_id, **{course_field: True})
+                self._update_contact(contact_id, event_timestamp, **{course_field: True})
                 return True
         return False
 
+    def advance_contact_timestamp(
+        self, email: str, sf_field: str, timestamp: datetime.datetime, fanout: SalesforceFanOut = None
+    ):
+        """
+        Write a monotonic contact timestamp to Salesforce if the timestamp is newer than the value Salesforce holds.
+        When the value is known from the timestamp store, an older or equal timestamp costs no Salesforce call and a
+        newer one is written without reading the contact first. Otherwise the contact is read, and the value it holds
+        is added to the store.
+        Args:
+            email: str: The Calbright email address of the contact
+            sf_field: str: The Salesforce field, one of MONOTONIC_CONTACT_FIELDS
+            timestamp: datetime.datetime: The timestamp of the event
+            fanout: SalesforceFanOut: The event's Salesforce fan-out. When it runs calls concurrently, the Salesforce
+                calls are submitted to it, and the store is updated on this thread once they are done
+
+        Returns: bool: True if the timestamp was written (or submitted to be), False if Salesforce already had a value
+            as new, None if the contact doesn't exist
+
+        """
+        if sf_field not in MONOTONIC_CONTACT_FIELDS:
+            raise ValueError(f"{sf_field} is not a monotonic contact field")
+        known = self.timestamp_store.get(self.session, email, sf_field) if self.session is not None else None
+        if known is not None and timestamp <= known[1]:
+            self.logger.debug(f"{sf_field} for {email} is already at {known[1]}")
+            return False
+
+        def remember(outcome):
+            return self._remember_contact_timestamp(email, sf_field, outcome)
+
+        if fanout is not None and fanout.concurrent:
+            fanout.submit(self._write_contact_timestamp, email, sf_field, timestamp, known, on_result=remember)
+            return True
+        return remember(self._write_contact_timestamp(email, sf_field, timestamp, known))
+
+    def _write_contact_timestamp(self, email: str, sf_field: str, timestamp: datetime.datetime, known: tuple = None):
+        """
+        The Salesforce side of `advance_contact_timestamp`. It doesn't use the Postgres session, so it can run on a
+        fan-out thread.
+        Args:
+            email: str: The Calbright email address of the contact
+            sf_field: str: The Salesforce field
+            timestamp: datetime.datetime: The timestamp of the event
+            known: tuple: The (contact ID, value) known from the timestamp store, if any
+
+        Returns: tuple: (True if written / False if Salesforce had a value as new / None if the contact doesn't exist,
+            the contact ID, the value Salesforce now holds)
+
+        """
+        if known is not None:
+            contact_id = known[0]
+        else:
+            contact_id = self.get_contact_id(email)
+            if not contact_id:
+                return None, None, None
+            current_timestamp = self.get_contact_field(email=email, sf_field=sf_field)
+            if current_timestamp is not None and timestamp <= current_timestamp:
+                return False, contact_id, current_timestamp
+
+        self.logger.info(f"Updating {sf_field} for {email} to {timestamp}")
+        formatted_date = self.convert_event_timestamp_to_sf_datetime(timestamp)
+        self._update_contact(contact_id, timestamp, **{sf_field: formatted_date})
+        return True, contact_id, timestamp
+
+    def _remember_contact_timestamp(self, email: str, sf_field: str, outcome: tuple):
+        written, contact_id, value = outcome
+        if contact_id and self.session is not None:
+            self.timestamp_store.advance(self.session, email, sf_field, contact_id, value)
+        return written
+
     def update_last_lms_timestamp(self, email: str, timestamp: datetime.datetime):
         """
-        Update the Last_LMS_Timestamp__c for a given email address
+        Update the Last_Strut_Activity_Timestamp__c for a given email address, if the timestamp is newer
         Args:
             email: str: The Calbright email address of the contact
             timestamp: datetime.datetime: The timestamp to update
 
-        Returns: bool: True if the timestamp was updated successfully, False otherwise
+        Returns: bool: True if the contact exists, False otherwise
 
         """
         self.logger.debug(f"Checking Last_Strut_Activity_Timestamp__c for {email} to {timestamp}")
-        contact_id = self.get_contact_id(email)
-        formatted_date = self.convert_event_timestamp_to_sf_datetime(timestamp)
-
-        if contact_id:
-            last_lms_timestamp = self.get_contact_field(email=email, sf_field="Last_Strut_Activity_Timestamp__c")
-            if last_lms_timestamp is None or timestamp > last_lms_timestamp:
-                self.logger.info(f"Updating Last_Strut_Activity_Timestamp__c for {email} to {timestamp}")
-                self.sf_client.update_contact_record(
-                    salesforce_id=contact_id, Last_Strut_Activity_Timestamp__c=formatted_date
-                )
-            return True
-        return False
+        written = self.advance_contact_timestamp(
+            email=email, sf_field="Last_Strut_Activity_Timestamp__c", timestamp=timestamp
+        )
+        return written is not None
 
     def update_eotg(self, grade_id, grade, grade_timestamp):
         """
@@ -221,17 +461,18 @@ class SFServices:
         )
         return True
 
-    def update_learner_status(self, email, status):
+    def update_learner_status(self, email, status, event_timestamp=None):
         """
         Update the learner status on Salesforce.
         Args:
             email (str): The email address of the learner
             status (str): The status to update
+            event_timestamp (datetime): The time of the event that changed the status
 
         Returns:
             None
         """
         self.logger.info(f"Updating Salesforce learner status for {email} to {status}")
         contact_id = self.get_contact_id(email)
-        self.sf_client.update_contact_record(salesforce_id=contact_id, cfg_Learner_Status__c=status)
+        self._update_contact(contact_id, event_timestamp, cfg_Learner_Status__c=status)
         return True
@@ -0,0 +1,104 @@
+import datetime
+import threading
+
+
+class SFWriteBuffer:
+    """
+    A write-behind buffer for Salesforce contact updates. Field updates are merged per contact during a batch, using
+    last-writer-wins by event timestamp, and are flushed together at the end of the batch instead of sending one PATCH
+    per change.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._message_ids = {}
+        self._current_message_ids = []
+        # Salesforce calls fanned out to a thread pool add to the buffer
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def track(self, message_ids: list):
+        """
+        Set the SQS message IDs that following updates belong to, so a failed write can be reported against them
+        Args:
+            message_ids: The SQS message IDs of the event being processed
+
+        Returns: None
+
+        """
+        self._current_message_ids = list(message_ids)
+
+    def add(self, contact_id: str, event_timestamp: datetime.datetime = None, **fields):
+        """
+        Merge field updates for a contact into the buffer. A field keeps the value from the latest event timestamp;
+        when either update has no timestamp, or the timestamps are equal, the update added last wins.
+        Args:
+            contact_id: The Salesforce contact ID
+            event_timestamp: The time of the event that produced the update
+            **fields: The fields to update
+
+        Returns: None
+
+        """
+        with self._lock:
+            contact_fields = self._pending.setdefault(contact_id, {})
+            for field, value in fields.items():
+                existing = contact_fields.get(field)
+                if (
+                    existing is None
+                    or event_timestamp is None
+                    or existing["event_timestamp"] is None
+                    or event_timestamp >= existing["event_timestamp"]
+                ):
+                    contact_fields[field] = {"value": value, "event_timestamp": event_timestamp}
+            self._message_ids.setdefault(contact_id, set()).update(self._current_message_ids)
+
+    def pending_records(self):
+        """
+        Get the merged updates as sObject Collection records
+
+        Returns: list: A record per contact, for example
+            [{"attributes": {"type": "Contact"}, "id": "0035G00001m2W8oQAE", "Course_1_Progress__c": 50}]
+
+        """
+        return [
+            {"attributes": {"type": "Contact"}, "id": contact_id}
+            | {field: update["value"] for field, update in contact_fields.items()}
+            for contact_id, contact_fields in self._pending.items()
+        ]
+
+    def flush(self, send_records):
+        """
+        Send every pending update and empty the buffer.
+        Args:
+            send_records: A function that takes the list of sObject Collection records and returns contact ID > list of
+                errors, empty for contacts that were updated, see common.sf_collections.update_records
+
+        Returns: dict: with the keys 'updated' (contact IDs written), 'failed' (contact ID > errors) and
+            'failed_message_ids' (the SQS message IDs whose updates were not written)
+
+        """
+        records = self.pending_records()
+        message_ids = self._message_ids
+        self._pending = {}
+        self._message_ids = {}
+
+        try:
+            errors = send_records(records) if records else {}
+        except Exception as err:
+            errors = {record["id"]: [str(err)] for record in records}
+
+        results = {"updated": [], "failed": {}, "failed_message_ids": []}
+        for record in records:
+            # a record without a result wasn't written
+            record_errors = errors.get(record["id"], ["no result returned"])
+            if record_errors:
+                results["failed"][record["id"]] = record_errors
+            else:
+                results["updated"].append(record["id"])
+
+        for contact_id in results["failed"]:
+            results["failed_message_ids"].extend(sorted(message_ids.get(contact_id, [])))
+        return results
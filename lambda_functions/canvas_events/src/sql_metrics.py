@@ -0,0 +1,5 @@
+from common.sql_metrics import SQLMetrics, statement_shape  # noqa: F401
+
+SQL_METRICS_NAMESPACE = "Castor/CanvasEvents"
+
+sql_metrics = SQLMetrics(SQL_METRICS_NAMESPACE, logger_name="castor/lambda_functions/canvas_events/sql_metrics")
@@ -0,0 +1,196 @@
+import json
+from collections import Counter, defaultdict
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from propus.logging_utility import Logging
+
+# The errors a Canvas API request is expected to fail with: connection errors, timeouts and HTTP errors are all
+# OSErrors, and a response that isn't JSON is a ValueError
+CANVAS_API_ERRORS = (OSError, ValueError)
+CANVAS_API_TIMEOUT_SECONDS = 10
+SUBMISSIONS_PAGE_SIZE = 100
+
+
+def _next_page(link_header: str):
+    """
+    Get the next page's URL from a Canvas Link header, see https://canvas.instructure.com/doc/api/file.pagination.html
+    Args:
+        link_header: The Link response header
+
+    Returns: The URL of the next page, or None on the last page
+
+    """
+    for link in (link_header or "").split(","):
+        url, _, params = link.partition(";")
+        if 'rel="next"' in params:
+            return url.strip().strip("<>")
+    return None
+
+
+def list_course_submissions(canvas_engine, course_id: str, student_ids: list, assignment_ids: list):
+    """
+    Get the submissions, including their submission_history, of many students for many assignments of a course with
+    GET /api/v1/courses/:course_id/students/submissions, following the pages of the response
+    Args:
+        canvas_engine: The Propus Canvas object, whose base_url and application_key the request is sent with
+        course_id: The Canvas course id
+        student_ids: The Canvas user ids
+        assignment_ids: The Canvas assignment ids
+
+    Returns: list: the submissions of every page
+
+    """
+    params = (
+        [("student_ids[]", student_id) for student_id in student_ids]
+        + [("assignment_ids[]", assignment_id) for assignment_id in assignment_ids]
+        + [("include[]", "submission_history"), ("per_page", SUBMISSIONS_PAGE_SIZE)]
+    )
+    api_url = canvas_engine.base_url.rstrip("/")
+    if not api_url.endswith("/api/v1"):
+        api_url = f"{api_url}/api/v1"
+    url = f"{api_url}/courses/{course_id}/students/submissions?{urlencode(params)}"
+    headers = {"Authorization": f"Bearer {canvas_engine.application_key}", "Accept": "application/json"}
+
+    submissions = []
+    while url:
+        with urlopen(Request(url, headers=headers), timeout=CANVAS_API_TIMEOUT_SECONDS) as response:
+            submissions.extend(json.load(response))
+            url = _next_page(response.headers.get("Link"))
+    return submissions
+
+
+def get_first_attempt(submission: dict):
+    """
+    Get the first attempt from a Canvas submission's history
+    Args:
+        submission: The Canvas submission, including its submission_history
+
+    Returns: The first attempt if it exists, otherwise None
+
+    """
+    history = (submission or {}).get("submission_history") or []
+    for attempt in history:
+        if attempt.get("attempt") == 1:
+            return attempt
+    # TODO: There is something happening with skillways where it's wiping out the first attempt.
+    #   SO here I'm gonna re-loop through it and just grab ANY attempt that exists if we don't have an attempt 1
+    #   we could also refactor to look through and grab the lowest attempt...
+    for attempt in history:
+        return attempt
+
+
+class SubmissionHistoryCache:
+    """
+    A per-invocation cache of Canvas submission histories. Grading a whole assignment sends a grade_change event for
+    every student, and each one whose submission isn't in the database needs the submission history from the REST API.
+
+    At the start of a batch the CanvasEventSystem registers the (course, assignment, user) of every grade_change event.
+    The first lookup for a course with more than one registered event pulls the submissions of the batch's users for
+    all of that course's registered assignments in one paginated request, and later lookups are served from the cache.
+    Lookups that aren't covered fall back to the single submission request. Prefetches that fail are logged and counted
+    in `stats`.
+
+    The cache lives at module level in canvas_services and is reset for every batch.
+    """
+
+    def __init__(self):
+        self.logger = Logging.get_logger(
+            "castor/lambda_functions/canvas_events/canvas_event_system/submission_history", debug=True
+        )
+        self.hits = 0
+        self.misses = 0
+        self.prefetch_failures = 0
+        self._registered = defaultdict(Counter)
+        self._users = defaultdict(set)
+        self._fetched_courses = set()
+        self._submissions = {}
+
+    def reset(self):
+        """
+        Empty the cache and the registered lookups, at the start of an invocation
+
+        Returns: None
+
+        """
+        self._registered.clear()
+        self._users.clear()
+        self._fetched_courses.clear()
+        self._submissions.clear()
+        self.hits = 0
+        self.misses = 0
+        self.prefetch_failures = 0
+
+    def register(self, course_id: str, assignment_id: str, user_id: str):
+        """
+        Register a lookup the batch may need
+        Args:
+            course_id: The Canvas course id, as it will be passed to `get`
+            assignment_id: The Canvas assignment id
+            user_id: The Canvas user id
+
+        Returns: None
+
+        """
+        if course_id and assignment_id and user_id:
+            self._registered[str(course_id)][str(assignment_id)] += 1
+            self._users[str(course_id)].add(str(user_id))
+
+    def _should_prefetch(self, course_id):
+        return course_id not in self._fetched_courses and sum(self._registered[course_id].values()) > 1
+
+    def _prefetch(self, canvas_engine, course_id):
+        self._fetched_courses.add(course_id)
+        assignment_ids = sorted(self._registered[course_id])
+        student_ids = sorted(self._users[course_id])
+        self.logger.info(
+            f"Prefetching submission histories of {len(student_ids)} students for assignments {assignment_ids} in "
+            f"course {course_id}"
+        )
+        try:
+            submissions = list_course_submissions(canvas_engine, course_id, student_ids, assignment_ids)
+        except CANVAS_API_ERRORS as err:
+            # The single submission lookups still work, so a failed prefetch only costs the requests it would save
+            self.prefetch_failures += 1
+            self.logger.warning(f"Unable to prefetch submission histories for course {course_id}: {err}")
+            return
+        for submission in submissions or []:
+            key = (course_id, str(submission.get("assignment_id")), str(submission.get("user_id")))
+            self._submissions[key] = submission
+
+    def get(self, canvas_engine, course_id: str, assignment_id: str, user_id: str):
+        """
+        Get a user's submission for an assignment from the cache, prefetching the course's registered assignments first
+        if they haven't been
+        Args:
+            canvas_engine: The Propus Canvas object
+            course_id: The Canvas course id
+            assignment_id: The Canvas assignment id
+            user_id: The Canvas user id
+
+        Returns: The submission including its submission_history, or None if it isn't cached
+
+        """
+        course_id = str(course_id)
+        if self._should_prefetch(course_id):
+            self._prefetch(canvas_engine, course_id)
+        submission = self._submissions.get((course_id, str(assignment_id), str(user_id)))
+        if submission is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return submission
+
+    def stats(self):
+        """
+        Get the cache counters
+
+        Returns: dict: the number of hits, misses, cached submissions and prefetches that couldn't be made
+
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._submissions),
+            "prefetch_failures": self.prefetch_failures,
+        }
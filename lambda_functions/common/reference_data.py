@@ -0,0 +1,118 @@
+import threading
+import time
+
+from sqlalchemy import inspect, select
+from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import make_transient_to_detached
+
+REFERENCE_DATA_REFRESH_SECONDS = 3600
+
+
+class ReferenceDataCache:
+    """
+    A per-container cache of small lookup tables (grades, learner statuses, enrollment statuses...) that almost never
+    change. Every table is loaded with one query per table the first time it is needed and reloaded after the refresh
+    interval, so looking up a row by name doesn't cost a round trip.
+
+    Rows are kept detached from any session. `get_instance` merges them into the caller's session without loading, so
+    they can be assigned to relationships like a freshly queried row. A name that is still missing after a reload is
+    remembered until the next refresh, so repeated lookups of an unknown name don't reload every table each time.
+    """
+
+    def __init__(self, lookup_columns: dict, refresh_seconds: int = REFERENCE_DATA_REFRESH_SECONDS):
+        """
+        Initialize the reference data cache
+        Args:
+            lookup_columns: The model > name of the column rows are looked up by, for example {Grade: "grade"}
+            refresh_seconds: How long the tables are used before they are loaded again
+        """
+        self.lookup_columns = lookup_columns
+        self.refresh_seconds = refresh_seconds
+        self._rows = {}
+        self._missing = set()
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def _is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at >= self.refresh_seconds
+
+    def load(self, session):
+        """
+        Load every lookup table from the database, replacing the cached rows and forgetting missing names
+        Args:
+            session: The SQLAlchemy session to query with
+
+        Returns: None
+
+        """
+        with self._lock:
+            self._load(session)
+
+    def _load(self, session):
+        rows = {}
+        for model, column in self.lookup_columns.items():
+            column_keys = [attribute.key for attribute in inspect(model).column_attrs]
+            rows[model] = {}
+            for row in session.execute(select(model)).scalars().all():
+                detached = model(**{key: getattr(row, key) for key in column_keys})
+                make_transient_to_detached(detached)
+                rows[model][getattr(row, column)] = detached
+        self._rows = rows
+        self._missing = set()
+        self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        """
+        Force the tables to be loaded again on the next lookup
+
+        Returns: None
+
+        """
+        self._loaded_at = None
+
+    def _get_row(self, session, model, name):
+        if self._is_stale():
+            with self._lock:
+                # Another thread may have loaded the tables while this one waited for the lock
+                if self._is_stale():
+                    self._load(session)
+        row = self._rows.get(model, {}).get(name)
+        if row is None and (model, name) not in self._missing:
+            # The row may have been added since the tables were loaded, so reload once before giving up
+            with self._lock:
+                if (model, name) not in self._missing:
+                    self._load(session)
+                    row = self._rows.get(model, {}).get(name)
+                    if row is None:
+                        self._missing.add((model, name))
+        if row is None:
+            raise NoResultFound(f"No {model.__name__} row found for {self.lookup_columns[model]} = {name!r}")
+        return row
+
+    def get_id(self, session, model, name):
+        """
+        Get the ID of a lookup table row by name
+        Args:
+            session: The SQLAlchemy session to query with if the tables need to be loaded
+            model: The lookup table model, for example LearnerStatus
+            name: The value of the lookup column, for example "Started Program Pathway"
+
+        Returns: The ID of the row
+
+        Raises: NoResultFound if there is no row with that name
+        """
+        return self._get_row(session, model, name).id
+
+    def get_instance(self, session, model, name):
+        """
+        Get a lookup table row by name, merged into the session without a round trip
+        Args:
+            session: The SQLAlchemy session to merge the row into
+            model: The lookup table model, for example Grade
+            name: The value of the lookup column, for example "P"
+
+        Returns: The row, attached to the session
+
+        Raises: NoResultFound if there is no row with that name
+        """
+        return session.merge(self._get_row(session, model, name), load=False)
@@ -0,0 +1,99 @@
+import json
+import time
+
+# sObject Collections requests take at most 200 records
+SF_COLLECTION_SIZE = 200
+SF_COLLECTION_FALLBACK_METRIC = "SalesforceCollectionFallback"
+
+
+def update_sobject_collection(sf_client, records: list):
+    """
+    Update up to SF_COLLECTION_SIZE records with one sObject Collections request (PATCH composite/sobjects), without
+    all-or-none, so one bad record doesn't fail the others
+    Args:
+        sf_client: The Propus Salesforce object, whose authenticated REST `session` and `base_url` are used
+        records: The sObject Collection records, for example
+            [{"attributes": {"type": "Contact"}, "id": "0035G00001m2W8oQAE", "Course_1_Progress__c": 50}]
+
+    Returns: list: the per-record results in the order of the records, for example
+        [{"id": "0035G00001m2W8oQAE", "success": True, "errors": []}]
+
+    """
+    response = sf_client.session.patch(
+        f"{sf_client.base_url.rstrip('/')}/composite/sobjects", json={"allOrNone": False, "records": records}
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def emit_collection_fallback(namespace: str, count: int):
+    """
+    Count records sent one PATCH at a time instead of with sObject Collections, as a CloudWatch Embedded Metric Format
+    line
+    Args:
+        namespace: The CloudWatch metric namespace
+        count: The number of records
+
+    Returns: None
+
+    """
+    line = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": namespace,
+                    "Dimensions": [[]],
+                    "Metrics": [{"Name": SF_COLLECTION_FALLBACK_METRIC, "Unit": "Count"}],
+                }
+            ],
+        },
+        SF_COLLECTION_FALLBACK_METRIC: count,
+    }
+    # EMF lines have to be written to stdout as they are, CloudWatch extracts the metrics from them
+    print(json.dumps(line))
+
+
+def _update_one_at_a_time(sf_client, records: list):
+    errors = {}
+    for record in records:
+        fields = {field: value for field, value in record.items() if field not in ("attributes", "id")}
+        try:
+            sf_client.update_contact_record(salesforce_id=record["id"], **fields)
+            errors[record["id"]] = []
+        except Exception as err:
+            errors[record["id"]] = [str(err)]
+    return errors
+
+
+def update_records(sf_client, records: list, namespace: str, logger):
+    """
+    Update any number of contact records, SF_COLLECTION_SIZE at a time with sObject Collections requests. When a
+    request fails as a whole the records in it are sent one PATCH at a time instead, which is logged and counted in the
+    SalesforceCollectionFallback metric.
+    Args:
+        sf_client: The Propus Salesforce object
+        records: The sObject Collection records
+        namespace: The CloudWatch metric namespace the fallback is counted in
+        logger: The logger the fallback is logged to
+
+    Returns: dict: record ID > list of errors, empty for records that were updated
+
+    """
+    errors = {}
+    for start in range(0, len(records), SF_COLLECTION_SIZE):
+        chunk = records[start : start + SF_COLLECTION_SIZE]
+        try:
+            results = update_sobject_collection(sf_client, chunk)
+        except Exception as err:
+            logger.warning(f"sObject Collections request for {len(chunk)} records failed, sending one by one: {err}")
+            emit_collection_fallback(namespace, len(chunk))
+            errors.update(_update_one_at_a_time(sf_client, chunk))
+            continue
+
+        # results come back in the order of the records, a record without one wasn't written
+        results = list(results or [])
+        for index, record in enumerate(chunk):
+            result = results[index] if index < len(results) else {"errors": ["no result returned"]}
+            errors[record["id"]] = [] if result.get("success") else (result.get("errors") or ["unknown error"])
+    return errors
@@ -0,0 +1,240 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from propus.logging_utility import Logging
+
+SQL_METRICS_LOGGER = "castor/lambda_functions/sql_metrics"
+N_PLUS_ONE_THRESHOLD = 5
+EVENT_STEP = "event"
+
+STRING_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL_PATTERN = re.compile(r"\b\d+(?:\.\d+)?\b")
+IN_LIST_PATTERN = re.compile(r"\bIN\s*\((?:\s*[^()\s,]+\s*,)*\s*[^()\s,]+\s*\)", re.IGNORECASE)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def statement_shape(statement: str):
+    """
+    Reduce a SQL statement to its shape, so the same query run with different values counts as one statement
+    Args:
+        statement: The SQL statement
+
+    Returns: str: the statement with literals and IN lists replaced and whitespace collapsed
+
+    """
+    shape = STRING_LITERAL_PATTERN.sub("?", statement)
+    shape = NUMBER_LITERAL_PATTERN.sub("?", shape)
+    shape = IN_LIST_PATTERN.sub("IN (?)", shape)
+    return WHITESPACE_PATTERN.sub(" ", shape).strip()
+
+
+class SQLMetrics:
+    """
+    Opt-in SQL instrumentation. When enabled (SQL_METRICS=true), the cursor events of the Calbright engine are hooked to
+    count the SQL statements and time spent in the database. Both are attributed to the event type being processed and
+    to the handler step running at the time.
+
+    At the end of every event one CloudWatch Embedded Metric Format line is logged per step, plus one for the whole
+    event. Statement shapes repeated more than `n_plus_one_threshold` times within an event are flagged as N+1 patterns.
+
+    State is kept per thread, so workers processing events concurrently don't mix their metrics. When disabled,
+    `event` and `step` do nothing.
+
+    Shared by the Lambdas, each of which keeps its own instance under its own namespace and logger.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        logger_name: str = SQL_METRICS_LOGGER,
+        n_plus_one_threshold: int = None,
+        enabled: bool = None,
+    ):
+        """
+        Initialize the SQL metrics
+        Args:
+            namespace: The CloudWatch metric namespace, for example 'Castor/CanvasEvents'
+            logger_name: The name of the logger N+1 warnings are logged to
+            n_plus_one_threshold: How many times a statement shape may run in one event before it is flagged, defaults
+                to SQL_METRICS_N_PLUS_ONE_THRESHOLD or 5
+            enabled: Whether to collect metrics, defaults to the SQL_METRICS environment variable
+        """
+        self.logger = Logging.get_logger(logger_name, debug=True)
+        self.namespace = namespace
+        if n_plus_one_threshold is None:
+            n_plus_one_threshold = int(os.environ.get("SQL_METRICS_N_PLUS_ONE_THRESHOLD", N_PLUS_ONE_THRESHOLD))
+        self.n_plus_one_threshold = n_plus_one_threshold
+        if enabled is None:
+            enabled = os.environ.get("SQL_METRICS", "").lower() in ("1", "true", "yes")
+        self.enabled = enabled
+        self._instrumented = set()
+        self._local = threading.local()
+
+    def instrument(self, psql_engine):
+        """
+        Hook the cursor events of an engine, once per engine. Does nothing if the metrics are disabled.
+        Args:
+            psql_engine: The Propus Calbright object (its session's bind is used) or a SQLAlchemy engine
+
+        Returns: None
+
+        """
+        if not self.enabled:
+            return
+        engine = psql_engine if isinstance(psql_engine, Engine) else psql_engine.session.get_bind()
+        if id(engine) in self._instrumented:
+            return
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        self._instrumented.add(id(engine))
+
+    def _current(self):
+        return getattr(self._local, "current", None)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("sql_metrics_started_at", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started_at = conn.info["sql_metrics_started_at"].pop()
+        current = self._current()
+        if current is None:
+            return
+        step = current["steps"][-1]
+        current["statements"][step] += 1
+        current["seconds"][step] += time.perf_counter() - started_at
+        current["shapes"][(statement_shape(statement), step)] += 1
+
+    @contextmanager
+    def event(self, event_type: str):
+        """
+        Collect the metrics of one event, and log them when it ends
+        Args:
+            event_type: The event type the statements are attributed to
+
+        Returns: None
+
+        """
+        if not self.enabled or self._current() is not None:
+            yield
+            return
+        self._local.current = {
+            "event_type": event_type,
+            "steps": [EVENT_STEP],
+            "statements": Counter(),
+            "seconds": defaultdict(float),
+            "shapes": Counter(),
+        }
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            current = self._local.current
+            self._local.current = None
+            self.emit(current, time.perf_counter() - started_at)
+
+    @contextmanager
+    def step(self, name: str):
+        """
+        Attribute the statements run inside the block to a handler step. Can also be used as a decorator.
+        Args:
+            name: The step name, for example 'saa_timestamp'
+
+        Returns: None
+
+        """
+        current = self._current()
+        if current is None:
+            yield
+            return
+        current["steps"].append(name)
+        try:
+            yield
+        finally:
+            current["steps"].pop()
+
+    def find_n_plus_one(self, current: dict):
+        """
+        Find the statement shapes an event ran more times than the threshold
+        Args:
+            current: The event's collected metrics
+
+        Returns: list: the repeated statements, with their step and count
+
+        """
+        return [
+            {"step": step, "count": count, "statement": shape[:500]}
+            for (shape, step), count in current["shapes"].most_common()
+            if count > self.n_plus_one_threshold
+        ]
+
+    def _emf_line(self, event_type: str, step: str, metrics: dict, properties: dict = None):
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [["EventType"], ["EventType", "Step"]],
+                        "Metrics": [{"Name": name, "Unit": unit} for name, (unit, _) in metrics.items()],
+                    }
+                ],
+            },
+            "EventType": event_type,
+            "Step": step,
+            **{name: value for name, (_, value) in metrics.items()},
+            **(properties or {}),
+        }
+
+    def emit(self, current: dict, elapsed_seconds: float):
+        """
+        Log the metrics of an event as CloudWatch Embedded Metric Format lines
+        Args:
+            current: The event's collected metrics
+            elapsed_seconds: How long the event took
+
+        Returns: list: the logged lines
+
+        """
+        event_type = current["event_type"]
+        lines = [
+            self._emf_line(
+                event_type,
+                step,
+                {
+                    "SQLStatements": ("Count", current["statements"][step]),
+                    "SQLTime": ("Milliseconds", round(current["seconds"][step] * 1000, 3)),
+                },
+            )
+            for step in current["statements"]
+        ]
+        n_plus_one = self.find_n_plus_one(current)
+        for repeated in n_plus_one:
+            self.logger.warning(
+                f"possible N+1 in {event_type} / {repeated['step']}: statement ran {repeated['count']} times: "
+                f"{repeated['statement']}"
+            )
+        lines.append(
+            self._emf_line(
+                event_type,
+                "total",
+                {
+                    "SQLStatements": ("Count", sum(current["statements"].values())),
+                    "SQLTime": ("Milliseconds", round(sum(current["seconds"].values()) * 1000, 3)),
+                    "EventTime": ("Milliseconds", round(elapsed_seconds * 1000, 3)),
+                    "NPlusOneStatements": ("Count", len(n_plus_one)),
+                },
+                {"NPlusOne": n_plus_one} if n_plus_one else None,
+            )
+        )
+        for line in lines:
+            # EMF lines have to be written to stdout as they are, CloudWatch extracts the metrics from them
+            print(json.dumps(line))
+        return lines
@@ -1,4 +1,3 @@
-from propus.aws.ssm import AWS_SSM
 from propus.logging_utility import Logging
 
 from events.calendly_event import CalendlyEvent
@@ -13,6 +12,8 @@ from events.tangoe_event import TangoeEvent
 from events.dpau_request import DPAURequest
 from events.dpau_complete import DPAUComplete
 from exceptions import UnknownEventType, EmptyEventData
+from services.client_registry import client_registry
+from services.sql_metrics import sql_metrics
 
 
 class EventSystem:
@@ -56,7 +57,7 @@ class EventSystem:
         return EventSystem(
             configs=configs,
             event_type=event_type,
-            ssm=AWS_SSM.build(use_cache=True),
+            ssm=client_registry.ssm,
             dlq=f"calbright_events_{environment}_dlq",
         )
 
@@ -68,7 +69,8 @@ class EventSystem:
         system = self._event_type_mapping.get(event_message.get("event_type")).build(configs=self.configs, ssm=self.ssm)
         self.logger.info(f"beginning processing event `{event_message.get('event_type')}`")
         try:
-            system.run(event_message.get("event_data"))
+            with sql_metrics.event(event_message.get("event_type")):
+                system.run(event_message.get("event_data"))
         except Exception as err:
             import traceback
 
@@ -1,18 +1,22 @@
 from typing import AnyStr, Dict
 from collections.abc import Iterable
-from propus.aws.ssm import AWS_SSM
 from propus.logging_utility import Logging
 from exceptions import MissingRequiredField, UnhandledEventData
+from services.config_store import config_store
 
 
 class BaseEventSystem:
     __event_type__ = "base_event"
 
-    def __init__(self, configs={}, ssm=AWS_SSM.build()):
+    # The clients a handler uses: argument name > client_registry name. `build` passes a LazyClient for each, so a
+    # client is only built when an event first uses it
+    _clients = {}
+
+    def __init__(self, configs={}, ssm=None):
         self.logger = Logging.get_logger("event/base_event")
         _constants = configs.get("constants")
         if _constants and isinstance(_constants, str):
-            self.constants = ssm.get_param(_constants, param_type="json")
+            self.constants = config_store.get(_constants)
         elif _constants and isinstance(_constants, dict):
             self.constants = _constants
         else:
@@ -20,7 +24,7 @@ class BaseEventSystem:
 
         _feature_flags = configs.get("feature_flags")
         if _feature_flags and isinstance(_feature_flags, str):
-            ssm_features = ssm.get_param(_feature_flags, param_type="json")
+            ssm_features = config_store.get(_feature_flags)
         elif _feature_flags and isinstance(_feature_flags, dict):
             ssm_features = _feature_flags
         else:
@@ -31,6 +35,17 @@ class BaseEventSystem:
         else:
             self.features_enabled = []
 
+    def is_enabled(self, feature: str):
+        """
+        Check if a feature of the event type is enabled by the feature flags
+        Args:
+            feature: The feature name, usually the name of the method it gates
+
+        Returns: bool
+
+        """
+        return bool(self.features_enabled) and ("ALL" in self.features_enabled or feature in self.features_enabled)
+
     @staticmethod
     def check_required_fields(event_type: AnyStr, event: Dict, required_fields: set):
         for field in required_fields:
@@ -63,10 +78,18 @@ class BaseEventSystem:
             raise UnhandledEventData(event_type)
 
 
-def is_feature_enabled(func):
+def is_feature_enabled(func=None, feature: str = None):
+    """
+    Only run the decorated method when its feature is enabled, otherwise log it and return None. Used bare, the feature
+    is the method's name; `@is_feature_enabled(feature="...")` gates the method behind another feature.
+    """
+    if func is None:
+        return lambda decorated: is_feature_enabled(decorated, feature=feature)
+    name = feature or func.__name__
+
     def wrapper(self, *args, **kwargs):
-        if self.features_enabled and ("ALL" in self.features_enabled or func.__name__ in self.features_enabled):
+        if self.is_enabled(name):
             return func(self, *args, **kwargs)
-        self.logger.info(f"Event {self.__event_type__} feature is disabled: {func.__name__}")
+        self.logger.info(f"Event {self.__event_type__} feature is disabled: {name}")
 
     return wrapper
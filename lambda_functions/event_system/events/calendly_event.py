@@ -9,9 +9,14 @@ from propus.calbright_sql.learner_status import LearnerStatus
 from propus.calbright_sql.user import User
 from propus.logging_utility import Logging
 
+from common.reference_data import ReferenceDataCache
 from events.base import BaseEventSystem
+from services.client_registry import client_registry
 from exceptions import UnknownCalendlyEventType, CalbrightEmailNotInDatabase
 
+# Lookup tables shared by every event in the Lambda container
+reference_data = ReferenceDataCache({LearnerStatus: "status"})
+
 
 def convert_date_to_pst(date_string):
     if not date_string:
@@ -36,6 +41,12 @@ class EventTypeUUID(str, Enum):
 class CalendlyEvent(BaseEventSystem):
     __event_type__ = "calendly_event"
 
+    _clients = {
+        "calbright": "calbright",
+        "calendly": "calendly",
+        "salesforce": "salesforce",
+    }
+
     _invitee_created_required_fields = ["email", "scheduled_event"]
     _scheduled_event_required_fields = ["event_type", "start_time", "location"]
     _invitee_canceled_required_fields = []
@@ -68,16 +79,7 @@ class CalendlyEvent(BaseEventSystem):
 
     @staticmethod
     def build(configs, ssm):
-        from services.calendly_client import CalendlyClient
-        from services.salesforce_client import SalesforceService
-        from services.calbright_client import CalbrightClient
-
-        return CalendlyEvent(
-            configs=configs,
-            calbright=CalbrightClient(configs.get("calbright_write_ssm"), ssm),
-            calendly=CalendlyClient(configs.get("calendly_ssm"), ssm),
-            salesforce=SalesforceService(configs.get("salesforce_ssm"), ssm),
-        )
+        return CalendlyEvent(configs=configs, **client_registry.lazy(CalendlyEvent._clients, configs, ssm))
 
     def init_data(self, event_data):
         event_memberships = event_data.get("scheduled_event").get("event_memberships")
@@ -140,9 +142,7 @@ class CalendlyEvent(BaseEventSystem):
 
     def update_learner_status(self, status):
         self.salesforce.client.update_contact_record(self.student_record.salesforce_id, Cfg_Learner_Status__c=status)
-        self.student_record.learner_status = self.calbright.session.execute(
-            select(LearnerStatus).filter_by(status=status)
-        ).scalar_one()
+        self.student_record.learner_status = reference_data.get_instance(self.calbright.session, LearnerStatus, status)
 
     def process_created_event(self, event_data):
         event_type = event_data.get("scheduled_event", {}).get("event_type", "")
@@ -20,7 +20,9 @@ from propus.helpers.sql_alchemy import update_or_create
 from propus.calbright_sql.enrollment import LMS
 from propus.calbright_sql.learner_status import LearnerStatus
 
+from common.reference_data import ReferenceDataCache
 from events.base import BaseEventSystem
+from services.client_registry import client_registry
 from exceptions import CalbrightEmailNotInSalesforce, CccIdNotInDatabase
 from constants.hubspot_template_ids import (
     CONTINUE_SERVICES_TO_STUDENT,
@@ -39,6 +41,9 @@ from events.constants import (
     CANVAS_LAUNCH_DATES_BY_PROGRAM,
 )
 
+# Lookup tables shared by every event in the Lambda container
+reference_data = ReferenceDataCache({LearnerStatus: "status"})
+
 # Custom Exceptions for this event
 
 
@@ -73,6 +78,17 @@ class InstructorNotInDatabase(Exception):
 class CsepComplete(BaseEventSystem):
     __event_type__ = "csep_complete"
 
+    _clients = {
+        "calbright": "calbright",
+        "salesforce": "salesforce",
+        "hubspot": "hubspot",
+        "gsheets": "gsheets",
+        "slack": "slack",
+        "strut": "strut",
+        "sqs": "sqs",
+        "canvas": "canvas",
+    }
+
     _required_fields = ["id", "tokens", "date_modified", "fields"]
     _required_tokens = ["Student.CCCID", "Student.CalbrightEmail", "Student.ProgramName"]
 
@@ -103,26 +119,7 @@ class CsepComplete(BaseEventSystem):
 
     @staticmethod
     def build(configs, ssm):
-        from services.calbright_client import CalbrightClient
-        from services.canvas_client import CanvasClient
-        from services.gsheets_client import GoogleSheetsService
-        from services.hubspot_client import HubspotClient
-        from services.salesforce_client import SalesforceService
-        from services.slack_client import SlackService
-        from services.strut_client import StrutClient
-        from propus.aws.sqs import AWS_SQS
-
-        return CsepComplete(
-            configs=configs,
-            calbright=CalbrightClient(configs.get("calbright_write_ssm"), ssm),
-            salesforce=SalesforceService(configs.get("salesforce_ssm"), ssm),
-            hubspot=HubspotClient(configs.get("hubspot_ssm"), ssm),
-            gsheets=GoogleSheetsService(configs.get("gsheets_ssm"), ssm, configs.get("gsheets_keys")),
-            slack=SlackService(configs.get("slack_ssm"), ssm),
-            strut=StrutClient(configs.get("strut_ssm"), ssm),
-            sqs=AWS_SQS.build(),
-            canvas=CanvasClient(configs.get("canvas_ssm"), ssm),
-        )
+        return CsepComplete(configs=configs, **client_registry.lazy(CsepComplete._clients, configs, ssm))
 
     def run(self, event_data):
         self.signed_datetime = event_data.get("date_modified")
@@ -162,11 +159,11 @@ class CsepComplete(BaseEventSystem):
             Veterans_Services_Requested__c=pd_requests.get("veterans_services"),
         )
 
-        student_data.user.learner_status = self.calbright.session.execute(
-            select(LearnerStatus).filter_by(
-                status="Completed CSEP" if extra_data.get("is_crm") else "Enrolled in Program Pathway"
-            )
-        ).scalar_one()
+        student_data.user.learner_status = reference_data.get_instance(
+            self.calbright.session,
+            LearnerStatus,
+            "Completed CSEP" if extra_data.get("is_crm") else "Enrolled in Program Pathway",
+        )
         self.calbright.session.commit()
 
         course_versions = None
@@ -592,9 +589,9 @@ class CsepComplete(BaseEventSystem):
                 cfg_Learner_Status__c="Enrolled in Program Pathway",
                 Program_Version__c=str.join(", ", course_versions),
             )
-            student_data.user.learner_status = self.calbright.session.execute(
-                select(LearnerStatus).filter_by(status="Enrolled in Program Pathway")
-            ).scalar_one()
+            student_data.user.learner_status = reference_data.get_instance(
+                self.calbright.session, LearnerStatus, "Enrolled in Program Pathway"
+            )
             self.calbright.session.commit()
         self.logger.info(f"{student_data.ccc_id}: myTrailhead enrolled")
         return course_versions
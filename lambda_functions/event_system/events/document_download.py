@@ -1,14 +1,20 @@
 import os
 import base64
 from events.base import BaseEventSystem
+from services.client_registry import client_registry
 from propus.logging_utility import Logging
-from propus.aws.s3 import AWS_S3
 from exceptions import UnknownDocumentDownloadEventType
 
 
 class DownloadDocumentEvent(BaseEventSystem):
     __event_type__ = "document_download_event"
 
+    _clients = {
+        "salesforce": "salesforce",
+        "pd": "pandadoc",
+        "s3": "s3",
+    }
+
     _required_fields = [
         "document_download_event",
         "event_timestamp",
@@ -26,14 +32,8 @@ class DownloadDocumentEvent(BaseEventSystem):
 
     @staticmethod
     def build(configs, ssm):
-        from services.salesforce_client import SalesforceService
-        from services.pandadoc_client import PandaDocClient
-
         return DownloadDocumentEvent(
-            configs=configs,
-            salesforce=SalesforceService(configs.get("salesforce_ssm"), ssm),
-            pd=PandaDocClient(configs.get("pandadoc_ssm"), ssm),
-            s3=AWS_S3.build(),
+            configs=configs, **client_registry.lazy(DownloadDocumentEvent._clients, configs, ssm)
         )
 
     def download_pandadoc_request(self, event_data):
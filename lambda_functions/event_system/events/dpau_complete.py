@@ -5,11 +5,18 @@ from typing import Dict
 from propus.helpers.input_validations import validate_email
 from propus.logging_utility import Logging
 from events.base import BaseEventSystem
+from services.client_registry import client_registry
 
 
 class DPAUComplete(BaseEventSystem):
     __event_type__ = "dpau_complete"
 
+    _clients = {
+        "salesforce": "salesforce",
+        "geolocator": "geolocator",
+        "sqs": "sqs",
+    }
+
     _required_fields = ["id", "tokens", "date_modified", "fields"]
     _required_tokens = ["Student.CCCID", "Student.FullName"]
 
@@ -27,16 +34,7 @@ class DPAUComplete(BaseEventSystem):
 
     @staticmethod
     def build(configs, ssm):
-        from services.salesforce_client import SalesforceService
-        from services.geolocator_client import GeolocatorClient
-        from propus.aws.sqs import AWS_SQS
-
-        return DPAUComplete(
-            configs=configs,
-            salesforce=SalesforceService(configs.get("salesforce_ssm"), ssm),
-            geolocator=GeolocatorClient(configs.get("geolocator_ssm"), ssm),
-            sqs=AWS_SQS.build(),
-        )
+        return DPAUComplete(configs=configs, **client_registry.lazy(DPAUComplete._clients, configs, ssm))
 
     def run(self, event_data):
         try:
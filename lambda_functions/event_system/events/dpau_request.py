@@ -6,12 +6,21 @@ from propus.helpers.input_validations import validate_email
 from propus.logging_utility import Logging
 
 from events.base import BaseEventSystem
+from services.client_registry import client_registry
 from events.constants import PANDADOC_TEMPLATES
 from exceptions import PandaDocCreationError
 
 
 class DPAURequest(BaseEventSystem):
     __event_type__ = "dpau_request"
+
+    _clients = {
+        "salesforce": "salesforce",
+        "pandadoc": "pandadoc",
+        "geolocator": "geolocator",
+        "slack": "slack",
+        "sqs": "sqs",
+    }
     _required_fields = [
         "form_id",
         "response_id",
@@ -38,20 +47,7 @@ class DPAURequest(BaseEventSystem):
 
     @staticmethod
     def build(configs, ssm):
-        from services.salesforce_client import SalesforceService
-        from services.pandadoc_client import PandaDocClient
-        from services.geolocator_client import GeolocatorClient
-        from services.slack_client import SlackService
-        from propus.aws.sqs import AWS_SQS
-
-        return DPAURequest(
-            configs=configs,
-            salesforce=SalesforceService(configs.get("salesforce_ssm"), ssm),
-            pandadoc=PandaDocClient(configs.get("pandadoc_ssm"), ssm),
-            geolocator=GeolocatorClient(configs.get("geolocator_ssm"), ssm),
-            slack=SlackService(configs.get("slack_ssm"), ssm),
-            sqs=AWS_SQS.build(),
-        )
+        return DPAURequest(configs=configs, **client_registry.lazy(DPAURequest._clients, configs, ssm))
 
     def run(self, event_data):
         if os.environ.get("ENV") not in ("dev", "stage"):
@@ -12,10 +12,15 @@ from propus.helpers.sql_alchemy import find_enum_value
 from propus.helpers.calbright import PROGRAM_SHORT_NAME_TO_SF_API_NAME
 from propus.logging_utility import Logging
 
+from common.reference_data import ReferenceDataCache
 from constants.hubspot_template_ids import STUDENT_INTENDED_PROGRAM_CHANGE
 from events.base import BaseEventSystem
+from services.client_registry import client_registry
 from exceptions import MissingRequiredField
 
+# Lookup tables shared by every event in the Lambda container
+reference_data = ReferenceDataCache({LearnerStatus: "status"})
+
 FORM_ID_PROGRAM_NAME_MAP = {
     "f0842358-1fe4-45c0-a823-769157308c95": "Enroll",
     "c8ada9a4-28f7-4b5c-8e0a-22b0af60f75f": "Pre-Apply Networks",
@@ -42,6 +47,12 @@ LEARNER_STATUS_UPDATE_TABLE = {
 class HubspotFormSubmitted(BaseEventSystem):
     __event_type__ = "hubspot_forms_submission"
 
+    _clients = {
+        "salesforce": "salesforce",
+        "hubspot": "hubspot",
+        "calbright": "calbright",
+    }
+
     _required_fields = ["properties"]
     _required_properties = [
         "email",
@@ -75,7 +86,7 @@ class HubspotFormSubmitted(BaseEventSystem):
         program_set = set(programs_of_interest)
         program_set.add(program_of_interest)
 
-        l_status = self.calbright.session.execute(select(LearnerStatus).filter_by(status=learner_status)).scalar_one()
+        l_status_id = reference_data.get_id(self.calbright.session, LearnerStatus, learner_status)
         properties["browser_type"] = self.get_browser_type(properties.get("user_agent", {}).get("value"))
         allow_sms = properties.get("I agree to receive text updates from Calbright College.", {}).get("value", False)
         salesforce_data = {
@@ -107,7 +118,7 @@ class HubspotFormSubmitted(BaseEventSystem):
             "first_name": first_name,
             "last_name": last_name,
             "phone_number": phone,
-            "learner_status_id": l_status.id,
+            "learner_status_id": l_status_id,
             "sms_opt_out": not allow_sms,
         }
         if user:
@@ -155,17 +166,7 @@ class HubspotFormSubmitted(BaseEventSystem):
 
     @staticmethod
     def build(configs, ssm):
-        from services.calbright_client import CalbrightClient
-        from services.hubspot_client import HubspotClient
-        from services.salesforce_client import SalesforceService
-
-        return HubspotFormSubmitted(
-            configs,
-            ssm,
-            salesforce=SalesforceService(configs.get("salesforce_ssm"), ssm),
-            hubspot=HubspotClient(configs.get("hubspot_ssm"), ssm),
-            calbright=CalbrightClient(configs.get("calbright_write_ssm"), ssm),
-        )
+        return HubspotFormSubmitted(configs, ssm, **client_registry.lazy(HubspotFormSubmitted._clients, configs, ssm))
 
     def run(self, event_data):
         self.check_required_fields(self.__event_type__, event_data, self._required_fields)
@@ -1,23 +1,63 @@
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 from propus.calbright_sql.learner_status import LearnerStatus
 from propus.calbright_sql.user import User
 from propus.logging_utility import Logging
-from sqlalchemy import select
+from sqlalchemy import String, any_, bindparam, select, update
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import Session
 
+from common.reference_data import ReferenceDataCache
 from constants.hubspot_template_ids import (
     AUTOMATIC_DROP_DEVICE,
     AUTOMATIC_DROP_STAFF,
     AUTOMATIC_DROP_STUDENT,
 )
 from events.base import BaseEventSystem, is_feature_enabled
+from services.client_registry import client_registry
+
+# Lookup tables shared by every event in the Lambda container
+reference_data = ReferenceDataCache({LearnerStatus: "status"})
+
+# The per-student steps of a drop and the downstream system each one calls
+DROP_STEPS = (
+    ("update_learner_status_db", "postgres"),
+    ("update_learner_status_salesforce", "salesforce"),
+    ("deprovision_gsuite", "gsuite"),
+    ("deprovision_strut", "strut"),
+    ("send_drop_emails", "hubspot"),
+)
+# How many calls may run against each downstream system at once, overridable with configs["salesforce_event"]["limits"].
+# Every worker has its own Postgres session, but the other systems are called through one shared client each, and none
+# of those clients is known to be thread-safe (the GSuite ones are built on httplib2, which isn't), so they get one call
+# at a time
+DOWNSTREAM_LIMITS = {"postgres": 4, "salesforce": 1, "gsuite": 1, "strut": 1, "hubspot": 1}
+# Drops of at least this many students update the learner statuses with one statement per status and sObject Collections
+# requests instead of per student, overridable with configs["salesforce_event"]["bulk_threshold"]
+BULK_DROP_THRESHOLD = 10
+BULK_DROP_STEPS = ("update_learner_status_db", "update_learner_status_salesforce")
+
+STEP_SUCCEEDED = "succeeded"
+STEP_FAILED = "failed"
+STEP_SKIPPED = "skipped"
 
 
 class SalesforceEvent(BaseEventSystem):
     __event_type__ = "salesforce_event"
+
+    _clients = {
+        "calbright": "calbright",
+        "gsuite_licensing": "gsuite_licensing",
+        "gsuite_users": "gsuite_users",
+        "hubspot": "hubspot",
+        "salesforce": "salesforce",
+        "strut": "strut_service",
+    }
     _required_fields = ["Student__r"]
 
     def __init__(self, configs, calbright, gsuite_licensing, gsuite_users, hubspot, salesforce, strut):
@@ -30,6 +70,11 @@ class SalesforceEvent(BaseEventSystem):
         self.salesforce = salesforce
         self.strut = strut
         self.processed_students = set()
+        event_configs = configs.get("salesforce_event") or {}
+        self.downstream_limits = DOWNSTREAM_LIMITS | (event_configs.get("limits") or {})
+        # More workers than per-student steps would only wait on the downstream limits
+        self.workers = event_configs.get("workers") or min(sum(self.downstream_limits.values()), len(DROP_STEPS))
+        self.bulk_threshold = event_configs.get("bulk_threshold") or BULK_DROP_THRESHOLD
         self.timestamp = datetime.now(tz=ZoneInfo("UTC")).strftime("%Y-%m-%dT%H:%M:%S.000+0000")
 
         emails = self.constants.get("email", {})
@@ -92,46 +137,220 @@ class SalesforceEvent(BaseEventSystem):
 
     @staticmethod
     def build(configs, ssm):
-        from services.calbright_client import CalbrightClient
-        from services.gsuite_licensing_client import GoogleSuiteLicensingService
-        from services.gsuite_user_directory_client import GoogleSuiteUserDirectoryService
-        from services.hubspot_client import HubspotClient
-        from services.salesforce_client import SalesforceService
-        from services.strut_client import StrutService
-
-        return SalesforceEvent(
-            configs=configs,
-            calbright=CalbrightClient(configs.get("calbright_write_ssm"), ssm),
-            gsuite_licensing=GoogleSuiteLicensingService(configs.get("gsuite_svc_ssm"), ssm),
-            gsuite_users=GoogleSuiteUserDirectoryService(configs.get("gsheets_ssm"), ssm, readonly=False),
-            hubspot=HubspotClient(configs.get("hubspot_ssm"), ssm),
-            salesforce=SalesforceService(configs.get("salesforce_ssm"), ssm),
-            strut=StrutService(configs.get("strut_ssm"), ssm),
-        )
+        return SalesforceEvent(configs=configs, **client_registry.lazy(SalesforceEvent._clients, configs, ssm))
 
     def run(self, event):
-        threads = []
+        """
+        Drop every student in the event. The per-student steps of all the students run on a bounded worker pool, with
+        at most `downstream_limits[system]` calls against each downstream system at once. Each worker uses its own
+        database session, since a SQLAlchemy session can't be shared between threads. Drops of at least
+        `bulk_threshold` students update the learner statuses in bulk first, and only the other steps run per student.
+        Args:
+            event: A Salesforce learner status record, or a list of them
+
+        Returns: dict: the summary of the per-student outcomes
+
+        """
+        payloads = []
         for each_event in self.yield_bulk_data(self.__event_type__, event):
-            thread_event = threading.local()
-            payload = threading.local()
-            thread_event = each_event | dict(learner_status="Dropped", timestamp=self.timestamp)
-            self.check_required_fields(self.__event_type__, thread_event, self._required_fields)
-            payload = self.create_payload(thread_event)
-            threads.append(threading.Thread(target=self.update_learner_status_db, args=(payload,)))
-            threads.append(threading.Thread(target=self.update_learner_status_salesforce, args=(payload,)))
-            threads.append(threading.Thread(target=self.deprovision_gsuite, args=(payload,)))
-            threads.append(threading.Thread(target=self.deprovision_strut, args=(payload,)))
-            threads.append(threading.Thread(target=self.send_drop_emails, args=(payload,)))
-
-        for t in threads:
-            t.start()
+            student_event = each_event | dict(learner_status="Dropped", timestamp=self.timestamp)
+            self.check_required_fields(self.__event_type__, student_event, self._required_fields)
+            payloads.append(self.create_payload(student_event))
+
+        started = time.monotonic()
+        outcomes = [{} for _ in payloads]
+        steps = DROP_STEPS
+        students = [payload for payload in payloads if payload is not None]
+        if len(students) >= self.bulk_threshold:
+            self.run_bulk_steps(payloads, outcomes)
+            steps = [(step, system) for step, system in DROP_STEPS if step not in BULK_DROP_STEPS]
+
+        limits = {system: threading.BoundedSemaphore(limit) for system, limit in self.downstream_limits.items()}
+        worker_sessions = threading.local()
+        sessions = []
+        sessions_lock = threading.Lock()
+
+        def worker_session():
+            session = getattr(worker_sessions, "session", None)
+            if session is None:
+                session = Session(bind=self.calbright.session.get_bind())
+                worker_sessions.session = session
+                with sessions_lock:
+                    sessions.append(session)
+            return session
+
+        def run_step(step, system, payload):
+            with limits[system]:
+                kwargs = {"session": worker_session()} if system == "postgres" else {}
+                return self._as_outcome(getattr(self, step)(payload, **kwargs))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="salesforce_event") as pool:
+                futures = {
+                    pool.submit(run_step, step, system, payload): (index, step)
+                    for index, payload in enumerate(payloads)
+                    if payload is not None
+                    for step, system in steps
+                }
+                for future in as_completed(futures):
+                    index, step = futures[future]
+                    try:
+                        outcomes[index][step] = future.result()
+                    except Exception as err:
+                        self.logger.error(f"Error running {step} for {payloads[index].get('ccc_id')}: {err}")
+                        outcomes[index][step] = STEP_FAILED
+        finally:
+            for session in sessions:
+                session.close()
+
+        summary = self.summarize(payloads, outcomes, time.monotonic() - started)
+        self.logger.info(f"Dropped {summary['students']} students: {summary}")
+        return summary
+
+    @staticmethod
+    def _as_outcome(result):
+        if result is None:
+            return STEP_SKIPPED
+        return STEP_SUCCEEDED if result else STEP_FAILED
+
+    def run_bulk_steps(self, payloads: list, outcomes: list):
+        """
+        Update the learner status of every student in the database and in Salesforce in bulk, and record each
+        student's outcome of both steps
+        Args:
+            payloads: The students' payloads, None for a student whose payload couldn't be created
+            outcomes: step > outcome for each student, in the same order, updated in place
+
+        Returns: None
+
+        """
+        indexes = [index for index, payload in enumerate(payloads) if payload is not None]
+        students = [payloads[index] for index in indexes]
+        for step in BULK_DROP_STEPS:
+            try:
+                results = getattr(self, f"bulk_{step}")(students)
+            except Exception as err:
+                self.logger.error(f"Error running bulk {step}: {err}")
+                results = [False] * len(students)
+            if results is None:
+                # the step's feature is disabled
+                results = [None] * len(students)
+            for index, result in zip(indexes, results):
+                outcomes[index][step] = self._as_outcome(result)
+
+    @is_feature_enabled(feature="update_learner_status_db")
+    def bulk_update_learner_status_db(self, payloads: list, session=None):
+        """
+        Update the learner status of many students with one UPDATE per learner status
+        Args:
+            payloads: The students' payloads
+            session: The SQLAlchemy session to use, defaults to the Calbright session
+
+        Returns: list: True for each student whose user was updated, False otherwise
+
+        """
+        session = session if session is not None else self.calbright.session
+        results = [False] * len(payloads)
+        by_status = {}
+        for index, payload in enumerate(payloads):
+            if payload.get("ccc_id"):
+                by_status.setdefault(payload.get("learner_status"), []).append(index)
+            else:
+                self.logger.error(f"No ccc_id to update the learner status of Salesforce Id {payload.get('sf_id')}")
+
+        for learner_status, indexes in by_status.items():
+            ccc_ids = sorted({payloads[index]["ccc_id"] for index in indexes})
             try:
-                t.join()
-            except RuntimeError as err:
-                if 'cannot join current thread' in err:
-                    continue
-                else:
-                    raise
+                status_id = reference_data.get_id(session, LearnerStatus, learner_status)
+                updated = set(
+                    session.execute(
+                        update(User)
+                        .where(User.ccc_id == any_(bindparam("ccc_ids", ccc_ids, type_=ARRAY(String))))
+                        .values(learner_status_id=status_id)
+                        .returning(User.ccc_id)
+                        .execution_options(synchronize_session=False)
+                    ).scalars()
+                )
+                session.commit()
+            except NoResultFound:
+                self.logger.error(f"Learner status not found {learner_status}")
+                session.rollback()
+                continue
+            except Exception as err:
+                self.logger.error(f"Error updating {len(ccc_ids)} users to learner status {learner_status}: {err}")
+                session.rollback()
+                continue
+            self.logger.info(f"Updated {len(updated)} users to learner status {learner_status}")
+            for index in indexes:
+                results[index] = payloads[index]["ccc_id"] in updated
+                if not results[index]:
+                    self.logger.error(f"User not found for ccc_id {payloads[index]['ccc_id']}")
+        return results
+
+    @is_feature_enabled(feature="update_learner_status_salesforce")
+    def bulk_update_learner_status_salesforce(self, payloads: list):
+        """
+        Update the learner status of many Salesforce contacts with sObject Collections requests, mapping each record's
+        errors back to its student
+        Args:
+            payloads: The students' payloads
+
+        Returns: list: True for each student whose contact was updated, False otherwise
+
+        """
+        updates = {
+            payload["sf_id"]: {
+                "cfg_Learner_Status__c": payload.get("learner_status"),
+                "cfg_Learner_Status_Timestamp__c": payload.get("timestamp"),
+                "Pilot_PostEnrollmentEmailSent__c": False,
+            }
+            for payload in payloads
+            if payload.get("sf_id")
+        }
+        errors = self.salesforce.update_contacts(updates)
+        results = []
+        for payload in payloads:
+            sf_id = payload.get("sf_id")
+            contact_errors = errors.get(sf_id, ["no result returned"]) if sf_id else ["no Salesforce Id"]
+            if contact_errors:
+                self.logger.error(f"Error updating Salesforce for ccc_id {payload.get('ccc_id')}: {contact_errors}")
+            results.append(not contact_errors)
+        self.logger.info(f"Updated Salesforce for {results.count(True)} of {len(payloads)} contacts")
+        return results
+
+    @staticmethod
+    def summarize(payloads: list, outcomes: list, elapsed_seconds: float):
+        """
+        Summarize the outcome of a drop
+        Args:
+            payloads: The students' payloads, None for a student whose payload couldn't be created
+            outcomes: step > outcome for each student, in the same order
+            elapsed_seconds: How long the steps took
+
+        Returns: dict: the number of students, how many had every step succeed or be skipped, the outcome counts per
+            step and the students with failed steps
+
+        """
+        steps = {step: {STEP_SUCCEEDED: 0, STEP_FAILED: 0, STEP_SKIPPED: 0} for step, _ in DROP_STEPS}
+        failed_students = []
+        for payload, student_outcomes in zip(payloads, outcomes):
+            if payload is None:
+                failed_students.append({"ccc_id": None, "sf_id": None, "failed_steps": ["create_payload"]})
+                continue
+            for step, outcome in student_outcomes.items():
+                steps[step][outcome] += 1
+            failed_steps = [step for step, _ in DROP_STEPS if student_outcomes.get(step) == STEP_FAILED]
+            if failed_steps:
+                failed_students.append(
+                    {"ccc_id": payload.get("ccc_id"), "sf_id": payload.get("sf_id"), "failed_steps": failed_steps}
+                )
+        return {
+            "students": len(payloads),
+            "succeeded": len(payloads) - len(failed_students),
+            "failed": failed_students,
+            "steps": steps,
+            "elapsed_seconds": round(elapsed_seconds, 3),
+        }
 
     def create_payload(self, event_data):
         try:
@@ -180,20 +399,25 @@ class SalesforceEvent(BaseEventSystem):
                 )
                 return
 
+            succeeded = True
             try:
                 self.gsuite_users.suspend_student(calbright_email)
                 self.logger.info(f"Suspended student from GSuite {calbright_email}")
             except Exception as err:
                 self.logger.error(f"Error suspending student from GSuite {calbright_email}: {err}")
+                succeeded = False
 
             try:
                 self.gsuite_licensing.delete_license(calbright_email)
                 self.logger.info(f"Deleted student license if existed from GSuite {calbright_email}")
             except Exception as err:
                 self.logger.error(f"Error deleting student license from GSuite {calbright_email}: {err}")
+                succeeded = False
+            return succeeded
 
         except Exception as err:
             self.logger.error(f"Error deprovisioning student from GSuite with {payload}: {err}")
+            return False
 
     @is_feature_enabled
     def deprovision_strut(self, payload):
@@ -203,20 +427,25 @@ class SalesforceEvent(BaseEventSystem):
                 self.logger.info("Skipping deprovision_strut... no strut_id provided")
                 return
 
+            succeeded = True
             try:
                 self.strut.lock_student_enrollments(strut_id)
                 self.logger.info(f"Strut enrollments locked for strut_id {strut_id}")
             except Exception as err:
                 self.logger.error(f"Error locking enrollments for strut_id {strut_id}: {err}")
+                succeeded = False
 
             try:
                 self.strut.withdraw_student(strut_id)
                 self.logger.info(f"Strut withdrawn for strut_id {strut_id}")
             except Exception as err:
                 self.logger.error(f"Error withdrawing for strut_id {strut_id}: {err}")
+                succeeded = False
+            return succeeded
 
         except Exception as err:
             self.logger.error(f"Error deprovisioning student from Strut with {payload}: {err}")
+            return False
 
     @is_feature_enabled
     def send_drop_emails(self, payload):
@@ -232,6 +461,7 @@ class SalesforceEvent(BaseEventSystem):
             calbright_address = f"{name} <{calbright_email}>"
             personal_address = f"{name} <{email}>"
 
+            succeeded = True
             try:
                 if requested_chromebook or requested_hotspot:
                     if requested_chromebook and requested_hotspot:
@@ -254,6 +484,7 @@ class SalesforceEvent(BaseEventSystem):
 
             except Exception as err:
                 self.logger.error(f"Error sending device email to student ccc_id {ccc_id}: {err}")
+                succeeded = False
 
             try:
                 # Email the Student notifying them that they have been dropped
@@ -271,6 +502,7 @@ class SalesforceEvent(BaseEventSystem):
                 self.logger.info(f"Student drop email sent to student ccc_id {ccc_id}")
             except Exception as err:
                 self.logger.error(f"Error sending student drop email to student ccc_id {ccc_id}: {err}")
+                succeeded = False
 
             try:
                 # Email Calbright staff notifying them of the Student dropped
@@ -284,33 +516,39 @@ class SalesforceEvent(BaseEventSystem):
                 self.logger.info(f"Staff drop email sent for student ccc_id {ccc_id}")
             except Exception as err:
                 self.logger.error(f"Error sending staff drop email for student ccc_id {ccc_id}: {err}")
+                succeeded = False
+            return succeeded
 
         except Exception as err:
             self.logger.error(f"Error sending emails with {payload}: {err}")
+            return False
 
     @is_feature_enabled
-    def update_learner_status_db(self, payload):
+    def update_learner_status_db(self, payload, session=None):
+        session = session if session is not None else self.calbright.session
         try:
             ccc_id = payload.get("ccc_id")
             learner_status = payload.get("learner_status")
-            user = self.calbright.session.execute(select(User).filter_by(ccc_id=ccc_id)).scalar_one()
+            user = session.execute(select(User).filter_by(ccc_id=ccc_id)).scalar_one()
         except NoResultFound:
             self.logger.error(f"User not found for ccc_id {ccc_id}")
-            return
+            return False
         except Exception as err:
             self.logger.error(f"Error getting User: {err}")
-            return
+            session.rollback()
+            return False
 
         try:
-            user.learner_status = self.calbright.session.execute(
-                select(LearnerStatus).filter_by(status=learner_status)
-            ).scalar_one()
-            self.calbright.session.commit()
+            user.learner_status = reference_data.get_instance(session, LearnerStatus, learner_status)
+            session.commit()
             self.logger.info(f"Updated {ccc_id} to learner status {learner_status}")
+            return True
         except NoResultFound:
             self.logger.error(f"Learner status not found {learner_status}")
         except Exception as err:
             self.logger.error(f"Error getting LearnerStatus: {err}")
+        session.rollback()
+        return False
 
     @is_feature_enabled
     def update_learner_status_salesforce(self, payload):
@@ -323,5 +561,7 @@ class SalesforceEvent(BaseEventSystem):
             }
             self.salesforce.client.update_contact_record(sf_id, **data)
             self.logger.info(f"Update Salesforce for contact {sf_id}")
+            return True
         except Exception as err:
             self.logger.error(f"Error updating Salesforce: {err}")
+            return False
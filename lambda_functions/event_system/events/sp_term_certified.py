@@ -9,6 +9,7 @@ from propus.helpers.sql_calbright.term_grades import upsert_eotg_records
 
 
 from events.base import BaseEventSystem
+from services.client_registry import client_registry
 
 # Custom Exceptions for this event
 
@@ -29,6 +30,11 @@ class MissingTermInDB(Exception):
 
 class SpTermGradeCertified(BaseEventSystem):
     __event_type__ = "sp_term_grade_certified"
+
+    _clients = {
+        "calbright": "calbright",
+        "salesforce": "salesforce",
+    }
     _required_fields = [
         "salesforce_grade_id",
         "enrollment_course_term_id",
@@ -42,13 +48,8 @@ class SpTermGradeCertified(BaseEventSystem):
 
     @staticmethod
     def build(configs, ssm):
-        from services.calbright_client import CalbrightClient
-        from services.salesforce_client import SalesforceService
-
         return SpTermGradeCertified(
-            configs=configs,
-            calbright=CalbrightClient(configs.get("calbright_write_ssm"), ssm),
-            salesforce=SalesforceService(configs.get("salesforce_ssm"), ssm),
+            configs=configs, **client_registry.lazy(SpTermGradeCertified._clients, configs, ssm)
         )
 
     def run(self, event):
@@ -1,6 +1,7 @@
 import os
 from propus.logging_utility import Logging
 from events.base import BaseEventSystem
+from services.client_registry import client_registry
 from events.constants import TANGOE_IDS
 from exceptions import TangoePersonCreationError, TangoeActivityCreationError, TangoeActivityReturnError
 
@@ -8,6 +9,15 @@ from exceptions import TangoePersonCreationError, TangoeActivityCreationError, T
 class TangoeEvent(BaseEventSystem):
     __event_type__ = "tangoe_event"
 
+    _clients = {
+        "salesforce": "salesforce",
+        "gsheets": "gsheets_svc",
+        "slack": "slack",
+        "geolocator": "geolocator",
+        "tangoemobile": "tangoe_mobile",
+        "tangoepeople": "tangoe_people",
+    }
+
     _required_fields = [
         "student_info",
         "event_timestamp",
@@ -28,20 +38,7 @@ class TangoeEvent(BaseEventSystem):
 
     @staticmethod
     def build(configs, ssm):
-        from services.salesforce_client import SalesforceService
-        from services.gsheets_client import GoogleSheetsService
-        from services.geolocator_client import GeolocatorClient
-        from services.slack_client import SlackService
-        from services.tangoe_client import TangoeMobileClient, TangoePeopleClient
-
-        return TangoeEvent(
-            salesforce=SalesforceService(configs.get("salesforce_ssm"), ssm),
-            gsheets=GoogleSheetsService(configs.get("gsheets_svc_ssm"), ssm, configs.get("gsheets_keys")),
-            slack=SlackService(configs.get("slack_ssm"), ssm),
-            geolocator=GeolocatorClient(configs.get("geolocator_ssm"), ssm),
-            tangoemobile=TangoeMobileClient(configs.get("tangoe_ssm"), ssm),
-            tangoepeople=TangoePeopleClient(configs.get("tangoe_ssm"), ssm),
-        )
+        return TangoeEvent(**client_registry.lazy(TangoeEvent._clients, configs, ssm))
 
     def send_device_request(self, student_info, event_timestamp):
         device_requests = dict()
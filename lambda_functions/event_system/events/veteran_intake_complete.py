@@ -8,6 +8,7 @@ from constants.hubspot_template_ids import (
     INTAKE_FORM_COMPLETE_TO_VS_TEAM,
 )
 from events.base import BaseEventSystem
+from services.client_registry import client_registry
 from exceptions import (
     MultipleCalbrightEmailInSalesforce,
     CalbrightEmailNotInSalesforce,
@@ -16,6 +17,12 @@ from exceptions import (
 
 class VeteranIntakeComplete(BaseEventSystem):
     __event_type__ = "veterans_intake_complete"
+
+    _clients = {
+        "salesforce": "salesforce_client",
+        "hubspot": "hubspot",
+        "gdrive": "gdrive",
+    }
     _required_fields = [
         "form_id",
         "response_id",
@@ -106,17 +113,10 @@ class VeteranIntakeComplete(BaseEventSystem):
 
     @staticmethod
     def build(configs, ssm):
-        from services.salesforce_client import SalesforceClient
-        from services.hubspot_client import HubspotClient
-        from services.gdrive_client import GoogleDriveClient
         from fpdf import FPDF
 
         return VeteranIntakeComplete(
-            configs=configs,
-            pdf=FPDF(),
-            salesforce=SalesforceClient(configs.get("salesforce_ssm"), ssm),
-            hubspot=HubspotClient(configs.get("hubspot_ssm"), ssm),
-            gdrive=GoogleDriveClient(configs.get("gdrive_ssm"), ssm),
+            configs=configs, pdf=FPDF(), **client_registry.lazy(VeteranIntakeComplete._clients, configs, ssm)
         )
 
     def run(self, event):
@@ -1,5 +1,6 @@
 import os
 from services.base_client import fetch_ssm
+from services.sql_metrics import sql_metrics
 from propus.calbright_sql.calbright import Calbright
 
 
@@ -13,4 +14,5 @@ class CalbrightClient:
                 cls._client = Calbright.build({k.lower(): os.environ.get(k) for k in cls._dev_db_keys}, verbose=True)
             else:
                 cls._client = Calbright.build(fetch_ssm(ssm, param_name, is_json=True))
+            sql_metrics.instrument(cls._client)
         return cls._client
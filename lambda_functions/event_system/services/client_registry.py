@@ -0,0 +1,286 @@
+import threading
+
+from propus.logging_utility import Logging
+
+# name > function building the client from the environment's configs and the SSM object. Each function imports its
+# client, so a client's code is only loaded when an event first uses it.
+_client_factories = {}
+
+
+def register_client(name: str):
+    """
+    Register the function that builds a client
+    Args:
+        name: The name handlers declare the client by
+
+    Returns: the decorator
+
+    """
+
+    def decorator(factory):
+        _client_factories[name] = factory
+        return factory
+
+    return decorator
+
+
+@register_client("calbright")
+def _calbright(configs, ssm):
+    from services.calbright_client import CalbrightClient
+
+    return CalbrightClient(configs.get("calbright_write_ssm"), ssm)
+
+
+@register_client("calendly")
+def _calendly(configs, ssm):
+    from services.calendly_client import CalendlyClient
+
+    return CalendlyClient(configs.get("calendly_ssm"), ssm)
+
+
+@register_client("canvas")
+def _canvas(configs, ssm):
+    from services.canvas_client import CanvasClient
+
+    return CanvasClient(configs.get("canvas_ssm"), ssm)
+
+
+@register_client("gdrive")
+def _gdrive(configs, ssm):
+    from services.gdrive_client import GoogleDriveClient
+
+    return GoogleDriveClient(configs.get("gdrive_ssm"), ssm)
+
+
+@register_client("geolocator")
+def _geolocator(configs, ssm):
+    from services.geolocator_client import GeolocatorClient
+
+    return GeolocatorClient(configs.get("geolocator_ssm"), ssm)
+
+
+@register_client("gsheets")
+def _gsheets(configs, ssm):
+    from services.gsheets_client import GoogleSheetsService
+
+    return GoogleSheetsService(configs.get("gsheets_ssm"), ssm, configs.get("gsheets_keys"))
+
+
+@register_client("gsheets_svc")
+def _gsheets_svc(configs, ssm):
+    from services.gsheets_client import GoogleSheetsService
+
+    return GoogleSheetsService(configs.get("gsheets_svc_ssm"), ssm, configs.get("gsheets_keys"))
+
+
+@register_client("gsuite_licensing")
+def _gsuite_licensing(configs, ssm):
+    from services.gsuite_licensing_client import GoogleSuiteLicensingService
+
+    return GoogleSuiteLicensingService(configs.get("gsuite_svc_ssm"), ssm)
+
+
+@register_client("gsuite_users")
+def _gsuite_users(configs, ssm):
+    from services.gsuite_user_directory_client import GoogleSuiteUserDirectoryService
+
+    return GoogleSuiteUserDirectoryService(configs.get("gsheets_ssm"), ssm, readonly=False)
+
+
+@register_client("hubspot")
+def _hubspot(configs, ssm):
+    from services.hubspot_client import HubspotClient
+
+    return HubspotClient(configs.get("hubspot_ssm"), ssm)
+
+
+@register_client("pandadoc")
+def _pandadoc(configs, ssm):
+    from services.pandadoc_client import PandaDocClient
+
+    return PandaDocClient(configs.get("pandadoc_ssm"), ssm)
+
+
+@register_client("s3")
+def _s3(configs, ssm):
+    from propus.aws.s3 import AWS_S3
+
+    return AWS_S3.build()
+
+
+@register_client("salesforce")
+def _salesforce(configs, ssm):
+    from services.salesforce_client import SalesforceService
+
+    return SalesforceService(configs.get("salesforce_ssm"), ssm)
+
+
+@register_client("salesforce_client")
+def _salesforce_client(configs, ssm):
+    from services.salesforce_client import SalesforceClient
+
+    return SalesforceClient(configs.get("salesforce_ssm"), ssm)
+
+
+@register_client("slack")
+def _slack(configs, ssm):
+    from services.slack_client import SlackService
+
+    return SlackService(configs.get("slack_ssm"), ssm)
+
+
+@register_client("sqs")
+def _sqs(configs, ssm):
+    from propus.aws.sqs import AWS_SQS
+
+    return AWS_SQS.build()
+
+
+@register_client("strut")
+def _strut(configs, ssm):
+    from services.strut_client import StrutClient
+
+    return StrutClient(configs.get("strut_ssm"), ssm)
+
+
+@register_client("strut_service")
+def _strut_service(configs, ssm):
+    from services.strut_client import StrutService
+
+    return StrutService(configs.get("strut_ssm"), ssm)
+
+
+@register_client("tangoe_mobile")
+def _tangoe_mobile(configs, ssm):
+    from services.tangoe_client import TangoeMobileClient
+
+    return TangoeMobileClient(configs.get("tangoe_ssm"), ssm)
+
+
+@register_client("tangoe_people")
+def _tangoe_people(configs, ssm):
+    from services.tangoe_client import TangoePeopleClient
+
+    return TangoePeopleClient(configs.get("tangoe_ssm"), ssm)
+
+
+class LazyClient:
+    """
+    Stands in for a client a handler declared: the client is built through the registry on first attribute access, and
+    every attribute access after that goes straight to it.
+    """
+
+    __slots__ = ("_registry", "_name", "_configs", "_ssm")
+
+    def __init__(self, registry, name: str, configs: dict, ssm):
+        object.__setattr__(self, "_registry", registry)
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_configs", configs)
+        object.__setattr__(self, "_ssm", ssm)
+
+    def __getattr__(self, attribute):
+        return getattr(self._registry.get(self._name, self._configs, self._ssm), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._registry.get(self._name, self._configs, self._ssm), attribute, value)
+
+    def __repr__(self):
+        return f"LazyClient({self._name!r})"
+
+
+class ClientRegistry:
+    """
+    A per-container registry of the service clients event handlers use. Handlers declare the clients they depend on and
+    get a LazyClient for each, so a client (and its import) is only built when an event first uses it, and is then
+    reused by every event in the container. Cold starts and short events only pay for the clients their code path
+    actually touches.
+
+    The registry also holds the container's SSM object, built on first use.
+    """
+
+    def __init__(self, factories: dict = None):
+        """
+        Initialize the client registry
+        Args:
+            factories: name > function building the client, defaults to the clients registered in this module
+        """
+        self.logger = Logging.get_logger("castor/lambda_functions/event_system/client_registry")
+        self.factories = factories if factories is not None else _client_factories
+        self._clients = {}
+        self._ssm = None
+        self._lock = threading.RLock()
+
+    @property
+    def ssm(self):
+        """
+        The container's Propus AWS_SSM object, built on first use
+
+        Returns: AWS_SSM
+
+        """
+        with self._lock:
+            if self._ssm is None:
+                from propus.aws.ssm import AWS_SSM
+
+                self._ssm = AWS_SSM.build(use_cache=True)
+            return self._ssm
+
+    def get(self, name: str, configs: dict, ssm=None):
+        """
+        Get a client, building it on first use. A container only ever runs one environment, so clients are kept by
+        name.
+        Args:
+            name: The registered client name
+            configs: The environment's configs
+            ssm: The SSM object to read the client's credentials with, defaults to the registry's
+
+        Returns: the client
+
+        """
+        client = self._clients.get(name)
+        if client is not None:
+            return client
+        with self._lock:
+            if name not in self._clients:
+                self.logger.info(f"building {name} client")
+                self._clients[name] = self.factories[name](configs, ssm if ssm is not None else self.ssm)
+            return self._clients[name]
+
+    def lazy(self, dependencies: dict, configs: dict, ssm=None):
+        """
+        Get a LazyClient for every client a handler depends on
+        Args:
+            dependencies: The handler's argument name > registered client name
+            configs: The environment's configs
+            ssm: The SSM object to read credentials with, defaults to the registry's
+
+        Returns: dict: argument name > LazyClient, to pass to the handler
+
+        """
+        for name in dependencies.values():
+            if name not in self.factories:
+                raise KeyError(f"unknown client {name}")
+        return {argument: LazyClient(self, name, configs, ssm) for argument, name in dependencies.items()}
+
+    def built(self):
+        """
+        Get the names of the clients built so far
+
+        Returns: list
+
+        """
+        return sorted(self._clients)
+
+    def reset(self):
+        """
+        Drop every client, so they are built again on next use
+
+        Returns: None
+
+        """
+        with self._lock:
+            self._clients = {}
+            self._ssm = None
+
+
+client_registry = ClientRegistry()
@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+import time
+
+from propus.logging_utility import Logging
+
+CONFIG_REFRESH_SECONDS = 300
+
+
+class ConfigStore:
+    """
+    A per-container store of the JSON SSM parameters every event system reads (constants and feature flags). A parameter
+    is loaded the first time it is needed and served from memory after that, so building an event system doesn't cost
+    an SSM call per parameter.
+
+    Once the refresh interval has passed, the versions of every stored parameter are checked with a single
+    DescribeParameters call and only the parameters whose version changed are loaded again, so a constant or feature
+    flag change takes effect within the refresh interval. If the versions can't be read, the stale parameters are
+    loaded again instead. Values are read with GetParameter on the same boto3 client, never through the cached Propus
+    AWS_SSM object, which would keep serving the value it read first.
+    """
+
+    def __init__(self, refresh_seconds: int = None, ssm_client=None):
+        """
+        Initialize the config store
+        Args:
+            refresh_seconds: How long parameters are used before their version is checked, defaults to the
+                CONFIG_REFRESH_SECONDS environment variable or 300
+            ssm_client: A boto3 SSM client to read parameters and their versions with, built on first use by default
+        """
+        self.logger = Logging.get_logger("castor/lambda_functions/event_system/config_store")
+        self.refresh_seconds = (
+            refresh_seconds
+            if refresh_seconds is not None
+            else int(os.environ.get("CONFIG_REFRESH_SECONDS", CONFIG_REFRESH_SECONDS))
+        )
+        self._ssm_client = ssm_client
+        self._params = {}
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    @property
+    def ssm_client(self):
+        if self._ssm_client is None:
+            import boto3
+
+            self._ssm_client = boto3.client("ssm", region_name="us-west-2")
+        return self._ssm_client
+
+    def _is_stale(self):
+        return self._checked_at is None or time.monotonic() - self._checked_at >= self.refresh_seconds
+
+    def _get_versions(self, names: list):
+        """
+        Get the current version of SSM parameters
+        Args:
+            names: The parameter names
+
+        Returns: dict: parameter name > version, or None if the versions couldn't be read
+
+        """
+        try:
+            response = self.ssm_client.describe_parameters(
+                ParameterFilters=[{"Key": "Name", "Option": "Equals", "Values": names}], MaxResults=50
+            )
+        except Exception as err:
+            self.logger.warning(f"unable to read the version of {names}: {err}")
+            return None
+        return {parameter["Name"]: parameter.get("Version") for parameter in response.get("Parameters", [])}
+
+    def _load(self, name: str):
+        parameter = self.ssm_client.get_parameter(Name=name, WithDecryption=True)["Parameter"]
+        self._params[name] = {"value": json.loads(parameter["Value"]), "version": parameter.get("Version")}
+        self.loads += 1
+
+    def _refresh(self):
+        names = list(self._params)
+        versions = self._get_versions(names) if names else {}
+        for name in names:
+            version = versions.get(name) if versions is not None else None
+            if versions is None or version is None or version != self._params[name]["version"]:
+                self.logger.info(f"loading changed SSM parameter {name} (version {version})")
+                self._load(name)
+        self._checked_at = time.monotonic()
+
+    def get(self, name: str):
+        """
+        Get a JSON SSM parameter, loading it on first use and again when its version changes
+        Args:
+            name: The parameter name
+
+        Returns: dict: the parameter's value. It is shared by every event in the container, so it must not be modified
+
+        """
+        with self._lock:
+            if self._is_stale():
+                self._refresh()
+            if name not in self._params:
+                self._load(name)
+            return self._params[name]["value"]
+
+    def invalidate(self):
+        """
+        Force every parameter to be loaded again on the next lookup
+
+        Returns: None
+
+        """
+        with self._lock:
+            self._params = {}
+            self._checked_at = None
+
+
+config_store = ConfigStore()
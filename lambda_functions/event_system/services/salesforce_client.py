@@ -1,4 +1,5 @@
 from datetime import timedelta, datetime
+from common.sf_collections import update_records
 from services.base_client import fetch_ssm
 from exceptions import CccIdNotInSalesforce, MultipleCccIdInSalesforce, EmailNotInSalesforce
 from propus.salesforce import Salesforce
@@ -7,6 +8,7 @@ from propus.logging_utility import Logging
 
 
 CALENDLY_INTAKE_ROLES = ("counselor", "student support")
+SF_METRICS_NAMESPACE = "Castor/EventSystem"
 
 
 class SalesforceClient:
@@ -24,6 +26,19 @@ class SalesforceService:
         self.client = SalesforceClient(param_name, ssm)
         self.logger = Logging.get_logger("castor/lambda_functions/event_system/services/salesforce_client")
 
+    def update_contacts(self, updates: dict):
+        """
+        Update many contact records with sObject Collections requests of up to 200 records, without all-or-none, so
+        one bad record doesn't fail the others
+        Args:
+            updates: Salesforce contact ID > the fields to update
+
+        Returns: dict: contact ID > list of errors, empty for contacts that were updated
+
+        """
+        records = [{"attributes": {"type": "Contact"}, "id": sf_id, **fields} for sf_id, fields in updates.items()]
+        return update_records(self.client, records, namespace=SF_METRICS_NAMESPACE, logger=self.logger)
+
     def get_learner_status_by_email(self, email):
         records = self.client.custom_query(
             f"""Select Id, Cfg_CCC_ID__c, Cfg_Learner_Status__c FROM contact WHERE Email = '{email}'
@@ -0,0 +1,56 @@
+import asyncio
+import unittest
+
+from tests.benchmarks.canvas_events_replay import (
+    build_fakes,
+    find_regressions,
+    generate_events,
+    load_templates,
+    parse_mix,
+    percentile,
+)
+
+
+class TestCanvasEventsReplay(unittest.TestCase):
+    def setUp(self):
+        self.templates = load_templates()
+
+    def test_events_follow_the_mix(self):
+        weights = parse_mix("grade_change=1,logged_in=3", self.templates)
+        pool = {"students": [("104", "106"), ("105", "107")], "assessments": {"assignment": ["123"]}}
+        canvas_events = generate_events(self.templates, weights, 40, pool, seed=1)
+
+        self.assertEqual({event["metadata"]["event_name"] for event in canvas_events}, {"grade_change", "logged_in"})
+        self.assertEqual(len({event["metadata"]["event_guid"] for event in canvas_events}), 40)
+        grade_change = next(event for event in canvas_events if event["metadata"]["event_name"] == "grade_change")
+        self.assertIn(grade_change["body"]["student_id"], ("104", "105"))
+        self.assertIn(grade_change["metadata"]["context_id"], ("106", "107"))
+        self.assertEqual(grade_change["body"]["assignment_id"], "123")
+        with self.assertRaises(ValueError):
+            parse_mix("unknown_event=1", self.templates)
+
+    def test_fakes_record_calls(self):
+        salesforce, canvas = build_fakes()
+        self.assertEqual(salesforce.custom_query("SELECT Id FROM Contact")["totalSize"], 1)
+        submissions = asyncio.run(canvas.get_single_submission(user_id="104", assignment_id="123"))
+        self.assertEqual(submissions[0]["submission_history"][0]["attempt"], 1)
+        self.assertEqual((salesforce.total_calls(), canvas.total_calls()), (1, 1))
+
+    def test_regressions(self):
+        self.assertEqual(percentile([5, 1, 3, 2, 4], 0.5), 3)
+        baseline = {
+            "event_types": {
+                "grade_change": {
+                    "p95_ms": 10,
+                    "statements_per_event": 6,
+                    "salesforce_calls_per_event": 1,
+                    "canvas_calls_per_event": 0,
+                    "errors": 0,
+                }
+            }
+        }
+        report = {"event_types": {"grade_change": dict(baseline["event_types"]["grade_change"], p95_ms=12)}}
+        self.assertEqual(find_regressions(report, baseline), [])
+
+        report["event_types"]["grade_change"].update(p95_ms=20, statements_per_event=7)
+        self.assertEqual(len(find_regressions(report, baseline)), 2)
@@ -1,13 +1,23 @@
+import copy
+import datetime
+import json
 import unittest
 from unittest.mock import patch, MagicMock
 
 
 from lambda_functions.canvas_events.canvas_event_system import CanvasEventSystem
+from lambda_functions.canvas_events.events.asset_events import AssetAccessedEvent
 
 # from lambda_functions.canvas_events.src.exceptions import UnknownCanvasEventType
 
 
 # from tests.lambda_functions.canvas_events.canvas_test_events import test_events
+from src.event_lanes import ACTIVITY_LANE, LaneMetrics, LaneRouter
+from src.event_ledger import OUTCOME_FAILED, OUTCOME_SUCCEEDED, EventLedger
+from src.exceptions import AssigmentNotFoundInDatabase
+from src.sf_services import SFServices
+
+from tests.lambda_functions.canvas_events.canvas_test_events import test_events
 from tests.lambda_functions.canvas_events.services.mock_psql_services import create_mock_psql_services
 from tests.lambda_functions.canvas_events.services.mock_sf_services import create_mock_sf_services
 from tests.lambda_functions.canvas_events.services.mock_canvas_services import create_mock_canvas_services
@@ -73,6 +83,249 @@ class TestCanvasEventSystem(unittest.TestCase):
             self.assertIsInstance(ces, CanvasEventSystem)
             self.assertEqual(ces.dlq, f"canvas_events_{environment}_dlq.fifo")
 
+    def test_get_or_build_reuses_system(self):
+        CanvasEventSystem.reset_registry()
+        with patch.object(CanvasEventSystem, "build", return_value=self.ces) as mock_build:
+            first = CanvasEventSystem.get_or_build("test")
+            second = CanvasEventSystem.get_or_build("test")
+        self.assertIs(first, second)
+        mock_build.assert_called_once_with("test")
+        CanvasEventSystem.reset_registry()
+
+    @patch("lambda_functions.canvas_events.canvas_event_system.AWS_SSM.build", return_value=create_mock_ssm())
+    def test_get_or_build_reconnects_unhealthy_system(self, mock_ssm_build):
+        CanvasEventSystem.reset_registry()
+        new_engine = MagicMock()
+        self.config.setup_postgres_engine.return_value = new_engine
+        self.psql_engine.session.execute.side_effect = Exception("server closed the connection unexpectedly")
+        with patch.object(CanvasEventSystem, "build", return_value=self.ces):
+            CanvasEventSystem.get_or_build("test")
+            ces = CanvasEventSystem.get_or_build("test")
+        self.assertIs(ces.psql_engine, new_engine)
+        self.config.setup_postgres_engine.assert_called_once()
+        CanvasEventSystem.reset_registry()
+
+    def test_check_health(self):
+        self.assertTrue(self.ces.check_health())
+        self.psql_engine.session.execute.side_effect = Exception("connection reset")
+        self.assertFalse(self.ces.check_health())
+
+    @staticmethod
+    def _create_record(message_id, event_name, user_id, event_time="2024-05-10T20:39:26.747Z"):
+        event = {"metadata": {"event_name": event_name, "user_id": user_id, "event_time": event_time}, "body": {}}
+        return {"messageId": message_id, "body": json.dumps(event)}
+
+    def test_records_are_grouped_by_the_envelope_user(self):
+        records = [
+            {"messageId": str(index), "body": json.dumps(test_events[event_name])}
+            for index, event_name in enumerate(("grade_change", "logged_in"))
+        ]
+        records.append({"messageId": "2", "body": json.dumps({"metadata": {"event_name": "logged_in"}, "body": {}})})
+        # Canvas IDs can arrive as numbers
+        int_ids = {"metadata": {"event_name": "logged_in", "user_id": 263480000000000104}, "body": {}}
+        records.append({"messageId": "3", "body": json.dumps(int_ids)})
+        body_user = {"metadata": {"event_name": "logged_in"}, "body": {"user": {"id": 105}}}
+        records.append({"messageId": "4", "body": json.dumps(body_user)})
+
+        parsed_records, failed_message_ids = self.ces.parse_records(records)
+        self.assertEqual(failed_message_ids, [])
+        self.assertEqual([record["user_id"] for record in parsed_records], ["113", "104", None, "104", "105"])
+        self.assertTrue(all(record["envelope"].metadata is record["event"]["metadata"] for record in parsed_records))
+
+    def test_parse_records(self):
+        records = [
+            self._create_record("1", "logged_in", "263480000000000104"),
+            {"messageId": "2", "body": "not json"},
+            self._create_record("3", "unknown_event", "263480000000000104"),
+        ]
+        parsed_records, failed_message_ids = self.ces.parse_records(records)
+        self.assertEqual([record["message_ids"] for record in parsed_records], [["1"]])
+        self.assertEqual(parsed_records[0]["user_id"], "104")
+        self.assertEqual(failed_message_ids, ["2", "3"])
+
+    def test_process_batch_reports_failures(self):
+        records = [
+            self._create_record("1", "submission_created", "263480000000000104"),
+            self._create_record("2", "grade_change", "263480000000000104"),
+            self._create_record("3", "logged_in", "263480000000000104"),
+            self._create_record("4", "logged_in", "263480000000000200"),
+        ]
+
+        def process_event(event, event_keys=None, **kwargs):
+            if event["metadata"]["event_name"] == "submission_created":
+                raise Exception("database went away")
+
+        with patch.object(self.ces, "process_event", side_effect=process_event) as mock_process_event:
+            response = self.ces.process_batch(records)
+        # the failed user's later grading events are retried with it, their activity lane and the other user are not
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "1"}, {"itemIdentifier": "2"}]})
+        self.assertEqual(mock_process_event.call_count, 3)
+
+    def test_process_batch_runs_transactional_lane_first(self):
+        records = [
+            self._create_record("1", "logged_in", "263480000000000104"),
+            self._create_record("2", "asset_accessed", "263480000000000200"),
+            self._create_record("3", "grade_change", "263480000000000104"),
+            self._create_record("4", "quiz_submitted", "263480000000000200"),
+        ]
+        with patch.object(self.ces, "process_event") as mock_process_event, patch("builtins.print") as emitted:
+            self.ces.process_batch(records)
+        self.assertEqual(
+            [call.args[0]["metadata"]["event_name"] for call in mock_process_event.call_args_list],
+            ["grade_change", "quiz_submitted", "logged_in", "asset_accessed"],
+        )
+        lines = {line["Lane"]: line for line in (json.loads(call.args[0]) for call in emitted.call_args_list)}
+        self.assertEqual(lines["transactional"]["LaneRecords"], 2)
+        self.assertEqual(lines[ACTIVITY_LANE]["LaneForwarded"], 0)
+
+    def test_process_batch_forwards_activity_lane(self):
+        sqs_client = MagicMock()
+        sqs_client.get_queue_url.return_value = {"QueueUrl": "https://sqs/canvas_events_test_activity"}
+        sqs_client.send_message_batch.return_value = {"Failed": [{"Id": "1"}]}
+        self.ces.lane_router = LaneRouter(activity_queue="canvas_events_test_activity", sqs_client=sqs_client)
+        records = [
+            self._create_record("1", "logged_in", "263480000000000104"),
+            self._create_record("2", "grade_change", "263480000000000104"),
+            self._create_record("3", "asset_accessed", "263480000000000200"),
+        ]
+        for record in records:
+            record["eventSourceARN"] = "arn:aws:sqs:us-west-2:1:canvas_events_test"
+
+        with patch.object(self.ces, "process_event") as mock_process_event, patch("builtins.print"):
+            response = self.ces.process_batch(records)
+        mock_process_event.assert_called_once()
+        entries = sqs_client.send_message_batch.call_args.kwargs["Entries"]
+        self.assertEqual([entry["MessageBody"] for entry in entries], [records[0]["body"], records[2]["body"]])
+        # only the record SQS refused to take is redelivered
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "3"}]})
+
+        # the activity queue's own batches are processed
+        for record in records:
+            record["eventSourceARN"] = "arn:aws:sqs:us-west-2:1:canvas_events_test_activity"
+        with patch.object(self.ces, "process_event") as mock_process_event, patch("builtins.print"):
+            self.ces.process_batch([records[0], records[2]])
+        self.assertEqual(mock_process_event.call_count, 2)
+        sqs_client.send_message_batch.assert_called_once()
+
+    def test_lane_metrics(self):
+        records = [{"message_ids": ["1"], "sent_at": 1000}, {"message_ids": ["2"], "sent_at": 4000}, {}]
+        self.assertEqual(LaneMetrics.oldest_age_ms(records, now_ms=5000), 4000)
+        self.assertEqual(LaneMetrics.oldest_age_ms([{}], now_ms=5000), 0)
+        with patch("builtins.print"):
+            line = LaneMetrics("Test").emit(ACTIVITY_LANE, records, failed=1, forwarded=0, elapsed_seconds=0.5)
+        self.assertEqual(line["LaneRecords"], 3)
+        self.assertEqual(line["LaneFailures"], 1)
+        self.assertEqual(line["LaneLatency"], 500.0)
+        self.assertEqual(line["_aws"]["CloudWatchMetrics"][0]["Dimensions"], [["Lane"]])
+
+    def test_process_batch_continues_after_non_retryable_error(self):
+        records = [
+            self._create_record("1", "grade_change", "263480000000000104"),
+            self._create_record("2", "logged_in", "263480000000000104"),
+        ]
+        with patch.object(
+            self.ces, "process_event", side_effect=[AssigmentNotFoundInDatabase("784"), None]
+        ) as mock_process_event:
+            response = self.ces.process_batch(records)
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "1"}]})
+        self.assertEqual(mock_process_event.call_count, 2)
+
+    def test_coalesce_activity_records(self):
+        records = [
+            self._create_record("1", "logged_in", "263480000000000104", "2024-05-10T20:39:26.747Z"),
+            self._create_record("2", "grade_change", "263480000000000104", "2024-05-10T20:40:00.000Z"),
+            self._create_record("3", "logged_in", "263480000000000104", "2024-05-10T18:00:00.000Z"),
+            self._create_record("4", "logged_in", "263480000000000104", "2024-05-10T22:15:00.000Z"),
+            self._create_record("5", "asset_accessed", "263480000000000104", "2024-05-10T20:41:00.000Z"),
+        ]
+        parsed_records, _ = self.ces.parse_records(records)
+        coalesced_records = self.ces.coalesce_activity_records(parsed_records)
+
+        self.assertEqual(
+            [record["event_type"] for record in coalesced_records], ["logged_in", "grade_change", "asset_accessed"]
+        )
+        login = coalesced_records[0]
+        self.assertEqual(login["message_ids"], ["1", "3", "4"])
+        utc = datetime.timezone.utc
+        self.assertEqual(login["envelope"].event_time, datetime.datetime(2024, 5, 10, 22, 15, tzinfo=utc))
+        self.assertEqual(login["envelope"].first_event_time, datetime.datetime(2024, 5, 10, 18, 0, tzinfo=utc))
+        self.assertEqual(login["event"]["metadata"]["coalesced_event_count"], 3)
+        self.assertNotIn("first_event_time", coalesced_records[2]["event"]["metadata"])
+
+    def test_process_batch_coalesces_logins(self):
+        records = [
+            self._create_record("1", "logged_in", "263480000000000104", "2024-05-10T20:39:26.747Z"),
+            self._create_record("2", "logged_in", "263480000000000104", "2024-05-10T18:00:00.000Z"),
+        ]
+        with patch.object(self.ces, "process_event", side_effect=Exception("timeout")) as mock_process_event:
+            response = self.ces.process_batch(records)
+        mock_process_event.assert_called_once()
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "1"}, {"itemIdentifier": "2"}]})
+
+    def test_process_event_skips_events_already_processed(self):
+        event = copy.deepcopy(test_events["grade_change"])
+        self.ces.event_ledger.remember([EventLedger.event_key(event)], OUTCOME_SUCCEEDED)
+        handler = MagicMock()
+        with patch.dict(self.ces._event_type_mapping, {"grade_change": handler}):
+            self.ces.process_event(event)
+        handler.assert_not_called()
+
+    def test_process_event_records_outcome(self):
+        event = copy.deepcopy(test_events["grade_change"])
+        key = EventLedger.event_key(event)
+        handler = MagicMock()
+        handler.return_value.process.side_effect = [Exception("database went away"), True]
+        with patch.dict(self.ces._event_type_mapping, {"grade_change": handler}):
+            with self.assertRaises(Exception):
+                self.ces.process_event(copy.deepcopy(event))
+            self.assertEqual(self.ces.event_ledger.get_outcome(self.psql_engine.session, key), OUTCOME_FAILED)
+            self.ces.process_event(copy.deepcopy(event))
+        self.assertEqual(self.ces.event_ledger.get_outcome(self.psql_engine.session, key), OUTCOME_SUCCEEDED)
+
+    def test_ledger_success_waits_for_salesforce_flush(self):
+        records = [
+            self._create_record("1", "grade_change", "263480000000000104"),
+            self._create_record("2", "grade_change", "263480000000000200"),
+        ]
+        keys = [EventLedger.event_key(json.loads(record["body"])) for record in records]
+        flushed = {"updated": ["0031"], "failed": {"0032": ["UNABLE_TO_LOCK_ROW"]}, "failed_message_ids": ["2"]}
+        handler = MagicMock()
+        with patch.dict(self.ces._event_type_mapping, {"grade_change": handler}), patch.object(
+            SFServices, "flush_writes", return_value=flushed
+        ), patch.object(self.ces.event_ledger, "record") as record, patch("builtins.print"):
+            response = self.ces.process_batch(records)
+        self.assertEqual(response, {"batchItemFailures": [{"itemIdentifier": "2"}]})
+        # nothing is recorded as succeeded inside the events, only the event whose writes were sent is afterwards
+        self.assertEqual(
+            [call.args[1:3] for call in record.call_args_list],
+            [([keys[0]], OUTCOME_SUCCEEDED), ([keys[1]], OUTCOME_FAILED)],
+        )
+        self.assertEqual(self.ces.event_ledger.get_outcome(self.psql_engine.session, keys[0]), OUTCOME_SUCCEEDED)
+
+    def test_no_op_events_touch_nothing(self):
+        self.psql_engine.session.reset_mock()
+        handler = MagicMock()
+        with patch.dict(self.ces._event_type_mapping, {"asset_accessed": handler}):
+            self.ces.process_event(copy.deepcopy(test_events["asset_accessed"]))
+        handler.assert_not_called()
+        self.assertEqual(self.psql_engine.session.mock_calls, [])
+        self.assertFalse(self.ces.is_no_op("grade_change"))
+
+    def test_handler_services_are_built_on_first_use(self):
+        with patch("events.base_event.PSQLServices") as psql_services:
+            handler = AssetAccessedEvent(
+                event=copy.deepcopy(test_events["asset_accessed"]),
+                psql_engine=self.psql_engine,
+                sf_client=self.sf_client,
+                canvas_client=self.canvas_client,
+            )
+            self.assertTrue(handler.process())
+            psql_services.assert_not_called()
+
+            handler.user_info
+            psql_services.assert_called_once_with(self.psql_engine)
+            psql_services.return_value.get_user_info_by_canvas_id.assert_called_once_with(canvas_id="104")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,135 @@
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+from lambda_functions.canvas_events.dlq_drain import DLQDrain, RateLimitedClient, RateLimiter
+from src.exceptions import UserNotFoundInDatabase
+
+from tests.lambda_functions.canvas_events.canvas_test_events import test_events
+
+
+def sqs_message(message_id, body):
+    return {"MessageId": message_id, "ReceiptHandle": f"receipt-{message_id}", "Body": json.dumps(body, default=str)}
+
+
+class TestDLQDrain(unittest.TestCase):
+    def setUp(self):
+        events = list(test_events.values())
+        self.messages = [sqs_message(str(index), events[index % len(events)]) for index in range(12)]
+        self.sqs_client = MagicMock()
+        self.sqs_client.get_queue_url.return_value = {"QueueUrl": "https://sqs/canvas_events_test_dlq.fifo"}
+        self.sqs_client.get_queue_attributes.return_value = {"Attributes": {"ApproximateNumberOfMessages": "0"}}
+        self.sqs_client.receive_message.side_effect = [
+            {"Messages": self.messages[:10]},
+            {"Messages": self.messages[10:]},
+        ] + [{}] * 5
+        self.sqs_client.delete_message_batch.side_effect = lambda QueueUrl, Entries: {
+            "Successful": [{"Id": entry["Id"]} for entry in Entries]
+        }
+
+        self.system = MagicMock()
+        self.system.event_ledger.is_applied.return_value = False
+
+    def _drain(self, max_empty_receives=1, **kwargs):
+        return DLQDrain(
+            queue_name="canvas_events_test_dlq.fifo",
+            environment="test",
+            sqs_client=self.sqs_client,
+            system_factory=lambda environment: self.system,
+            workers=1,
+            max_empty_receives=max_empty_receives,
+            report_interval=3600,
+            **kwargs,
+        )
+
+    def test_messages_are_received_and_deleted_in_batches(self):
+        report = self._drain().run()
+
+        self.assertEqual(self.system.process_event.call_count, 12)
+        self.assertEqual(self.sqs_client.receive_message.call_args.kwargs["MaxNumberOfMessages"], 10)
+        self.assertEqual(self.sqs_client.delete_message_batch.call_count, 2)
+        self.sqs_client.delete_message.assert_not_called()
+        self.assertEqual(report["processed"], 12)
+        self.assertEqual(report["deleted"], 12)
+
+    def test_failed_messages_are_hidden_and_kept(self):
+        failures = [Exception("Salesforce down"), UserNotFoundInDatabase("1")]
+        self.system.process_event.side_effect = failures + [None] * 10
+        report = self._drain().run()
+
+        deleted = [
+            entry["Id"]
+            for call in self.sqs_client.delete_message_batch.call_args_list
+            for entry in call.kwargs["Entries"]
+        ]
+        self.assertNotIn("0", deleted)
+        self.assertIn("1", deleted)
+        hidden = self.sqs_client.change_message_visibility_batch.call_args.kwargs["Entries"]
+        self.assertEqual([(entry["Id"], entry["VisibilityTimeout"]) for entry in hidden], [("0", 900)])
+        self.assertEqual((report["failed"], report["discarded"], report["processed"]), (1, 1, 10))
+
+    def test_events_already_processed_are_skipped(self):
+        self.system.event_ledger.is_applied.return_value = True
+        report = self._drain().run()
+
+        self.system.process_event.assert_not_called()
+        self.assertEqual(report["skipped"], 12)
+        self.assertEqual(report["deleted"], 12)
+
+    def test_dry_run_changes_nothing(self):
+        report = self._drain(dry_run=True).run()
+
+        self.system.process_event.assert_not_called()
+        self.sqs_client.delete_message_batch.assert_not_called()
+        self.assertEqual(report["processed"], 12)
+        # every message is made visible again at the end
+        released = [
+            entry["Id"]
+            for call in self.sqs_client.change_message_visibility_batch.call_args_list
+            for entry in call.kwargs["Entries"]
+            if entry["VisibilityTimeout"] == 0
+        ]
+        self.assertEqual(sorted(released, key=int), [str(index) for index in range(12)])
+        hidden = {
+            entry["VisibilityTimeout"]
+            for call in self.sqs_client.change_message_visibility_batch.call_args_list
+            for entry in call.kwargs["Entries"]
+        }
+        self.assertEqual(hidden, {300, 0})
+
+    def test_dry_run_counts_messages_received_again_once(self):
+        redelivered = [dict(message, ReceiptHandle=f"receipt-{message['MessageId']}-2") for message in self.messages]
+        self.sqs_client.receive_message.side_effect = [
+            {"Messages": self.messages[:10]},
+            {"Messages": redelivered[:10]},
+            {"Messages": self.messages[10:]},
+        ] + [{}] * 5
+        report = self._drain(dry_run=True, max_empty_receives=2).run()
+
+        self.assertEqual((report["received"], report["processed"]), (12, 12))
+        released = {
+            entry["Id"]: entry["ReceiptHandle"]
+            for call in self.sqs_client.change_message_visibility_batch.call_args_list
+            for entry in call.kwargs["Entries"]
+            if entry["VisibilityTimeout"] == 0
+        }
+        self.assertEqual(released["0"], "receipt-0-2")
+        self.assertEqual(released["11"], "receipt-11")
+
+    def test_clients_share_the_rate_limiters(self):
+        drain = self._drain(salesforce_calls_per_second=5, canvas_calls_per_second=2)
+        system = drain.build_system()
+        self.assertIsInstance(system.sf_client, RateLimitedClient)
+        self.assertIs(system.sf_client._limiter, drain.salesforce_limiter)
+        self.assertIs(system.canvas_client._limiter, drain.canvas_limiter)
+
+    @patch("lambda_functions.canvas_events.dlq_drain.time")
+    def test_rate_limiter(self, mock_time):
+        mock_time.monotonic.side_effect = [0.0, 0.0, 0.001]
+        limiter = RateLimiter(1000)
+        limiter._tokens = 0
+        client = RateLimitedClient(MagicMock(name="sf_client"), limiter)
+        client.update_contact("1", {})
+        client._client.update_contact.assert_called_once_with("1", {})
+        mock_time.sleep.assert_called_once_with(0.001)
+        self.assertLess(limiter._tokens, 1)
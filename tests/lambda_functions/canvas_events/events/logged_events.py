@@ -1,3 +1,4 @@
+import copy
 import unittest
 
 from unittest.mock import MagicMock
@@ -36,6 +37,21 @@ class TestCanvasEventLoggedIn(unittest.TestCase):
         response = handler.process()
         self.assertTrue(response)
 
+    def test_coalesced_logged_in_event(self):
+        test_event = copy.deepcopy(test_events["logged_in"])
+        test_event["metadata"]["first_event_time"] = "2024-05-10T18:00:00.000Z"
+        handler = LoggedInEvent(
+            event=test_event, psql_engine=self.psql_engine, sf_client=self.sf_client, canvas_client=self.canvas_client
+        )
+        handler.psql_services = self.psql_engine
+        handler.sf_services = self.sf_client
+        enrollment = MagicMock(first_lms_login=None, last_lms_login=None)
+        self.psql_engine.get_student_enrollment.return_value = enrollment
+
+        handler.process_login_event()
+        self.assertEqual(enrollment.first_lms_login.isoformat(), "2024-05-10T18:00:00+00:00")
+        self.assertEqual(enrollment.last_lms_login, handler.event_info["event_time"])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -31,6 +31,11 @@ def create_mock_psql_services():
     mock_psql_services.update_ect_progress.return_value = True
     mock_psql_services.update_ect_final_grade.return_value = True
     mock_psql_services.calculate_progress.return_value = 100
+    mock_psql_services.get_progress.return_value = {
+        "program": {"competencies": 21, "completed": 3, "percentage": 0.14285714285714285},
+        "course": {"competencies": 7, "completed": 3, "percentage": 0.42857142857142855},
+        "course_code": "COURSE123",
+    }
     mock_psql_services.update_program_progress.return_value = True
     mock_psql_services.get_course_code_by_lms_id.return_value = "COURSE123"
 
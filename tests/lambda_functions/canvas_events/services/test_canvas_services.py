@@ -0,0 +1,110 @@
+import io
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+from urllib.parse import parse_qs, urlsplit
+
+from src.canvas_services import CanvasServices
+from src.submission_history import SubmissionHistoryCache
+
+
+def submission(assignment_id, user_id, attempts):
+    return {
+        "assignment_id": assignment_id,
+        "user_id": user_id,
+        "submission_history": [{"attempt": attempt, "score": 90 + attempt} for attempt in attempts],
+    }
+
+
+class CanvasResponse(io.BytesIO):
+    def __init__(self, body, link: str = None):
+        super().__init__(json.dumps(body).encode())
+        self.headers = {"Link": link} if link else {}
+
+
+class TestSubmissionHistoryCache(unittest.TestCase):
+    def setUp(self):
+        self.canvas_engine = MagicMock()
+        self.canvas_engine.base_url = "https://calbright.instructure.com"
+        self.canvas_engine.application_key = "canvas-token"
+
+        async def get_single_submission(**kwargs):
+            return [submission(int(kwargs["assignment_id"]), int(kwargs["user_id"]), [1])]
+
+        self.canvas_engine.get_single_submission = MagicMock(side_effect=get_single_submission)
+        self.cache = SubmissionHistoryCache()
+        self.canvas_services = CanvasServices(self.canvas_engine, MagicMock(), submission_cache=self.cache)
+
+        # the submissions come back on two pages
+        next_page = "https://calbright.instructure.com/api/v1/courses/263480000000000106/students/submissions?page=2"
+        self.urlopen = patch(
+            "src.submission_history.urlopen",
+            side_effect=[
+                CanvasResponse(
+                    [submission(123, 104, [1, 2]), submission(123, 105, [2])],
+                    link=f'<{next_page}>; rel="next", <https://calbright.instructure.com/first>; rel="first"',
+                ),
+                CanvasResponse([submission(124, 104, [1])]),
+            ],
+        ).start()
+        self.addCleanup(patch.stopall)
+
+    def test_course_is_fetched_once_for_the_batch(self):
+        for assignment_id, user_id in (("123", "104"), ("123", "105"), ("124", "104")):
+            self.cache.register("263480000000000106", assignment_id, user_id)
+
+        first = self.canvas_services.get_first_assignment_submission("123", "104", "263480000000000106")
+        self.assertEqual(first, {"attempt": 1, "score": 91})
+        # without a first attempt, any attempt is used
+        self.assertEqual(
+            self.canvas_services.get_first_assignment_submission("123", "105", "263480000000000106")["attempt"], 2
+        )
+        self.canvas_services.get_first_assignment_submission("124", "104", "263480000000000106")
+
+        self.assertEqual(self.urlopen.call_count, 2)
+        request = self.urlopen.call_args_list[0].args[0]
+        url = urlsplit(request.full_url)
+        self.assertEqual(url.netloc, "calbright.instructure.com")
+        self.assertEqual(url.path, "/api/v1/courses/263480000000000106/students/submissions")
+        # only the batch's students are fetched
+        self.assertEqual(
+            parse_qs(url.query),
+            {
+                "student_ids[]": ["104", "105"],
+                "assignment_ids[]": ["123", "124"],
+                "include[]": ["submission_history"],
+                "per_page": ["100"],
+            },
+        )
+        self.assertEqual(request.get_header("Authorization"), "Bearer canvas-token")
+        self.assertTrue(self.urlopen.call_args_list[1].args[0].full_url.endswith("/students/submissions?page=2"))
+        self.canvas_engine.get_single_submission.assert_not_called()
+        self.assertEqual(self.cache.stats(), {"hits": 3, "misses": 0, "size": 3, "prefetch_failures": 0})
+
+    def test_single_lookups_are_not_prefetched(self):
+        self.cache.register("263480000000000106", "123", "104")
+        self.canvas_services.get_first_assignment_submission("123", "104", "263480000000000106")
+        self.urlopen.assert_not_called()
+        self.canvas_engine.get_single_submission.assert_called_once()
+
+    def test_failed_prefetch_falls_back_to_single_lookups(self):
+        self.urlopen.side_effect = ConnectionError("rate limited")
+        self.cache.register("263480000000000106", "123", "104")
+        self.cache.register("263480000000000106", "123", "105")
+        self.assertEqual(
+            self.canvas_services.get_first_assignment_submission("123", "105", "263480000000000106")["attempt"], 1
+        )
+        self.canvas_services.get_first_assignment_submission("123", "104", "263480000000000106")
+        self.urlopen.assert_called_once()
+        self.assertEqual(self.canvas_engine.get_single_submission.call_count, 2)
+        self.assertEqual(self.cache.stats()["prefetch_failures"], 1)
+
+        self.cache.reset()
+        self.assertEqual(self.cache.stats(), {"hits": 0, "misses": 0, "size": 0, "prefetch_failures": 0})
+
+    def test_unexpected_prefetch_errors_are_raised(self):
+        self.urlopen.side_effect = TypeError("unexpected keyword argument")
+        self.cache.register("263480000000000106", "123", "104")
+        self.cache.register("263480000000000106", "123", "105")
+        with self.assertRaises(TypeError):
+            self.canvas_services.get_first_assignment_submission("123", "105", "263480000000000106")
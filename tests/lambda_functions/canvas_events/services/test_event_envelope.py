@@ -0,0 +1,57 @@
+import copy
+import datetime
+import unittest
+
+from src.event_envelope import CanvasEventEnvelope, to_local_id, to_utc
+
+from tests.lambda_functions.canvas_events.canvas_test_events import test_events
+
+
+class TestCanvasEventEnvelope(unittest.TestCase):
+    def setUp(self):
+        self.event = copy.deepcopy(test_events["submission_created"])
+
+    def test_ids_and_timestamps_are_normalized_once(self):
+        envelope = CanvasEventEnvelope(self.event)
+        self.assertEqual(envelope.event_name, "submission_created")
+        self.assertEqual(envelope.user_id_local, "109")
+        self.assertEqual(envelope.context_id_local, "106")
+        self.assertEqual(envelope.local_id("assignment_id"), "123")
+        self.assertEqual(envelope.local_id("submission_id"), "6")
+        self.assertIsNone(envelope.local_id("quiz_id"))
+
+        utc = datetime.timezone.utc
+        self.assertEqual(envelope.event_time, datetime.datetime(2024, 3, 29, 22, 33, 50, 22000, tzinfo=utc))
+        self.assertEqual(envelope.first_event_time, envelope.event_time)
+        self.assertEqual(envelope.body["submitted_at"], datetime.datetime(2024, 3, 29, 22, 33, 49, tzinfo=utc))
+        self.assertEqual(envelope.metadata["user_id_local"], "109")
+        self.assertEqual(
+            envelope.event_info(),
+            {
+                "event_name": "submission_created",
+                "event_time": envelope.event_time,
+                "first_event_time": envelope.event_time,
+                "context_type": "Course",
+                "context_id": "263480000000000106",
+                "context_account_id": "263480000000000001",
+                "context_id_local": "106",
+            },
+        )
+        self.assertIs(CanvasEventEnvelope.parse(envelope), envelope)
+        # parsing the same event again doesn't change the normalized values
+        self.assertEqual(CanvasEventEnvelope(self.event).event_time, envelope.event_time)
+
+    def test_user_from_body(self):
+        envelope = CanvasEventEnvelope(copy.deepcopy(test_events["course_progress"]))
+        self.assertEqual((envelope.user_id, envelope.user_id_local), ("113", "113"))
+
+        del self.event["body"]["user_id"]
+        self.event["body"]["student_id"] = "263480000000000105"
+        self.assertEqual(CanvasEventEnvelope(self.event).user_id_local, "105")
+
+    def test_helpers(self):
+        self.assertEqual(to_local_id("123"), "123")
+        self.assertEqual(to_local_id("263480000000000123"), "123")
+        self.assertEqual(
+            to_utc("2024-03-29T15:33:49"), datetime.datetime(2024, 3, 29, 22, 33, 49, tzinfo=datetime.timezone.utc)
+        )
@@ -0,0 +1,104 @@
+import copy
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy.dialects import postgresql
+
+from src.event_ledger import OUTCOME_FAILED, OUTCOME_SUCCEEDED, EventLedger
+
+from tests.lambda_functions.canvas_events.canvas_test_events import test_events
+
+
+class TestEventLedger(unittest.TestCase):
+    def setUp(self):
+        self.session = MagicMock()
+        self.ledger = EventLedger()
+        self.event = copy.deepcopy(test_events["grade_change"])
+        self.key = EventLedger.event_key(self.event)
+
+    def test_event_key(self):
+        event_id, event_type = self.key
+        self.assertEqual(event_type, "grade_change")
+        self.assertTrue(event_id.startswith("a6a4eacd-2284-42fa-aea7-d784c238b010:"))
+
+        # events from the same request are told apart by their body
+        other_student = copy.deepcopy(self.event)
+        other_student["body"]["student_id"] = "263480000000000105"
+        self.assertNotEqual(EventLedger.event_key(other_student), self.key)
+
+        with_guid = copy.deepcopy(self.event)
+        with_guid["metadata"]["event_guid"] = "8f0c4e3e-0f3c-4ad7-9a1b-9d0c6b0f4a11"
+        self.assertEqual(EventLedger.event_key(with_guid), ("8f0c4e3e-0f3c-4ad7-9a1b-9d0c6b0f4a11", "grade_change"))
+
+    def test_committed_outcome_is_served_from_cache(self):
+        self.ledger.record(self.session, [self.key], OUTCOME_SUCCEEDED)
+        statement = self.session.execute.call_args.args[0]
+        self.assertIn("ON CONFLICT", str(statement.compile(dialect=postgresql.dialect())))
+
+        # until it is committed, a recorded outcome is read from the table, which a rollback leaves untouched
+        self.session.reset_mock()
+        self.session.execute.return_value.scalar_one_or_none.return_value = None
+        self.assertFalse(self.ledger.is_applied(self.session, [self.key]))
+        self.session.execute.assert_called_once()
+
+        self.ledger.remember([self.key], OUTCOME_SUCCEEDED)
+        self.session.reset_mock()
+        self.assertTrue(self.ledger.is_applied(self.session, [self.key]))
+        self.session.execute.assert_not_called()
+
+        self.ledger.remember([self.key], OUTCOME_FAILED)
+        self.assertFalse(self.ledger.is_applied(self.session, [self.key]))
+
+    def test_prefetch_loads_a_batch_in_one_query(self):
+        other_key = ("c7fff8da-9874-4b33-9741-f5638b19238d:0123456789abcdef", "discussion_entry_created")
+        self.session.execute.return_value.all.return_value = [
+            SimpleNamespace(event_id=self.key[0], event_type=self.key[1], outcome=OUTCOME_SUCCEEDED)
+        ]
+        self.ledger.prefetch(self.session, [self.key, other_key])
+        self.assertTrue(self.ledger.is_applied(self.session, [self.key]))
+        self.assertFalse(self.ledger.is_applied(self.session, [other_key]))
+        self.assertFalse(self.ledger.is_applied(self.session, [self.key, other_key]))
+        self.session.execute.assert_called_once()
+
+    def test_unrecorded_event_is_looked_up(self):
+        self.session.execute.return_value.scalar_one_or_none.return_value = None
+        self.assertIsNone(self.ledger.get_outcome(self.session, self.key))
+        self.session.execute.return_value.scalar_one_or_none.return_value = OUTCOME_SUCCEEDED
+        self.assertEqual(self.ledger.get_outcome(self.session, self.key), OUTCOME_SUCCEEDED)
+
+    def test_unrecorded_events_expire_quickly(self):
+        self.session.execute.return_value.all.return_value = []
+        with patch("src.event_ledger.time.monotonic", return_value=1000):
+            self.ledger.prefetch(self.session, [self.key])
+            self.ledger.remember([("succeeded-event", "grade_change")], OUTCOME_SUCCEEDED)
+        with patch("src.event_ledger.time.monotonic", return_value=1000 + self.ledger.unrecorded_ttl_seconds - 1):
+            self.assertIsNone(self.ledger.get_outcome(self.session, self.key))
+        self.session.execute.assert_called_once()
+
+        # another container recorded the event since the prefetch
+        self.session.execute.return_value.scalar_one_or_none.return_value = OUTCOME_SUCCEEDED
+        with patch("src.event_ledger.time.monotonic", return_value=1000 + self.ledger.unrecorded_ttl_seconds):
+            self.assertTrue(self.ledger.is_applied(self.session, [self.key]))
+            # recorded outcomes keep the long TTL
+            self.assertTrue(self.ledger.is_applied(self.session, [("succeeded-event", "grade_change")]))
+        self.assertEqual(self.session.execute.call_count, 2)
+
+    def test_cache_is_shared_by_threads(self):
+        ledger = EventLedger(max_size=50)
+        keys = [(f"event-{n}", "grade_change") for n in range(400)]
+        start = threading.Barrier(4, timeout=5)
+
+        def remember(offset):
+            start.wait()
+            for key in keys[offset::4]:
+                ledger.remember([key], OUTCOME_SUCCEEDED)
+                ledger.is_applied(self.session, [key])
+
+        threads = [threading.Thread(target=remember, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(ledger._outcomes), 50)
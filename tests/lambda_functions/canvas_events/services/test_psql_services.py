@@ -0,0 +1,270 @@
+import unittest
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import Column, ForeignKey, Integer, String, create_engine, event
+from sqlalchemy.exc import MultipleResultsFound, NoResultFound
+from sqlalchemy.orm import Session, declarative_base, relationship
+from sqlalchemy.pool import StaticPool
+
+from propus.calbright_sql.enrollment_course_term import GradeStatus
+
+from common.reference_data import ReferenceDataCache
+from src.exceptions import CourseNotFoundInDatabase, EnrollmentNotFoundInDatabase
+from src.psql_services import PSQLServices, StudentContext
+
+Base = declarative_base()
+
+
+class Grade(Base):
+    __tablename__ = "grade"
+    id = Column(Integer, primary_key=True)
+    grade = Column(String)
+
+
+class CourseGrade(Base):
+    __tablename__ = "course_grade"
+    id = Column(Integer, primary_key=True)
+    grade_id = Column(Integer, ForeignKey("grade.id"))
+    grade = relationship(Grade)
+
+
+class TestReferenceDataCache(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        Base.metadata.create_all(self.engine)
+        with Session(self.engine) as session:
+            session.add_all([Grade(id=1, grade="P"), Grade(id=2, grade="NP")])
+            session.commit()
+
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute", self._count_statement)
+        self.cache = ReferenceDataCache({Grade: "grade"})
+
+    def _count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def test_lookups_are_served_from_one_load(self):
+        with Session(self.engine) as session:
+            self.assertEqual(self.cache.get_id(session, Grade, "P"), 1)
+            self.assertEqual(self.cache.get_id(session, Grade, "NP"), 2)
+        with Session(self.engine) as session:
+            self.assertEqual(self.cache.get_id(session, Grade, "P"), 1)
+        self.assertEqual(len(self.statements), 1)
+
+    def test_instance_is_merged_without_a_round_trip(self):
+        self.cache.load(Session(self.engine))
+        self.statements.clear()
+        with Session(self.engine) as session:
+            course_grade = CourseGrade(id=1)
+            course_grade.grade = self.cache.get_instance(session, Grade, "NP")
+            session.add(course_grade)
+            session.flush()
+            self.assertEqual(course_grade.grade.grade, "NP")
+            session.commit()
+        self.assertFalse([statement for statement in self.statements if statement.startswith("SELECT")])
+
+        with Session(self.engine) as session:
+            self.assertEqual(session.get(CourseGrade, 1).grade_id, 2)
+
+    def test_missing_name_reloads_once(self):
+        with Session(self.engine) as session:
+            self.cache.get_id(session, Grade, "P")
+            session.add(Grade(id=3, grade="I"))
+            session.commit()
+            self.assertEqual(self.cache.get_id(session, Grade, "I"), 3)
+            with self.assertRaises(NoResultFound):
+                self.cache.get_id(session, Grade, "A")
+
+    def test_unknown_name_is_remembered_until_refresh(self):
+        with Session(self.engine) as session:
+            for _ in range(3):
+                with self.assertRaises(NoResultFound):
+                    self.cache.get_id(session, Grade, "A")
+            self.assertEqual(len(self.statements), 2)
+
+            session.add(Grade(id=3, grade="A"))
+            session.commit()
+            self.cache.invalidate()
+            self.assertEqual(self.cache.get_id(session, Grade, "A"), 3)
+
+    def test_concurrent_lookups_load_once(self):
+        # every worker shares one in-memory database through a single connection
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        Base.metadata.create_all(engine)
+        with Session(engine) as session:
+            session.add(Grade(id=1, grade="P"))
+            session.commit()
+        loads = []
+        event.listen(engine, "before_cursor_execute", lambda *args: loads.append(args[2]))
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            ids = list(executor.map(lambda _: self.cache.get_id(Session(engine), Grade, "P"), range(8)))
+        self.assertEqual(ids, [1] * 8)
+        self.assertEqual(len(loads), 1)
+
+    def test_stale_tables_are_reloaded(self):
+        cache = ReferenceDataCache({Grade: "grade"}, refresh_seconds=0)
+        with Session(self.engine) as session:
+            cache.get_id(session, Grade, "P")
+            cache.get_id(session, Grade, "P")
+        self.assertEqual(len(self.statements), 2)
+
+
+class TestUnitOfWork(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        Base.metadata.create_all(self.engine)
+        self.session = Session(self.engine)
+        self.psql_services = PSQLServices(SimpleNamespace(session=self.session))
+        self.commits = []
+        event.listen(self.session, "after_commit", lambda session: self.commits.append(session))
+
+    def _grades(self):
+        with Session(self.engine) as session:
+            return sorted(grade.grade for grade in session.query(Grade).all())
+
+    def test_event_is_committed_once(self):
+        with self.psql_services.unit_of_work():
+            self.psql_services.update_object(Grade(id=1, grade="P"))
+            self.psql_services.update_object(Grade(id=2, grade="NP"))
+        self.assertEqual(len(self.commits), 1)
+        self.assertEqual(self._grades(), ["NP", "P"])
+
+    def test_failed_event_is_rolled_back(self):
+        with self.assertRaises(ValueError):
+            with self.psql_services.unit_of_work():
+                self.psql_services.update_object(Grade(id=1, grade="P"))
+                raise ValueError("failed")
+        self.assertEqual(self._grades(), [])
+
+    def test_failed_optional_step_only_rolls_back_the_savepoint(self):
+        with self.psql_services.unit_of_work():
+            self.psql_services.update_object(Grade(id=1, grade="P"))
+            with self.assertRaises(ValueError):
+                with self.psql_services.savepoint():
+                    self.psql_services.update_object(Grade(id=2, grade="NP"))
+                    raise ValueError("failed")
+        self.assertEqual(self._grades(), ["P"])
+
+    def test_commits_without_unit_of_work(self):
+        self.psql_services.update_object(Grade(id=1, grade="P"))
+        self.psql_services.update_object(Grade(id=2, grade="NP"))
+        self.assertEqual(len(self.commits), 2)
+
+
+class TestStudentContext(unittest.TestCase):
+    def setUp(self):
+        self.user_lms = MagicMock()
+        self.user_lms.user.ccc_id = "CCC123"
+        self.user_lms.user.calbright_email = "student@calbright.org"
+        self.enrollment = MagicMock(id="ENROLLMENT1", enrollment_status_id="Enrolled")
+        self.course_terms = []
+        for course_lms_id in ("101", "102"):
+            course_term = MagicMock(grade_status=GradeStatus("Not Graded"))
+            course_term.course_version_section.program_version_course.course_version.lms_id = course_lms_id
+            self.course_terms.append(course_term)
+
+        self.psql_engine = MagicMock()
+        self.psql_engine.session.execute.return_value.all.return_value = [
+            SimpleNamespace(UserLms=self.user_lms, Enrollment=self.enrollment, EnrollmentCourseTerm=course_term)
+            for course_term in self.course_terms
+        ]
+        self.psql_services = PSQLServices(self.psql_engine)
+
+        # reference data IDs are the names themselves
+        patcher = patch("src.psql_services.reference_data")
+        self.reference_data = patcher.start()
+        self.reference_data.get_id.side_effect = lambda session, model, name: name
+        self.addCleanup(patcher.stop)
+
+    def test_context_is_loaded_once_per_event(self):
+        self.assertEqual(
+            self.psql_services.get_user_info_by_canvas_id("1234"),
+            {"ccc_id": "CCC123", "email": "student@calbright.org"},
+        )
+        self.assertIs(self.psql_services.get_student_enrollment("1234"), self.enrollment)
+        self.assertIs(self.psql_services.get_student_context("1234").get_course_term("102"), self.course_terms[1])
+        self.assertTrue(self.psql_services.update_ect_progress("CCC123", "102", 0.5))
+        self.assertEqual(self.course_terms[1].progress, 50)
+        self.assertEqual(self.psql_engine.session.execute.call_count, 1)
+
+    def test_missing_enrollment(self):
+        self.psql_engine.session.execute.return_value.all.return_value = [
+            SimpleNamespace(UserLms=self.user_lms, Enrollment=None, EnrollmentCourseTerm=None)
+        ]
+        self.assertEqual(self.psql_services.get_user_info_by_canvas_id("1234")["ccc_id"], "CCC123")
+        with self.assertRaises(EnrollmentNotFoundInDatabase):
+            self.psql_services.get_student_enrollment("1234")
+        self.assertIsNone(self.psql_services.get_student_context("1234").get_course_term("101"))
+
+    def test_final_grade_for_an_enrollment_that_is_no_longer_active(self):
+        self.enrollment.enrollment_status_id = "Completed"
+        self.psql_services.get_user_info_by_canvas_id("1234")
+        with self.assertRaises(EnrollmentNotFoundInDatabase):
+            self.psql_services.get_student_enrollment("1234")
+
+        grade_timestamp = datetime(2024, 5, 1, tzinfo=timezone.utc)
+        course = self.psql_services.update_ect_final_grade("CCC123", "102", "P", grade_timestamp, "5678")
+        self.assertIs(course, self.course_terms[1])
+        self.assertEqual(
+            (course.grade_status, course.grade, course.grade_date, course.progress),
+            (GradeStatus("Submitted"), self.reference_data.get_instance.return_value, grade_timestamp, 100),
+        )
+
+    def test_multiple_enrollments_only_fail_enrollment_lookups(self):
+        context = StudentContext("1234", self.user_lms, [self.enrollment, MagicMock(id="ENROLLMENT2")], [])
+        self.assertEqual((context.ccc_id, context.email), ("CCC123", "student@calbright.org"))
+        with self.assertRaises(MultipleResultsFound):
+            context.enrollment
+
+    def test_progress_update_without_context_is_one_statement(self):
+        self.psql_engine.session.execute.return_value.rowcount = 1
+        self.assertTrue(self.psql_services.update_ect_progress("CCC123", "102", 0.5))
+        statement = self.psql_engine.session.execute.call_args.args[0]
+        self.assertTrue(statement.is_dml)
+        self.assertIn("course_version.lms_id", str(statement))
+        self.assertEqual(self.psql_engine.session.execute.call_count, 1)
+
+        self.psql_engine.session.execute.return_value.rowcount = 0
+        self.assertFalse(self.psql_services.update_ect_progress("CCC123", "103", 0.5))
+
+
+class TestPSQLServicesProgress(unittest.TestCase):
+    def setUp(self):
+        self.psql_engine = MagicMock()
+        self.psql_services = PSQLServices(self.psql_engine)
+        self.psql_services.get_student_enrollment = MagicMock(return_value=MagicMock(id="ENROLLMENT1"))
+
+    def test_progress_is_fetched_in_one_bound_query(self):
+        self.psql_engine.session.execute.return_value.fetchone.return_value = SimpleNamespace(
+            program_progress={"enrollment_id": "ENROLLMENT1", "competencies": 21, "completed": 3, "percentage": 0.5},
+            course_progress={
+                "enrollment_id": "ENROLLMENT1",
+                "course_id": "COURSE1",
+                "competencies": 7,
+                "completed": 3,
+                "percentage": 0.25,
+            },
+            course_code="BUS500",
+        )
+        progress = self.psql_services.get_progress(lms_id="1234", course_lms_id="101")
+        self.assertEqual(
+            progress,
+            {
+                "program": {"competencies": 21, "completed": 3, "percentage": 0.5},
+                "course": {"competencies": 7, "completed": 3, "percentage": 0.25},
+                "course_code": "BUS500",
+            },
+        )
+        statement, params = self.psql_engine.session.execute.call_args.args
+        self.assertEqual(params, {"enrollment_id": "ENROLLMENT1", "course_lms_id": "101"})
+        self.assertNotIn("ENROLLMENT1", str(statement))
+        self.assertEqual(self.psql_engine.session.execute.call_count, 1)
+
+    def test_unknown_course(self):
+        self.psql_engine.session.execute.return_value.fetchone.return_value = None
+        with self.assertRaises(CourseNotFoundInDatabase):
+            self.psql_services.get_progress(lms_id="1234", course_lms_id="101")
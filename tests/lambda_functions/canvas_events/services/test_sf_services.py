@@ -0,0 +1,495 @@
+import datetime
+import json
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy.dialects import postgresql
+
+from common.sf_collections import update_records
+from src.activity_timestamps import ActivityTimestampStore
+from src.contact_cache import ContactCache
+from src.sf_fanout import SalesforceFanOut
+from src.sf_services import SFServices
+from src.sf_write_buffer import SFWriteBuffer
+
+
+class TestSFServices(unittest.TestCase):
+    def setUp(self):
+        self.sf_client = MagicMock()
+        self.sf_client.custom_query.return_value = {
+            "totalSize": 1,
+            "records": [
+                {
+                    "Id": "CONTACT123",
+                    "Course_1__c": "BUS500",
+                    "Course_2__c": "BUS501",
+                    "Course_3__c": None,
+                    "Last_Strut_SAA_Timestamp__c": "2024-03-30T00:18:00.000+0000",
+                    "Last_Strut_Activity_Timestamp__c": None,
+                }
+            ],
+        }
+        self.sf_client.base_url = "https://calbright.my.salesforce.com/services/data/v59.0/"
+        self.sf_services = SFServices(self.sf_client, cache=ContactCache())
+
+    def test_contact_lookups_share_one_query(self):
+        self.assertEqual(self.sf_services.get_contact_id("student@calbright.org"), "CONTACT123")
+        self.assertEqual(
+            self.sf_services.get_contact_field("student@calbright.org", "Last_Strut_SAA_Timestamp__c"),
+            datetime.datetime(2024, 3, 30, 0, 18, tzinfo=datetime.timezone.utc),
+        )
+        self.assertEqual(self.sf_services.get_courses("CONTACT123"), {1: "BUS500", 2: "BUS501", 3: None})
+        self.sf_client.custom_query.assert_called_once()
+        self.assertEqual(self.sf_services.contact_cache.stats(), {"hits": 2, "misses": 1, "size": 1})
+
+    def test_update_course_progress_uses_cache(self):
+        self.assertTrue(self.sf_services.update_course_progress("student@calbright.org", "BUS501", 0.5))
+        self.assertTrue(self.sf_services.update_course_progress("student@calbright.org", "BUS501", 0.75))
+        self.sf_client.custom_query.assert_called_once()
+        self.sf_client.update_contact_record.assert_called_with(salesforce_id="CONTACT123", Course_2_Progress__c=75)
+
+    def test_cache_updated_after_write(self):
+        timestamp = datetime.datetime(2024, 4, 2, 10, 0, tzinfo=datetime.timezone.utc)
+        self.sf_services.update_last_lms_timestamp("student@calbright.org", timestamp)
+        self.sf_client.update_contact_record.assert_called_once_with(
+            salesforce_id="CONTACT123", Last_Strut_Activity_Timestamp__c="2024-04-02T10:00:00.000Z"
+        )
+        self.assertEqual(
+            self.sf_services.get_contact_field("student@calbright.org", "Last_Strut_Activity_Timestamp__c"), timestamp
+        )
+        # an older activity timestamp doesn't need a write, and the cached value answers the read
+        self.sf_services.update_last_lms_timestamp("student@calbright.org", timestamp - datetime.timedelta(days=1))
+        self.sf_client.update_contact_record.assert_called_once()
+        self.sf_client.custom_query.assert_called_once()
+
+    def test_missing_contact_is_not_cached(self):
+        self.sf_client.custom_query.return_value = {"totalSize": 0, "records": []}
+        self.assertIsNone(self.sf_services.get_contact_id("missing@calbright.org"))
+        self.assertIsNone(self.sf_services.get_contact_id("missing@calbright.org"))
+        self.assertEqual(self.sf_client.custom_query.call_count, 2)
+
+    def test_buffered_writes_are_merged_per_contact(self):
+        self.sf_client.session.patch.return_value.json.return_value = [
+            {"id": "CONTACT123", "success": True, "errors": []}
+        ]
+        timestamp = datetime.datetime(2024, 4, 2, 10, 0, tzinfo=datetime.timezone.utc)
+        with SFServices.buffer_writes() as buffer:
+            buffer.track(["message-1"])
+            self.sf_services.update_contact_saa_timestamp("student@calbright.org", timestamp)
+            self.sf_services.update_course_progress("student@calbright.org", "BUS500", 0.25, timestamp)
+            buffer.track(["message-2"])
+            self.sf_services.update_course_progress(
+                "student@calbright.org", "BUS500", 0.5, timestamp + datetime.timedelta(minutes=5)
+            )
+            self.sf_client.update_contact_record.assert_not_called()
+            results = self.sf_services.flush_writes(buffer)
+
+        self.sf_client.session.patch.assert_called_once_with(
+            "https://calbright.my.salesforce.com/services/data/v59.0/composite/sobjects",
+            json={
+                "allOrNone": False,
+                "records": [
+                    {
+                        "attributes": {"type": "Contact"},
+                        "id": "CONTACT123",
+                        "Last_Strut_SAA_Timestamp__c": "2024-04-02T10:00:00.000Z",
+                        "Course_1_Progress__c": 50,
+                    }
+                ],
+            },
+        )
+        self.assertEqual(results["updated"], ["CONTACT123"])
+        self.assertIsNone(self.sf_services.write_buffer)
+
+    def test_write_buffers_are_per_thread(self):
+        both_open = threading.Barrier(2, timeout=5)
+
+        def run_batch(email):
+            with SFServices.buffer_writes() as buffer:
+                both_open.wait()
+                self.sf_services.update_learner_status(email, "Started Program Pathway")
+                both_open.wait()
+                return buffer.pending_records()
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            batches = list(executor.map(run_batch, ["one@calbright.org", "two@calbright.org"]))
+        self.assertEqual([len(records) for records in batches], [1, 1])
+        self.sf_client.update_contact_record.assert_not_called()
+
+    def test_fanned_out_writes_go_to_the_event_buffer(self):
+        fanout = SalesforceFanOut(ThreadPoolExecutor(max_workers=1))
+        timestamp = datetime.datetime(2024, 4, 2, 10, 0, tzinfo=datetime.timezone.utc)
+        with SFServices.buffer_writes() as buffer:
+            self.sf_services.advance_contact_timestamp(
+                "student@calbright.org", "Last_Strut_Activity_Timestamp__c", timestamp, fanout=fanout
+            )
+            fanout.wait()
+        fanout.executor.shutdown()
+        self.assertEqual(len(buffer), 1)
+        self.sf_client.update_contact_record.assert_not_called()
+
+    def test_collection_fallback_is_counted(self):
+        self.sf_client.session.patch.side_effect = Exception("404 Client Error: Not Found")
+        buffer = SFWriteBuffer()
+        buffer.add("CONTACT123", None, Course_1_Progress__c=10)
+        with patch("builtins.print") as emitted:
+            results = self.sf_services.flush_writes(buffer)
+        self.assertEqual(results["updated"], ["CONTACT123"])
+        self.sf_client.update_contact_record.assert_called_once_with(
+            salesforce_id="CONTACT123", Course_1_Progress__c=10
+        )
+        self.assertEqual(json.loads(emitted.call_args.args[0])["SalesforceCollectionFallback"], 1)
+
+    def test_failed_buffered_writes_are_reported(self):
+        self.sf_client.session.patch.return_value.json.return_value = [
+            {"id": "CONTACT123", "success": False, "errors": [{"statusCode": "UNABLE_TO_LOCK_ROW"}]}
+        ]
+        with SFServices.buffer_writes() as buffer:
+            buffer.track(["message-1"])
+            self.sf_services.update_learner_status("student@calbright.org", "Started Program Pathway")
+            results = self.sf_services.flush_writes(buffer)
+        self.assertEqual(results["failed_message_ids"], ["message-1"])
+        self.assertEqual(self.sf_services.contact_cache.stats()["size"], 0)
+
+    def test_known_timestamps_skip_salesforce_reads(self):
+        session = MagicMock()
+        session.execute.return_value.one_or_none.return_value = None
+        store = ActivityTimestampStore()
+        timestamp = datetime.datetime(2024, 4, 2, 10, 0, tzinfo=datetime.timezone.utc)
+        sf_services = SFServices(self.sf_client, cache=ContactCache(), session=session, timestamp_store=store)
+        self.assertTrue(sf_services.update_last_lms_timestamp("student@calbright.org", timestamp))
+        self.sf_client.custom_query.assert_called_once()
+        saved = session.execute.call_args.args[0].compile(dialect=postgresql.dialect()).params
+        self.assertEqual((saved["contact_id"], saved["value"]), ("CONTACT123", timestamp))
+
+        # a cold contact cache doesn't matter once the value is known
+        known = SimpleNamespace(contact_id="CONTACT123", value=timestamp)
+        session.execute.return_value.one_or_none.return_value = known
+        sf_services = SFServices(self.sf_client, cache=ContactCache(), session=session, timestamp_store=store)
+        self.assertFalse(
+            sf_services.advance_contact_timestamp(
+                "student@calbright.org", "Last_Strut_Activity_Timestamp__c", timestamp - datetime.timedelta(hours=1)
+            )
+        )
+        self.assertTrue(
+            sf_services.advance_contact_timestamp(
+                "student@calbright.org", "Last_Strut_Activity_Timestamp__c", timestamp + datetime.timedelta(hours=1)
+            )
+        )
+        self.sf_client.custom_query.assert_called_once()
+        self.assertEqual(self.sf_client.update_contact_record.call_count, 2)
+
+        # the SAA value Salesforce already holds is read once and saved
+        session.execute.return_value.one_or_none.return_value = None
+        saa_timestamp = datetime.datetime(2024, 3, 29, tzinfo=datetime.timezone.utc)
+        self.assertFalse(
+            sf_services.advance_contact_timestamp("student@calbright.org", "Last_Strut_SAA_Timestamp__c", saa_timestamp)
+        )
+        saved = session.execute.call_args.args[0].compile(dialect=postgresql.dialect()).params
+        self.assertEqual(
+            (saved["sf_field"], saved["value"]),
+            ("Last_Strut_SAA_Timestamp__c", datetime.datetime(2024, 3, 30, 0, 18, tzinfo=datetime.timezone.utc)),
+        )
+
+
+class TestSalesforceFanOut(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_inline_calls_run_right_away(self):
+        fanout = SalesforceFanOut()
+        self.assertFalse(fanout.concurrent)
+        self.assertEqual(fanout.submit(lambda value: value * 2, 21), 42)
+        self.assertEqual(fanout.submit(lambda: "written", on_result=str.upper), "WRITTEN")
+
+    def test_calls_overlap_and_results_are_handled_on_the_waiting_thread(self):
+        fanout = SalesforceFanOut(self.executor)
+        both_running = threading.Barrier(2, timeout=5)
+        result_threads = []
+
+        def call(value):
+            both_running.wait()
+            return value
+
+        fanout.submit(call, 1, on_result=lambda value: result_threads.append((value, threading.get_ident())))
+        fanout.submit(call, 2, on_result=lambda value: result_threads.append((value, threading.get_ident())))
+        self.assertEqual(result_threads, [])
+        fanout.wait()
+        self.assertEqual(result_threads, [(1, threading.get_ident()), (2, threading.get_ident())])
+
+    def test_errors_are_raised_after_every_call_finished(self):
+        fanout = SalesforceFanOut(self.executor)
+        finished = []
+
+        def fail():
+            raise Exception("UNABLE_TO_LOCK_ROW")
+
+        fanout.submit(fail)
+        fanout.submit(lambda: finished.append(True))
+        with self.assertRaises(Exception) as raised:
+            fanout.wait()
+        self.assertEqual(str(raised.exception), "UNABLE_TO_LOCK_ROW")
+        self.assertEqual(finished, [True])
+
+        fanout.submit(fail)
+        fanout.wait(raise_errors=False)
+
+    def test_known_timestamps_are_saved_after_the_wait(self):
+        sf_client = MagicMock()
+        sf_client.custom_query.return_value = {
+            "totalSize": 1,
+            "records": [{"Id": "CONTACT123", "Last_Strut_SAA_Timestamp__c": None}],
+        }
+        store = MagicMock()
+        store.get.return_value = None
+        sf_services = SFServices(sf_client, cache=ContactCache(), session=MagicMock(), timestamp_store=store)
+        fanout = SalesforceFanOut(self.executor)
+        timestamp = datetime.datetime(2024, 4, 2, 10, 0, tzinfo=datetime.timezone.utc)
+
+        self.assertTrue(
+            sf_services.advance_contact_timestamp(
+                "student@calbright.org", "Last_Strut_SAA_Timestamp__c", timestamp, fanout=fanout
+            )
+        )
+        store.advance.assert_not_called()
+        fanout.wait()
+        sf_client.update_contact_record.assert_called_once_with(
+            salesforce_id="CONTACT123", Last_Strut_SAA_Timestamp__c="2024-04-02T10:00:00.000Z"
+        )
+        store.advance.assert_called_once_with(
+            sf_services.session, "student@calbright.org", "Last_Strut_SAA_Timestamp__c", "CONTACT123", timestamp
+        )
+
+
+class TestSFWriteBuffer(unittest.TestCase):
+    def test_last_writer_wins_by_event_timestamp(self):
+        buffer = SFWriteBuffer()
+        newer = datetime.datetime(2024, 4, 2, 10, 0, tzinfo=datetime.timezone.utc)
+        older = newer - datetime.timedelta(hours=1)
+        buffer.add("CONTACT123", newer, Course_1_Progress__c=50)
+        buffer.add("CONTACT123", older, Course_1_Progress__c=25, Completed_Course_1__c=True)
+        self.assertEqual(
+            buffer.pending_records(),
+            [
+                {
+                    "attributes": {"type": "Contact"},
+                    "id": "CONTACT123",
+                    "Course_1_Progress__c": 50,
+                    "Completed_Course_1__c": True,
+                }
+            ],
+        )
+
+    def test_flush_maps_errors_to_messages(self):
+        buffer = SFWriteBuffer()
+        buffer.track(["message-1"])
+        buffer.add("CONTACT1", None, Course_1_Progress__c=10)
+        buffer.track(["message-2"])
+        buffer.add("CONTACT2", None, Course_1_Progress__c=10)
+        results = buffer.flush(MagicMock(return_value={"CONTACT1": [], "CONTACT2": ["UNABLE_TO_LOCK_ROW"]}))
+        self.assertEqual(results["updated"], ["CONTACT1"])
+        self.assertEqual(results["failed"], {"CONTACT2": ["UNABLE_TO_LOCK_ROW"]})
+        self.assertEqual(results["failed_message_ids"], ["message-2"])
+        self.assertEqual(len(buffer), 0)
+
+    def test_flush_fails_records_without_a_result(self):
+        buffer = SFWriteBuffer()
+        buffer.track(["message-1"])
+        buffer.add("CONTACT1", None, Course_1_Progress__c=10)
+        buffer.track(["message-2"])
+        buffer.add("CONTACT2", None, Course_1_Progress__c=10)
+        results = buffer.flush(MagicMock(return_value={"CONTACT1": []}))
+        self.assertEqual(results["updated"], ["CONTACT1"])
+        self.assertEqual(results["failed"], {"CONTACT2": ["no result returned"]})
+        self.assertEqual(results["failed_message_ids"], ["message-2"])
+
+    def test_flush_reports_failed_request(self):
+        buffer = SFWriteBuffer()
+        buffer.track(["message-1", "message-2"])
+        buffer.add("CONTACT123", None, Course_1_Progress__c=10)
+        results = buffer.flush(MagicMock(side_effect=Exception("REQUEST_LIMIT_EXCEEDED")))
+        self.assertEqual(results["failed"], {"CONTACT123": ["REQUEST_LIMIT_EXCEEDED"]})
+        self.assertEqual(results["failed_message_ids"], ["message-1", "message-2"])
+
+
+class TestSalesforceCollections(unittest.TestCase):
+    def setUp(self):
+        self.sf_client = MagicMock()
+        self.sf_client.base_url = "https://calbright.my.salesforce.com/services/data/v59.0"
+        self.sf_client.session.patch.side_effect = lambda url, json: MagicMock(
+            json=MagicMock(return_value=[{"id": record["id"], "success": True} for record in json["records"]])
+        )
+
+    def records(self, count: int):
+        return [
+            {"attributes": {"type": "Contact"}, "id": f"CONTACT{n}", "Course_1_Progress__c": 10} for n in range(count)
+        ]
+
+    def test_records_are_sent_200_at_a_time(self):
+        errors = update_records(self.sf_client, self.records(450), "Castor/CanvasEvents", MagicMock())
+        calls = self.sf_client.session.patch.call_args_list
+        self.assertEqual([len(call.kwargs["json"]["records"]) for call in calls], [200, 200, 50])
+        self.assertEqual(
+            {call.args[0] for call in calls},
+            {"https://calbright.my.salesforce.com/services/data/v59.0/composite/sobjects"},
+        )
+        self.assertTrue(all(call.kwargs["json"]["allOrNone"] is False for call in calls))
+        self.assertEqual(len(errors), 450)
+        self.assertFalse(any(errors.values()))
+
+    def test_records_without_a_result_failed(self):
+        self.sf_client.session.patch.side_effect = None
+        self.sf_client.session.patch.return_value.json.return_value = [
+            {"id": "CONTACT0", "success": False, "errors": [{"statusCode": "UNABLE_TO_LOCK_ROW"}]}
+        ]
+        errors = update_records(self.sf_client, self.records(2), "Castor/CanvasEvents", MagicMock())
+        self.assertEqual(
+            errors, {"CONTACT0": [{"statusCode": "UNABLE_TO_LOCK_ROW"}], "CONTACT1": ["no result returned"]}
+        )
+
+    def test_failed_request_falls_back_to_single_updates(self):
+        self.sf_client.session.patch.side_effect = Exception("REQUEST_LIMIT_EXCEEDED")
+        self.sf_client.update_contact_record.side_effect = [None, Exception("ENTITY_IS_DELETED")]
+        logger = MagicMock()
+        with patch("builtins.print") as emitted:
+            errors = update_records(self.sf_client, self.records(2), "Castor/EventSystem", logger)
+        self.assertEqual(errors, {"CONTACT0": [], "CONTACT1": ["ENTITY_IS_DELETED"]})
+        line = json.loads(emitted.call_args.args[0])
+        self.assertEqual(line["SalesforceCollectionFallback"], 2)
+        self.assertEqual(line["_aws"]["CloudWatchMetrics"][0]["Namespace"], "Castor/EventSystem")
+        logger.warning.assert_called_once()
+
+
+class TestContactCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = ContactCache(max_size=2)
+        cache.put("1", {"Id": "1"}, email="one@calbright.org")
+        cache.put("2", {"Id": "2"}, email="two@calbright.org")
+        cache.get(contact_id="1")
+        cache.put("3", {"Id": "3"}, email="three@calbright.org")
+        self.assertIsNone(cache.get(email="two@calbright.org"))
+        self.assertEqual(cache.get(email="one@calbright.org"), {"Id": "1"})
+        self.assertEqual(cache.get(contact_id="3"), {"Id": "3"})
+
+    def test_ttl_expiry(self):
+        cache = ContactCache(ttl_seconds=60)
+        with patch("src.contact_cache.time.monotonic", return_value=1000):
+            cache.put("1", {"Id": "1"}, email="one@calbright.org")
+        with patch("src.contact_cache.time.monotonic", return_value=1059):
+            self.assertEqual(cache.get(email="one@calbright.org"), {"Id": "1"})
+        with patch("src.contact_cache.time.monotonic", return_value=1061):
+            self.assertIsNone(cache.get(email="one@calbright.org"))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "size": 0})
+
+
+class TestActivityTimestampStore(unittest.TestCase):
+    def setUp(self):
+        self.session = MagicMock()
+        self.store = ActivityTimestampStore()
+        self.timestamp = datetime.datetime(2024, 4, 2, 10, 0, tzinfo=datetime.timezone.utc)
+
+    def test_values_only_move_forward(self):
+        self.store.advance(self.session, "one@calbright.org", "Last_Strut_SAA_Timestamp__c", "1", self.timestamp)
+        statement = self.session.execute.call_args.args[0]
+        compiled = str(statement.compile(dialect=postgresql.dialect()))
+        self.assertIn("ON CONFLICT", compiled)
+        self.assertIn("WHERE canvas_contact_timestamps.value < excluded.value", compiled)
+
+    def test_writes_are_not_answered_from_memory(self):
+        self.session.execute.return_value.one_or_none.return_value = SimpleNamespace(
+            contact_id="1", value=self.timestamp.replace(tzinfo=None)
+        )
+        self.assertEqual(
+            self.store.get(self.session, "one@calbright.org", "Last_Strut_Activity_Timestamp__c"), ("1", self.timestamp)
+        )
+        # an advance that is rolled back is never answered from memory
+        newer = self.timestamp.replace(year=2025)
+        self.store.advance(self.session, "one@calbright.org", "Last_Strut_Activity_Timestamp__c", "1", newer)
+        self.session.execute.return_value.one_or_none.return_value = None
+        self.assertIsNone(self.store.get(self.session, "one@calbright.org", "Last_Strut_Activity_Timestamp__c"))
+        self.assertIsNone(self.store.get(self.session, "one@calbright.org", "Last_Strut_Activity_Timestamp__c"))
+        self.assertEqual(self.store.stats(), {"hits": 1, "memory_hits": 0, "misses": 2, "size": 0})
+
+    def test_reads_are_answered_from_memory_briefly(self):
+        self.session.execute.return_value.one_or_none.return_value = SimpleNamespace(
+            contact_id="1", value=self.timestamp
+        )
+        with patch("src.activity_timestamps.time.monotonic", return_value=1000):
+            for _ in range(3):
+                self.assertEqual(
+                    self.store.get(self.session, "one@calbright.org", "Last_Strut_SAA_Timestamp__c"),
+                    ("1", self.timestamp),
+                )
+        self.assertEqual(self.session.execute.call_count, 1)
+        self.assertEqual(self.store.stats(), {"hits": 1, "memory_hits": 2, "misses": 0, "size": 1})
+
+        # after the TTL, a value another container moved forward is read from the table
+        with patch("src.activity_timestamps.time.monotonic", return_value=1000 + self.store.ttl_seconds):
+            self.store.get(self.session, "one@calbright.org", "Last_Strut_SAA_Timestamp__c")
+        self.assertEqual(self.session.execute.call_count, 2)
+
+        # contacts whose Salesforce write failed are dropped from memory too
+        self.store.forget_contacts(self.session, ["1"])
+        self.assertEqual(self.store.stats()["size"], 0)
+
+    def _rows(self, contact_id, *sf_fields):
+        return [
+            SimpleNamespace(
+                email=f"{contact_id}@calbright.org", sf_field=sf_field, contact_id=contact_id, value=self.timestamp
+            )
+            for sf_field in sf_fields
+        ]
+
+    def test_reconcile_repairs_drift(self):
+        rows = (
+            self._rows("1", "Last_Strut_SAA_Timestamp__c", "Last_Strut_Activity_Timestamp__c")
+            + self._rows("2", "Last_Strut_SAA_Timestamp__c")
+            + self._rows("3", "Last_Strut_SAA_Timestamp__c")
+        )
+        pages = []
+
+        def execute(statement):
+            result = MagicMock()
+            sql = str(statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+            if sql.startswith("SELECT DISTINCT"):
+                after = statement.compile().params.get("contact_id_1")
+                ids = sorted({row.contact_id for row in rows if after is None or row.contact_id > after})[:2]
+                pages.append(ids)
+                result.scalars.return_value.all.return_value = ids
+            elif sql.startswith("SELECT"):
+                result.all.return_value = [row for row in rows if f"'{row.contact_id}'" in sql]
+            return result
+
+        self.session.execute.side_effect = execute
+        sf_client = MagicMock()
+        sf_client.custom_query.side_effect = [
+            {
+                "records": [
+                    {
+                        "Id": "1",
+                        "Last_Strut_SAA_Timestamp__c": "2024-04-03T00:00:00.000+0000",
+                        "Last_Strut_Activity_Timestamp__c": "2024-04-01T00:00:00.000+0000",
+                    }
+                ]
+            },
+            {"records": [{"Id": "3", "Last_Strut_SAA_Timestamp__c": "2024-04-02T10:00:00.000+0000"}]},
+        ]
+        stats = self.store.reconcile(self.session, sf_client, batch_size=2)
+
+        self.assertEqual(stats, {"checked": 2, "advanced": 1, "rewritten": 1, "dropped": 1})
+        self.assertEqual(pages, [["1", "2"], ["3"], []])
+        # each page is its own Salesforce query
+        self.assertIn("WHERE Id IN ('1', '2')", sf_client.custom_query.call_args_list[0].args[0])
+        self.assertIn("WHERE Id IN ('3')", sf_client.custom_query.call_args_list[1].args[0])
+        sf_client.update_contact_record.assert_called_once_with(
+            salesforce_id="1", Last_Strut_Activity_Timestamp__c="2024-04-02T10:00:00.000Z"
+        )
+        self.assertEqual(self.session.commit.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import unittest
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, text
+
+from common.sql_metrics import SQLMetrics, statement_shape
+
+
+class TestSQLMetrics(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        self.metrics = SQLMetrics(namespace="Test", n_plus_one_threshold=3, enabled=True)
+        self.metrics.instrument(self.engine)
+        # instrumenting twice must not count statements twice
+        self.metrics.instrument(self.engine)
+
+    def run_event(self, event_type, step_queries):
+        with patch("builtins.print") as emitted, self.engine.connect() as conn:
+            with self.metrics.event(event_type):
+                for step, queries in step_queries:
+                    with self.metrics.step(step):
+                        for query in queries:
+                            conn.execute(text(query))
+        return [json.loads(call.args[0]) for call in emitted.call_args_list]
+
+    def test_statements_are_attributed_to_steps(self):
+        lines = self.run_event(
+            "grade_change", [("saa_timestamp", ["SELECT 1", "SELECT 2"]), ("progress", ["SELECT 3"])]
+        )
+        by_step = {line["Step"]: line for line in lines}
+
+        self.assertEqual(by_step["saa_timestamp"]["SQLStatements"], 2)
+        self.assertEqual(by_step["progress"]["SQLStatements"], 1)
+        self.assertEqual(by_step["total"]["SQLStatements"], 3)
+        self.assertEqual(by_step["total"]["NPlusOneStatements"], 0)
+        self.assertEqual(by_step["total"]["EventType"], "grade_change")
+        directive = by_step["total"]["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(directive["Namespace"], "Test")
+        self.assertIn({"Name": "SQLTime", "Unit": "Milliseconds"}, directive["Metrics"])
+
+    def test_repeated_statement_shapes_are_flagged(self):
+        lines = self.run_event("grade_change", [("progress", [f"SELECT {value}" for value in range(5)])])
+        total = lines[-1]
+
+        self.assertEqual(total["NPlusOneStatements"], 1)
+        self.assertEqual(total["NPlusOne"], [{"step": "progress", "count": 5, "statement": "SELECT ?"}])
+
+    def test_disabled_metrics_collect_nothing(self):
+        metrics = SQLMetrics(namespace="Test", enabled=False)
+        metrics.instrument(self.engine)
+        with patch.object(metrics, "emit") as emit, metrics.event("logged_in"), metrics.step("login"):
+            with self.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+        emit.assert_not_called()
+
+    def test_statement_shape(self):
+        self.assertEqual(
+            statement_shape("SELECT *  FROM lms\n WHERE id IN (1, 2, 3) AND name = 'it''s' AND x = %(x_1)s"),
+            "SELECT * FROM lms WHERE id IN (?) AND name = ? AND x = %(x_1)s",
+        )
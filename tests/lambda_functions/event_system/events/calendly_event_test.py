@@ -1,5 +1,5 @@
 import unittest
-from unittest.mock import MagicMock, Mock
+from unittest.mock import MagicMock, Mock, patch
 
 from propus.calbright_sql.user import User
 
@@ -35,6 +35,11 @@ class TestCalendlyEvents(unittest.TestCase):
         self.calendly_event.logger = logger
 
         self.return_learner_status_id = "NEW LEARNER STATUS"
+        self.reference_data = patch("events.calendly_event.reference_data").start()
+        self.reference_data.get_instance.side_effect = lambda session, model, status: LearnerStatus(
+            id=self.return_learner_status_id, status=status
+        )
+        self.addCleanup(patch.stopall)
         self.user_email = "prof@calbright.org"
         self.user_id = "fc6e51473b30"
         self.crm_event = f"https://api.calendly.com/event_types/{EventTypeUUID.CRM.value}"
@@ -180,6 +185,11 @@ class TestCalendlyEvents(unittest.TestCase):
         self.calendly_event.run(self.invitee_created_event)
         self.assertTrue(self.sf_updated)
         self.assertEqual(self.calendly_event.student_record.learner_status.id, self.return_learner_status_id)
+        # the learner status comes from the reference data cache, not a query per event
+        self.reference_data.get_instance.assert_called_once_with(
+            self.calendly_event.calbright.session, LearnerStatus, "Ready for Onboarding"
+        )
+        self.assertEqual(self.calendly_event.calbright.session.execute.call_count, 1)
 
     def test_invitee_created_flow(self):
         self.test_name = "student_only_app_submitted"
@@ -199,8 +209,6 @@ class TestCalendlyEvents(unittest.TestCase):
         if "student_only" in self.test_name:
             resp.scalars().all = Mock(return_value=[self.student_record])
             self.test_name = self.test_name.replace("student_only", "")
-        else:
-            resp.scalar_one.return_value = LearnerStatus(id=self.return_learner_status_id)
         return resp
 
     def sf_update_contact_record(self, sf_id, Cfg_Learner_Status__c):
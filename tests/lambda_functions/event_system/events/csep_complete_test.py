@@ -157,6 +157,10 @@ class TestEventCsepComplete(unittest.TestCase):
 
         self.salesforce.get_next_term.return_value = {"Id": self.test_event_data.get("first_term_id")}
 
+        self.reference_data = patch("events.csep_complete.reference_data").start()
+        self.reference_data.get_instance.return_value = self.test_event_data.get("learner_status")
+        self.addCleanup(patch.stopall)
+
     @patch("events.csep_complete.update_or_create")
     def test_run(self, mock_update_or_create):
         validate_csep_mock = MagicMock()
@@ -210,6 +214,10 @@ class TestEventCsepComplete(unittest.TestCase):
             self.test_event_data.get("student"), self.test_event_data.get("intended_program"), "ABC_1234"
         )
         mock_update_or_create.assert_called_once()
+        self.reference_data.get_instance.assert_called_once_with(
+            self.calbright.session, LearnerStatus, "Completed CSEP"
+        )
+        self.assertEqual(self.test_event_data.get("student").user.learner_status.status, "Completed CSEP")
         request_veteran_services.assert_called_once()
         get_shipping_address_mock.assert_called_once()
         self.sqs.send_message.assert_called_once()
@@ -492,6 +500,9 @@ class TestEventCsepComplete(unittest.TestCase):
             ["IT520 - v1.0", "IT520 - v3.0"],
         )
         self.assertTrue(self.update_contact_record)
+        self.reference_data.get_instance.assert_called_once_with(
+            self.calbright.session, LearnerStatus, "Enrolled in Program Pathway"
+        )
 
         self.assertListEqual(
             self.csep_complete.enroll_student_in_trailhead(
@@ -729,8 +740,6 @@ class TestEventCsepComplete(unittest.TestCase):
             scalar_one.scalar_one.return_value = self.test_event_data.get("instructor")
         elif self.test_name == "MissingInstructor":
             scalar_one.scalar_one.return_value = None
-        elif self.test_name in ["TestRun", "EnrollInTrailhead"]:
-            scalar_one.scalar_one.return_value = self.test_event_data.get("learner_status")
         else:
             scalar_one.scalar_one.return_value = self.test_event_data.get("student")
         return scalar_one
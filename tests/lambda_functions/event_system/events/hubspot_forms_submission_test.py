@@ -4,6 +4,7 @@ from unittest.mock import MagicMock, Mock
 from unittest.mock import patch
 from sqlalchemy.exc import NoResultFound
 from propus.calbright_sql.expressed_interest import LeadSource
+from propus.calbright_sql.learner_status import LearnerStatus
 
 from events.hubspot_form_submitted import HubspotFormSubmitted
 from exceptions import MissingRequiredField
@@ -56,6 +57,10 @@ class TestEventHubspotFormSubmission(unittest.TestCase):
         self.session_added = False
         self.session_executed = False
 
+        self.reference_data = patch("events.hubspot_form_submitted.reference_data").start()
+        self.reference_data.get_id.return_value = "learner_status_id_123"
+        self.addCleanup(patch.stopall)
+
     def test_required_fields(self):
         payload = {}
         for field in self.hubspot_form_submitted._required_fields:
@@ -178,7 +183,9 @@ class TestEventHubspotFormSubmission(unittest.TestCase):
         # Expected outcome: New learner contact is created
         self.hubspot_form_submitted.run(self.test_data)
         self.hubspot_form_submitted.salesforce.client.create_contact_record.assert_called_once()
-        self.patcher.stop()
+        # the learner status comes from the reference data cache, not a query per event
+        self.reference_data.get_id.assert_called_once_with(self.calbright.session, LearnerStatus, "Expressed Interest")
+        self.assertEqual(self.User.call_args.kwargs["learner_status_id"], "learner_status_id_123")
 
     def test_update_program_of_interest(self):
         self.test_name = "update_program_of_interest"
@@ -244,12 +251,8 @@ class TestEventHubspotFormSubmission(unittest.TestCase):
         if self.test_name == "create_new_learner_contact":
             if args[0].columns_clause_froms[0].name == "user":
                 scalar_one.scalar_one.side_effect = NoResultFound
-            if args[0].columns_clause_froms[0].name == "learner_status":
-                self.patcher = patch("events.hubspot_form_submitted.User")
-                self.User = self.patcher.start()
-                l_status_mock = Mock()
-                l_status_mock.id = "learner_status_id_123"
-                scalar_one.scalar_one.side_effect = l_status_mock
+                # the User model is only replaced once it has been queried
+                self.User = patch("events.hubspot_form_submitted.User").start()
                 self.hubspot_form_submitted.create_expressed_interest_record = Mock()
         if self.test_name == "update_learner_status_to_app_submitted":
             contact = Mock()
@@ -1,5 +1,8 @@
+import copy
+import threading
+import time
 import unittest
-from unittest.mock import MagicMock, Mock
+from unittest.mock import MagicMock, Mock, patch
 
 from lambda_functions.event_system.constants.hubspot_template_ids import (
     AUTOMATIC_DROP_DEVICE,
@@ -10,6 +13,8 @@ from lambda_functions.event_system.events.salesforce import SalesforceEvent
 
 from exceptions import MissingRequiredField
 
+MODULE = "lambda_functions.event_system.events.salesforce"
+
 
 class TestEventSalesforce(unittest.TestCase):
     def setUp(self):
@@ -158,6 +163,112 @@ class TestEventSalesforce(unittest.TestCase):
         self.assertTrue(self.staff_email_sent)
         self.assertTrue(self.student_email_sent)
 
+    def test_bulk_drop_summary(self):
+        self.test_name = "salesforce_event"
+        students = []
+        for index in range(3):
+            student = copy.deepcopy(self.student_data)
+            student["Student__r"].update({"Id": f"sf{index}", "cfg_CCC_ID__c": f"CCC{index}"})
+            students.append(student)
+
+        def update_contact_record(sf_id, **data):
+            if sf_id == "sf1":
+                raise Exception("UNABLE_TO_LOCK_ROW")
+
+        self.salesforce_event.salesforce.client.update_contact_record = Mock(side_effect=update_contact_record)
+        summary = self.salesforce_event.run(students)
+
+        self.assertEqual(summary["students"], 3)
+        failed_steps = {student["ccc_id"]: student["failed_steps"] for student in summary["failed"]}
+        self.assertIn("update_learner_status_salesforce", failed_steps["CCC1"])
+        self.assertEqual(
+            summary["steps"]["update_learner_status_salesforce"], {"succeeded": 2, "failed": 1, "skipped": 0}
+        )
+        self.assertEqual(summary["steps"]["deprovision_strut"]["skipped"], 3)
+        self.assertEqual(self.salesforce_event.salesforce.client.update_contact_record.call_count, 3)
+
+    def test_bulk_drop(self):
+        self.test_name = "salesforce_event"
+        self.salesforce_event.bulk_threshold = 2
+        students = []
+        for index in range(3):
+            student = copy.deepcopy(self.student_data)
+            student["Student__r"].update({"Id": f"sf{index}", "cfg_CCC_ID__c": f"CCC{index}"})
+            students.append(student)
+        self.salesforce_event.salesforce.update_contacts = Mock(
+            return_value={"sf0": [], "sf1": [{"statusCode": "UNABLE_TO_LOCK_ROW"}], "sf2": []}
+        )
+        session = self.salesforce_event.calbright.session
+        session.execute.return_value.scalars.return_value = ["CCC0", "CCC1"]
+
+        with patch(f"{MODULE}.reference_data") as reference_data, patch(f"{MODULE}.update") as update:
+            reference_data.get_id.return_value = 7
+            summary = self.salesforce_event.run(students)
+
+        update.return_value.where.return_value.values.assert_called_once_with(learner_status_id=7)
+        session.commit.assert_called_once()
+        self.salesforce_event.salesforce.client.update_contact_record.assert_not_called()
+        (updates,) = self.salesforce_event.salesforce.update_contacts.call_args.args
+        self.assertEqual(sorted(updates), ["sf0", "sf1", "sf2"])
+        self.assertEqual(updates["sf0"]["cfg_Learner_Status__c"], "Dropped")
+
+        failed_steps = {student["ccc_id"]: student["failed_steps"] for student in summary["failed"]}
+        self.assertEqual(failed_steps["CCC1"], ["update_learner_status_salesforce"])
+        self.assertEqual(failed_steps["CCC2"], ["update_learner_status_db"])
+        self.assertNotIn("CCC0", failed_steps)
+        self.assertEqual(summary["steps"]["send_drop_emails"]["succeeded"], 3)
+
+    def test_downstream_limits(self):
+        self.test_name = "salesforce_event"
+        self.salesforce_event.downstream_limits = self.salesforce_event.downstream_limits | {"hubspot": 1}
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def send_transactional_email(**kwargs):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+        self.salesforce_event.hubspot.send_transactional_email = Mock(side_effect=send_transactional_email)
+        self.salesforce_event.run([copy.deepcopy(self.student_data) for _ in range(4)])
+        self.assertEqual(self.salesforce_event.hubspot.send_transactional_email.call_count, 8)
+        self.assertEqual(max(peak), 1)
+
+    def test_shared_clients_run_one_call_at_a_time(self):
+        self.test_name = "salesforce_event"
+        self.assertEqual(self.salesforce_event.workers, 5)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def deprovision_gsuite(payload):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+            return True
+
+        self.salesforce_event.deprovision_gsuite = Mock(side_effect=deprovision_gsuite)
+        self.salesforce_event.run([copy.deepcopy(self.student_data) for _ in range(4)])
+        self.assertEqual(self.salesforce_event.deprovision_gsuite.call_count, 4)
+        self.assertEqual(max(peak), 1)
+
+    def test_disabled_bulk_steps_are_skipped(self):
+        self.test_name = "salesforce_event"
+        self.salesforce_event.bulk_threshold = 2
+        self.salesforce_event.features_enabled = ["deprovision_gsuite", "deprovision_strut", "send_drop_emails"]
+        self.salesforce_event.salesforce.update_contacts = Mock()
+        summary = self.salesforce_event.run([copy.deepcopy(self.student_data) for _ in range(3)])
+
+        self.salesforce_event.salesforce.update_contacts.assert_not_called()
+        self.assertEqual(summary["steps"]["update_learner_status_db"], {"succeeded": 0, "failed": 0, "skipped": 3})
+
     def send_transactional_email(self, email_id, to_email, cc=None, bcc=None, custom_properties=None):
         if email_id == AUTOMATIC_DROP_DEVICE:
             self.assertEqual(
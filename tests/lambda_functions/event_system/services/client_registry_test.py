@@ -0,0 +1,38 @@
+import unittest
+from unittest.mock import MagicMock
+
+from event_system import EventSystem
+from services.client_registry import ClientRegistry, LazyClient, _client_factories
+
+
+class TestClientRegistry(unittest.TestCase):
+    def setUp(self):
+        self.factories = {"salesforce": MagicMock(name="salesforce"), "hubspot": MagicMock(name="hubspot")}
+        self.registry = ClientRegistry(self.factories)
+        self.configs = {"salesforce_ssm": "salesforce.propus.dev"}
+        self.ssm = MagicMock()
+
+    def test_clients_are_built_on_first_use_and_reused(self):
+        clients = self.registry.lazy({"salesforce": "salesforce", "hubspot": "hubspot"}, self.configs, self.ssm)
+        self.assertIsInstance(clients["salesforce"], LazyClient)
+        self.factories["salesforce"].assert_not_called()
+
+        clients["salesforce"].get_contact("1")
+        clients["salesforce"].get_contact("2")
+        other_event = self.registry.lazy({"salesforce": "salesforce"}, self.configs, self.ssm)
+        other_event["salesforce"].get_contact("3")
+
+        self.factories["salesforce"].assert_called_once_with(self.configs, self.ssm)
+        self.assertEqual(self.factories["salesforce"].return_value.get_contact.call_count, 3)
+        self.factories["hubspot"].assert_not_called()
+        self.assertEqual(self.registry.built(), ["salesforce"])
+
+    def test_unknown_clients_are_rejected(self):
+        with self.assertRaises(KeyError):
+            self.registry.lazy({"salesforce": "salesforce_v2"}, self.configs, self.ssm)
+
+    def test_handlers_declare_registered_clients(self):
+        for handler in EventSystem._event_type_mapping.values():
+            self.assertTrue(handler._clients)
+            for name in handler._clients.values():
+                self.assertIn(name, _client_factories, f"{handler.__name__} uses unknown client {name}")
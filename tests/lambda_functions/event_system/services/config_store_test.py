@@ -0,0 +1,77 @@
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+from events.base import BaseEventSystem
+from services.config_store import ConfigStore
+
+
+class TestConfigStore(unittest.TestCase):
+    def setUp(self):
+        self.ssm_client = MagicMock()
+        self.versions = {"constants.dev": 1, "feature_flags.dev": 1}
+        self.values = {}
+        self.ssm_client.describe_parameters.side_effect = lambda **kwargs: {
+            "Parameters": [
+                {"Name": name, "Version": self.versions[name]} for name in kwargs["ParameterFilters"][0]["Values"]
+            ]
+        }
+        self.ssm_client.get_parameter.side_effect = lambda Name, WithDecryption: {
+            "Parameter": {
+                "Name": Name,
+                "Version": self.versions[Name],
+                "Value": json.dumps(self.values.get(Name, {"name": Name, "version": self.versions[Name]})),
+            }
+        }
+        self.store = ConfigStore(refresh_seconds=60, ssm_client=self.ssm_client)
+
+    def test_parameters_are_loaded_once(self):
+        for _ in range(3):
+            self.assertEqual(self.store.get("constants.dev"), {"name": "constants.dev", "version": 1})
+            self.store.get("feature_flags.dev")
+        self.assertEqual(self.ssm_client.get_parameter.call_count, 2)
+
+    def test_changed_parameters_are_reloaded_after_the_refresh_interval(self):
+        with patch("services.config_store.time.monotonic", return_value=0.0):
+            self.store.get("constants.dev")
+            self.store.get("feature_flags.dev")
+        self.versions["feature_flags.dev"] = 2
+
+        with patch("services.config_store.time.monotonic", return_value=30.0):
+            self.assertEqual(self.store.get("feature_flags.dev")["version"], 1)
+        with patch("services.config_store.time.monotonic", return_value=61.0):
+            self.assertEqual(self.store.get("feature_flags.dev")["version"], 2)
+            self.store.get("constants.dev")
+        # only the changed parameter was loaded again
+        self.assertEqual(self.ssm_client.get_parameter.call_count, 3)
+
+    def test_flag_flip_takes_effect_when_the_version_changes(self):
+        self.values["feature_flags.dev"] = {"castor": {"base_event": {"active": False}}}
+        with patch("events.base.config_store", self.store):
+            with patch("services.config_store.time.monotonic", return_value=0.0):
+                self.assertEqual(BaseEventSystem({"feature_flags": "feature_flags.dev"}).features_enabled, [])
+
+            self.values["feature_flags.dev"] = {"castor": {"base_event": {"active": True, "enabled": ["ALL"]}}}
+            self.versions["feature_flags.dev"] = 2
+            with patch("services.config_store.time.monotonic", return_value=61.0):
+                self.assertEqual(BaseEventSystem({"feature_flags": "feature_flags.dev"}).features_enabled, ["ALL"])
+        self.assertEqual(
+            [call.kwargs["Name"] for call in self.ssm_client.get_parameter.call_args_list],
+            ["feature_flags.dev", "feature_flags.dev"],
+        )
+
+    def test_parameters_are_reloaded_when_versions_cannot_be_read(self):
+        with patch("services.config_store.time.monotonic", return_value=0.0):
+            self.store.get("constants.dev")
+        self.ssm_client.describe_parameters.side_effect = Exception("throttled")
+        with patch("services.config_store.time.monotonic", return_value=61.0):
+            self.store.get("constants.dev")
+        self.assertEqual(self.ssm_client.get_parameter.call_count, 2)
+
+    def test_event_systems_share_the_store(self):
+        self.values["feature_flags.dev"] = {"castor": {"base_event": {"active": True, "enabled": ["ALL"]}}}
+        with patch("events.base.config_store", self.store):
+            for _ in range(2):
+                system = BaseEventSystem({"constants": "constants.dev", "feature_flags": "feature_flags.dev"})
+        self.assertEqual(system.features_enabled, ["ALL"])
+        self.assertEqual(self.ssm_client.get_parameter.call_count, 2)
@@ -3,7 +3,11 @@ import sys
 
 current_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append("/".join(current_path.split("/")[:-2] + "lambda_functions/canvas_events".split("/")))
+# modules shared by the Lambdas, copied into each Lambda by its deploy.sh
+sys.path.append("/".join(current_path.split("/")[:-2] + ["lambda_functions"]))
+from tests.benchmarks.canvas_events_replay_test import TestCanvasEventsReplay
 from tests.lambda_functions.canvas_events.canvas_event_system_test import TestCanvasEventSystem
+from tests.lambda_functions.canvas_events.dlq_drain_test import TestDLQDrain
 from tests.lambda_functions.canvas_events.events.asset_events import TestCanvasEventAsset
 from tests.lambda_functions.canvas_events.events.conversation_events import TestCanvasEventConversation
 from tests.lambda_functions.canvas_events.events.course_events import TestCanvasEventCourse
@@ -12,6 +16,24 @@ from tests.lambda_functions.canvas_events.events.grade_events import TestCanvasE
 from tests.lambda_functions.canvas_events.events.logged_events import TestCanvasEventLoggedIn
 from tests.lambda_functions.canvas_events.events.quiz_events import TestCanvasEventQuiz
 from tests.lambda_functions.canvas_events.events.submission_events import TestCanvasEventSubmission
+from tests.lambda_functions.canvas_events.services.test_canvas_services import TestSubmissionHistoryCache
+from tests.lambda_functions.canvas_events.services.test_event_envelope import TestCanvasEventEnvelope
+from tests.lambda_functions.canvas_events.services.test_event_ledger import TestEventLedger
+from tests.lambda_functions.canvas_events.services.test_psql_services import (
+    TestPSQLServicesProgress,
+    TestReferenceDataCache,
+    TestStudentContext,
+    TestUnitOfWork,
+)
+from tests.lambda_functions.canvas_events.services.test_sf_services import (
+    TestActivityTimestampStore,
+    TestContactCache,
+    TestSalesforceCollections,
+    TestSalesforceFanOut,
+    TestSFServices,
+    TestSFWriteBuffer,
+)
+from tests.lambda_functions.canvas_events.services.test_sql_metrics import TestSQLMetrics
 
 from tests.start_scripts.base import BaseTestClass
 
@@ -21,15 +43,31 @@ class CanvasEventsTests(BaseTestClass):
         super().__init__(test_name)
 
         self.tests = [
+            TestActivityTimestampStore,
             TestCanvasEventAsset,
             TestCanvasEventConversation,
             TestCanvasEventCourse,
             TestCanvasEventDiscussion,
+            TestCanvasEventEnvelope,
             TestCanvasEventGrade,
             TestCanvasEventLoggedIn,
             TestCanvasEventQuiz,
             TestCanvasEventSubmission,
+            TestCanvasEventsReplay,
             TestCanvasEventSystem,
+            TestContactCache,
+            TestDLQDrain,
+            TestEventLedger,
+            TestPSQLServicesProgress,
+            TestReferenceDataCache,
+            TestSalesforceCollections,
+            TestSalesforceFanOut,
+            TestSFServices,
+            TestSFWriteBuffer,
+            TestSQLMetrics,
+            TestStudentContext,
+            TestSubmissionHistoryCache,
+            TestUnitOfWork,
         ]
 
 
@@ -3,6 +3,8 @@ import sys
 
 current_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append("/".join(current_path.split("/")[:-2] + "lambda_functions/event_system".split("/")))
+# modules shared by the Lambdas, copied into each Lambda by its deploy.sh
+sys.path.append("/".join(current_path.split("/")[:-2] + ["lambda_functions"]))
 from tests.lambda_functions.event_system.event_system_test import TestEventSystem
 from tests.lambda_functions.event_system.events.calendly_event_test import TestCalendlyEvents
 from tests.lambda_functions.event_system.events.csep_complete_test import TestEventCsepComplete
@@ -16,6 +18,8 @@ from tests.lambda_functions.event_system.events.veteran_intake_complete_test imp
 from tests.lambda_functions.event_system.events.tangoe_event_test import TestEventTangoeEvent
 from tests.lambda_functions.event_system.events.dpau_request_test import TestEventDPAURequest
 from tests.lambda_functions.event_system.events.dpau_complete_test import TestEventDPAUComplete
+from tests.lambda_functions.event_system.services.client_registry_test import TestClientRegistry
+from tests.lambda_functions.event_system.services.config_store_test import TestConfigStore
 
 from tests.start_scripts.base import BaseTestClass
 
@@ -36,6 +40,8 @@ class EventSystem(BaseTestClass):
             TestEventDPAURequest,
             TestEventDPAUComplete,
             TestSpTermCertified,
+            TestClientRegistry,
+            TestConfigStore,
         ]
 
 